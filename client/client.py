@@ -1,7 +1,6 @@
 import sys
 import socket
 import cv2
-import requests
 import subprocess
 import threading
 import queue
@@ -9,9 +8,31 @@ import time
 import argparse
 import urllib.parse
 
+from uploader import ChunkUploader, read_chunks, DEFAULT_BATCH_BYTES, DEFAULT_BATCH_INTERVAL, DEFAULT_MAX_IN_FLIGHT
+from latency import FrameClock, LatencyStamper
+from framering import FrameRing, DEFAULT_SLOTS
+from ratecontrol import RateController, default_bitrate
+
 DEFAULT_SERVER_URL = "http://127.0.0.1:5000/upload"
 
 SERVER_URL = DEFAULT_SERVER_URL
+UPLOADER = None
+# Extra per-camera upload headers (e.g. ABR-Ladder) set from the command line
+CAMERA_HEADERS = {}
+# Captured frames waiting for the encoder before the oldest is dropped (--frame-slots)
+FRAME_SLOTS = DEFAULT_SLOTS
+# Adapt each camera's encoder to upload congestion (--no-adapt turns it off)
+ADAPT = True
+# Bitrate ceiling in bits/s for adaptive encoding; None derives it from the capture size (--max-kbps)
+MAX_BITRATE = None
+
+
+def get_uploader() -> ChunkUploader:
+    # lazily build the shared uploader so importing this module stays side-effect free
+    global UPLOADER
+    if UPLOADER is None:
+        UPLOADER = ChunkUploader(SERVER_URL)
+    return UPLOADER
 
 
 def build_server_url(host: str, port: int) -> str:
@@ -20,39 +41,75 @@ def build_server_url(host: str, port: int) -> str:
     return urllib.parse.urljoin(base, "/upload")
 
 
-def _writer_loop(ffmpeg, frame_queue, stop_event):
-    """Write raw frames into ffmpeg stdin."""
+def encoder_command(width: int, height: int, fps: int, settings=None):
+    """ffmpeg command encoding raw BGR frames from stdin to H.264 on stdout.
+    settings (see RateController.settings) caps the bitrate and degrades the picture
+    without changing the coded size or frame rate the server already set up for."""
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-f", "rawvideo",
+        "-pix_fmt", "bgr24",
+        "-s", f"{width}x{height}",
+        "-r", str(fps),
+        "-i", "-",
+    ]
+    if settings is not None:
+        filters = []
+        if settings["scale"] < 1:
+            w = max(2, int(width * settings["scale"]) // 2 * 2)
+            h = max(2, int(height * settings["scale"]) // 2 * 2)
+            filters.append(f"scale={w}:{h},scale={width}:{height}")
+        if settings["fps_divisor"] > 1:
+            # drop frames here; -r below repeats them, and repeated frames cost almost nothing
+            filters.append(f"fps={fps}/{settings['fps_divisor']}")
+        if filters:
+            cmd += ["-vf", ",".join(filters), "-r", str(fps)]
+        bitrate = str(settings["bitrate"])
+        # a one-second VBV buffer keeps bursts (keyframes) within what the uplink just sustained
+        cmd += ["-b:v", bitrate, "-maxrate", bitrate, "-bufsize", bitrate]
+    cmd += [
+        "-c:v", "libx264",
+        "-preset", "ultrafast",
+        # 4:2:0 and a keyframe every 2 s let the server package the stream without re-encoding
+        "-pix_fmt", "yuv420p",
+        "-g", str(fps * 2),
+        "-f", "h264",
+        "-"
+    ]
+    return cmd
+
+
+def _writer_loop(ffmpeg, ring, stop_event, clock=None, switch=None):
+    """Write queued frames from the ring into ffmpeg stdin, straight from their slots.
+    switch(ffmpeg), if given, runs between frames and returns the encoder to continue with."""
     while not stop_event.is_set():
-        try:
-            frame = frame_queue.get(timeout=1)
-            ffmpeg.stdin.write(frame.tobytes())
-        except queue.Empty:
+        item = ring.get(timeout=1)
+        if item is None:
             continue
+        if switch is not None:
+            ffmpeg = switch(ffmpeg)
+        slot, captured = item
+        try:
+            ffmpeg.stdin.write(ring.views[slot])
         except BrokenPipeError:
+            ring.release(slot, written=False)
             break
+        ring.release(slot)
+        if clock is not None:
+            clock.written(captured)
 
 
-def _reader_loop(ffmpeg, cam_unique_id, stop_event):
-    """Read encoded chunks from ffmpeg stdout and send to server."""
-    while True:
-        data = ffmpeg.stdout.read(4096)
-        if not data:
-            if ffmpeg.poll() is not None:
-                break
-            time.sleep(0.01)
-            continue
-        try:
-            requests.post(
-                SERVER_URL,
-                data=data,
-                headers={
-                    "Content-Type": "application/octet-stream",
-                    "Camera-ID": str(cam_unique_id)
-                },
-                timeout=1
-            )
-        except requests.exceptions.RequestException:
-            pass  # drop chunk if server unreachable
+def _reader_loop(ffmpeg, cam_unique_id, stop_event, fps=30, clock=None, successors=None):
+    """Read encoded chunks from ffmpeg stdout and hand them to the shared uploader.
+    successors (a queue) delivers the encoders that replace ffmpeg after a rate change, in
+    order; each is read only once its predecessor has flushed, and None ends the stream."""
+    uploader = get_uploader()
+    upload = uploader.open(cam_unique_id, headers={**CAMERA_HEADERS, "Camera-FPS": str(fps)})
+    stamper = LatencyStamper(clock, uploader.clock_offset)
+    while ffmpeg is not None:
+        read_chunks(ffmpeg.stdout, upload, ffmpeg, stamper=stamper)
+        ffmpeg = successors.get() if successors is not None else None
 
 
 class CameraController:
@@ -64,6 +121,8 @@ class CameraController:
         self.stop_event = threading.Event()
         self._thread = None
         self.unique_id_timestamped = None
+        self.ring = None
+        self.rate = None
 
     def start(self):
         if self._thread and self._thread.is_alive():
@@ -81,10 +140,13 @@ class CameraController:
             self._thread.join()
             self._thread = None
         if self.unique_id_timestamped:
-            try:
-                requests.delete(SERVER_URL, headers={"Camera-ID": str(self.unique_id_timestamped)}, timeout=1)
-            except requests.exceptions.RequestException:
-                pass
+            stats = get_uploader().close(self.unique_id_timestamped)
+            if stats:
+                print(f"Camera {self.unique_id_timestamped} upload stats: {stats}")
+        if self.ring is not None:
+            print(f"Camera {self.unique_id_timestamped} frame stats: {self.ring.stats}")
+        if self.rate is not None:
+            print(f"Camera {self.unique_id_timestamped} encoder level {self.rate.level}, {self.rate.changes} changes")
 
     def _run(self):
         cap = cv2.VideoCapture(self.device_index)
@@ -96,51 +158,76 @@ class CameraController:
         height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) or 480)
         fps = int(cap.get(cv2.CAP_PROP_FPS) or 30)
 
-        ffmpeg_cmd = [
-            "ffmpeg",
-            "-y",
-            "-f", "rawvideo",
-            "-pix_fmt", "bgr24",
-            "-s", f"{width}x{height}",
-            "-r", str(fps),
-            "-i", "-",
-            "-c:v", "libx264",
-            "-preset", "ultrafast",
-            "-f", "h264",
-            "-"
-        ]
-
-        ffmpeg = subprocess.Popen(
-            ffmpeg_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
-        )
-
-        frame_queue = queue.Queue()
+        if ADAPT:
+            self.rate = RateController(
+                MAX_BITRATE or default_bitrate(width, height, fps),
+                max_queued=max(1, get_uploader().max_in_flight // 2),
+                log=lambda message: print(f"Camera {self.unique_id_timestamped}: {message}")
+            )
+        else:
+            self.rate = None
+
+        def start_encoder():
+            settings = self.rate.settings() if self.rate is not None else None
+            return subprocess.Popen(
+                encoder_command(width, height, fps, settings),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+
+        # encoders replacing the first one after rate changes, in order, for the reader
+        successors = queue.Queue()
+        encoders = [start_encoder()]
+
+        def switch(current):
+            if self.rate is None or not self.rate.due():
+                return current
+            if not self.rate.update(get_uploader().stats().get(self.unique_id_timestamped, {})):
+                return current
+            # the new encoder starts with SPS/PPS and an IDR frame; the old one flushes
+            # its last frames on EOF, so the uploaded stream changes over at a keyframe
+            encoders.append(start_encoder())
+            try:
+                current.stdin.close()
+            except OSError:
+                pass
+            successors.put(encoders[-1])
+            return encoders[-1]
+
+        self.ring = ring = FrameRing((height, width, 3), FRAME_SLOTS)
+        # capture times travel to the server inside the encoded stream (see latency.py)
+        clock = FrameClock()
 
         # Start writer + reader threads
-        writer = threading.Thread(target=_writer_loop, args=(ffmpeg, frame_queue, self.stop_event), daemon=True)
-        reader = threading.Thread(target=_reader_loop, args=(ffmpeg, self.unique_id_timestamped, self.stop_event), daemon=True)
+        writer = threading.Thread(target=_writer_loop, args=(encoders[0], ring, self.stop_event, clock, switch), daemon=True)
+        reader = threading.Thread(target=_reader_loop, args=(encoders[0], self.unique_id_timestamped, self.stop_event, fps, clock, successors), daemon=True)
         writer.start()
         reader.start()
 
         print(f"Started camera {self.unique_id_timestamped} (device {self.device_index})")
 
         while not self.stop_event.is_set():
-            ret, frame = cap.read()
-            if not ret:
+            # capture straight into a ring slot; when the encoder lags the oldest queued frame is reused
+            slot = ring.acquire()
+            ret, frame = cap.read(image=ring.frames[slot])
+            if not ret or not ring.fill(slot, frame):
+                ring.release(slot, written=False)
+                if ret:
+                    print(f"Camera {self.device_index} delivered {frame.shape} frames, expected {ring.frames[slot].shape}")
                 break
-            try:
-                frame_queue.put_nowait(frame)
-            except queue.Full:
-                pass  # drop if queue is overloaded
+            ring.commit(slot, time.time())
 
         cap.release()
+        # the writer may still swap encoders until it has stopped
+        self.stop_event.set()
+        writer.join()
         try:
-            ffmpeg.stdin.close()
+            encoders[-1].stdin.close()
         except Exception:
             pass
-        writer.join()
+        successors.put(None)
         reader.join()
-        ffmpeg.wait()
+        for ffmpeg in encoders:
+            ffmpeg.wait()
 
 
 def detect_cameras(max_test=5):
@@ -173,6 +260,9 @@ def interactive_menu(server_url: str = DEFAULT_SERVER_URL):
         for uid, ctrl in controllers.items():
             status = 'running' if ctrl._thread and ctrl._thread.is_alive() else 'stopped'
             print(f" - {uid}: device {ctrl.device_index} ({status})")
+            stats = get_uploader().stats().get(str(ctrl.unique_id_timestamped))
+            if stats:
+                print(f"     sent {stats['sent_bytes']} B, retried {stats['retried_bytes']} B, dropped {stats['dropped_bytes']} B")
         print('\nCommands (single-char):')
         print(' l  - list cameras')
         print(' s  - start all cameras')
@@ -216,6 +306,15 @@ def main(argv=None):
     group.add_argument('--server-url', help='Full server upload URL (overrides --host/--port)')
     parser.add_argument('--host', help='Server host to connect to (used with --port)', default='127.0.0.1')
     parser.add_argument('--port', type=int, help='Server port to connect to (used with --host)', default=5000)
+    parser.add_argument('--batch-bytes', type=int, default=DEFAULT_BATCH_BYTES, help='Upload once this many bytes are buffered')
+    parser.add_argument('--batch-ms', type=float, default=DEFAULT_BATCH_INTERVAL * 1000, help='Upload buffered bytes at least this often')
+    parser.add_argument('--in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT, help='Max batches queued per camera before dropping the oldest')
+    parser.add_argument('--stream', action='store_true', help='Send each camera over one long-lived chunked POST to /ingest')
+    parser.add_argument('--abr', choices=('on', 'off'), help="Ask the server to encode (or skip) its bitrate ladder for these cameras")
+    parser.add_argument('--low-latency', choices=('on', 'off'), help="Ask the server for (or against) low-latency chunked live streaming of these cameras")
+    parser.add_argument('--no-adapt', action='store_true', help='Encode at a fixed quality instead of adapting to upload congestion')
+    parser.add_argument('--max-kbps', type=int, help='Bitrate ceiling for adaptive encoding (default: from the capture size)')
+    parser.add_argument('--frame-slots', type=int, default=DEFAULT_SLOTS, help='Captured frames queued for the encoder before the oldest is dropped')
     args = parser.parse_args(argv)
 
     if args.server_url:
@@ -223,9 +322,23 @@ def main(argv=None):
     else:
         server_url = build_server_url(args.host, args.port)
 
-    # override module-level default used by reader loop
-    global SERVER_URL
+    # override module-level defaults used by reader loop
+    global SERVER_URL, UPLOADER, FRAME_SLOTS, ADAPT, MAX_BITRATE
     SERVER_URL = server_url
+    FRAME_SLOTS = max(1, args.frame_slots)
+    ADAPT = not args.no_adapt
+    MAX_BITRATE = args.max_kbps * 1000 if args.max_kbps else None
+    if args.abr:
+        CAMERA_HEADERS["ABR-Ladder"] = args.abr
+    if args.low_latency:
+        CAMERA_HEADERS["Low-Latency"] = args.low_latency
+    UPLOADER = ChunkUploader(
+        server_url,
+        batch_bytes=args.batch_bytes,
+        batch_interval=args.batch_ms / 1000,
+        max_in_flight=args.in_flight,
+        streaming=args.stream
+    )
 
     interactive_menu(server_url=server_url)
 
@@ -0,0 +1,73 @@
+"""
+Fixed-size ring of preallocated frame buffers between capture and the encoder.
+
+The capture thread fills a slot in place (`cv2.VideoCapture.read(image=...)`),
+commits it with its capture time, and the writer thread hands the slot's
+memory straight to ffmpeg's stdin. No frame is copied on the way. Memory
+is fixed at `slots + 2` frames: the queued ones plus one being captured and
+one being written.
+
+When the encoder falls behind and every queued slot is full, the capture
+thread reuses the oldest queued frame. That drop is counted.
+"""
+import collections
+import threading
+
+import numpy as np
+
+DEFAULT_SLOTS = 4
+
+
+class FrameRing:
+    """Bounded drop-oldest frame queue over one preallocated array."""
+
+    def __init__(self, shape, slots: int = DEFAULT_SLOTS, dtype=np.uint8):
+        # one extra buffer for the frame being captured and one for the frame being written
+        self.frames = np.empty((slots + 2, *shape), dtype=dtype)
+        self.views = [memoryview(frame).cast("B") for frame in self.frames]
+        self._free = collections.deque(range(len(self.frames)))
+        self._ready = collections.deque()
+        self._cond = threading.Condition()
+        self.stats = {"captured": 0, "dropped": 0, "written": 0, "copied": 0}
+
+    def acquire(self) -> int:
+        """Slot for the next capture; reuses the oldest queued frame if none is free."""
+        with self._cond:
+            if self._free:
+                return self._free.popleft()
+            slot, _ = self._ready.popleft()
+            self.stats["dropped"] += 1
+            return slot
+
+    def commit(self, slot: int, captured: float):
+        """Queue a filled slot captured at `captured` (time.time())."""
+        with self._cond:
+            self._ready.append((slot, captured))
+            self.stats["captured"] += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Oldest queued (slot, captured), or None after timeout. release() the slot when done."""
+        with self._cond:
+            if not self._ready and not self._cond.wait_for(lambda: self._ready, timeout):
+                return None
+            return self._ready.popleft()
+
+    def release(self, slot: int, written: bool = True):
+        """Return a slot from get() or acquire() to the free list."""
+        with self._cond:
+            self._free.append(slot)
+            if written:
+                self.stats["written"] += 1
+
+    def fill(self, slot: int, image) -> bool:
+        """Make sure the slot holds image; copies only when the capture backend did not
+        write in place. False if the image does not fit the ring."""
+        frame = self.frames[slot]
+        if image is frame or (image is not None and image.ctypes.data == frame.ctypes.data):
+            return True
+        if image is None or image.shape != frame.shape:
+            return False
+        np.copyto(frame, image)
+        self.stats["copied"] += 1
+        return True
@@ -0,0 +1,112 @@
+"""
+Capture timestamps that travel inside the encoded stream, for the server's
+glass-to-playback latency breakdown.
+
+`FrameClock` remembers when each frame was captured and handed to ffmpeg.
+`LatencyStamper` watches ffmpeg's H.264 output, matches each encoded frame to
+its capture, and every `interval` seconds inserts an SEI user-data NAL unit
+(ignored by decoders) in front of a frame carrying:
+
+    c=<capture time>;q=<frame queue s>;e=<encode s>;o=<server clock offset s>
+
+The payload is ASCII, so it never needs emulation-prevention bytes.
+"""
+import collections
+import threading
+import time
+
+# 16-byte user_data_unregistered UUID the server looks for
+LATENCY_SEI_UUID = b"MultiFlowLatency"
+DEFAULT_STAMP_INTERVAL = 0.5
+
+_START_CODE = b"\x00\x00\x01"
+_NAL_SLICE = 1
+_NAL_IDR = 5
+
+
+def sei_nal(payload: bytes) -> bytes:
+    """Annex-B SEI NAL with one user_data_unregistered message."""
+    size = len(LATENCY_SEI_UUID) + len(payload)
+    size_bytes = b"\xff" * (size // 255) + bytes([size % 255])
+    # type 6 (SEI), payload type 5, payload, rbsp trailing bits
+    return b"\x00\x00\x00\x01\x06\x05" + size_bytes + LATENCY_SEI_UUID + payload + b"\x80"
+
+
+def latency_sei(captured: float, written: float, encoded: float, clock_offset: float) -> bytes:
+    """SEI NAL for a frame captured at `captured`, handed to the encoder at
+    `written` and leaving it at `encoded` (all time.time())."""
+    return sei_nal((f"c={captured:.6f};q={written - captured:.6f};"
+                    f"e={encoded - written:.6f};o={clock_offset:.6f}").encode())
+
+
+class FrameClock:
+    """Capture and hand-off times of frames written to the encoder, in order."""
+
+    def __init__(self):
+        self._frames = collections.deque()
+        self._lock = threading.Lock()
+
+    def written(self, captured: float):
+        """Call after a frame captured at `captured` (time.time()) was written to ffmpeg."""
+        with self._lock:
+            self._frames.append((captured, time.time()))
+
+    def pop(self):
+        """(captured, written) of the next encoded frame, or None if unknown."""
+        with self._lock:
+            return self._frames.popleft() if self._frames else None
+
+
+class LatencyStamper:
+    """Callable that returns each chunk of encoder output with latency SEI inserted.
+
+    Without a FrameClock (e.g. a file source), frames are treated as captured
+    when they leave the encoder.
+    """
+
+    def __init__(self, clock=None, clock_offset=lambda: 0.0, interval=DEFAULT_STAMP_INTERVAL):
+        self.clock = clock
+        self.clock_offset = clock_offset
+        self.interval = interval
+        self._pending = b""
+        self._last_stamp = 0.0
+
+    def _frame_starts(self, data: bytes):
+        """Offsets in data of start codes that begin a new frame (first slice of a picture).
+        Offsets are negative when the start code began in an earlier chunk."""
+        buf = self._pending + data
+        base = len(self._pending)
+        starts = []
+        pos = buf.find(_START_CODE)
+        incomplete = None
+        while pos != -1:
+            if pos + 4 >= len(buf):
+                incomplete = pos
+                break
+            nal_type = buf[pos + 3] & 0x1F
+            # first_mb_in_slice == 0 is ue(v) "1": the slice header's first bit is set
+            if nal_type in (_NAL_SLICE, _NAL_IDR) and buf[pos + 4] & 0x80:
+                start = pos - 1 if pos > 0 and buf[pos - 1] == 0 else pos
+                starts.append(start - base)
+            pos = buf.find(_START_CODE, pos + 3)
+        self._pending = buf[incomplete:] if incomplete is not None else buf[-3:]
+        return starts
+
+    def __call__(self, data: bytes) -> bytes:
+        starts = self._frame_starts(data)
+        if not starts:
+            return data
+        now = time.time()
+        out = bytearray()
+        copied = 0
+        for start in starts:
+            frame = self.clock.pop() if self.clock is not None else None
+            captured, written = frame if frame is not None else (now, now)
+            if start < 0 or now - self._last_stamp < self.interval:
+                continue
+            out += data[copied:start]
+            out += latency_sei(captured, written, now, self.clock_offset())
+            copied = start
+            self._last_stamp = now
+        out += data[copied:]
+        return bytes(out)
@@ -0,0 +1,147 @@
+"""
+Congestion-aware rate control for a camera's encoder.
+
+`RateController` compares successive upload snapshots (see
+`CameraUpload.snapshot`). It treats an interval as congested if any of these
+happened:
+- batches were dropped
+- the server pushed back with 429/503
+- batches piled up in the pipeline
+- uploads took too long on average
+
+On congestion it steps one level down the ladder in LEVELS. After
+`recover_after` healthy intervals in a row it steps one level back up. A step
+up that is followed straight away by congestion doubles the wait before the
+next probe.
+
+Levels lower the target bitrate first, then soften the picture, then halve
+the frame rate. The encoded size and frame rate stay the same throughout:
+the server sized its packaging from the first stream and times raw H.264 by
+the Camera-FPS header. So resolution and frame-rate steps happen inside the
+encoder's filter graph (scale down and back up, drop and repeat frames), and
+the bitrate cap makes them pay off.
+
+A server that analyses motion answers uploads with a Camera-Activity header.
+While it reports the camera "idle", the encoder runs at the last level
+whatever the uplink could carry, and uplink judgement pauses. The first
+"active" answer restores the previous level. Streaming uploads get no
+answers until they end, so this only applies to batched uploads.
+"""
+import time
+
+# (bitrate fraction, picture scale, frame-rate divisor)
+LEVELS = (
+    (1.0, 1.0, 1),
+    (0.7, 1.0, 1),
+    (0.5, 1.0, 1),
+    (0.35, 0.75, 1),
+    (0.25, 0.5, 1),
+    (0.15, 0.5, 2),
+)
+DEFAULT_INTERVAL = 2.0
+DEFAULT_RECOVER_AFTER = 5
+MAX_RECOVER_AFTER = 60
+# Average seconds per upload above which the uplink counts as congested
+DEFAULT_MAX_SEND_SECONDS = 0.5
+# Default ceiling: bits per pixel per frame, roughly good 720p/1080p quality with libx264
+BITS_PER_PIXEL = 0.1
+
+
+def default_bitrate(width: int, height: int, fps: int) -> int:
+    return int(width * height * fps * BITS_PER_PIXEL)
+
+
+class RateController:
+    """Chooses an encoder level for one camera from its upload statistics."""
+
+    def __init__(self, max_bitrate: int, max_queued: int = 2, interval: float = DEFAULT_INTERVAL,
+                 recover_after: int = DEFAULT_RECOVER_AFTER, max_send_seconds: float = DEFAULT_MAX_SEND_SECONDS,
+                 log=print):
+        self.max_bitrate = max_bitrate
+        self.max_queued = max_queued
+        self.interval = interval
+        self.base_recover_after = recover_after
+        self.recover_after = recover_after
+        self.max_send_seconds = max_send_seconds
+        self.log = log
+        self.level = 0
+        self.changes = 0
+        self.idle = False
+        self._previous = None
+        self._checked = time.monotonic()
+        self._healthy = 0
+        self._probing = False
+
+    def settings(self) -> dict:
+        fraction, scale, divisor = LEVELS[len(LEVELS) - 1 if self.idle else self.level]
+        return {"bitrate": int(self.max_bitrate * fraction), "scale": scale, "fps_divisor": divisor}
+
+    def congestion(self, previous: dict, current: dict) -> list:
+        """Reasons the interval between two snapshots counts as congested (empty if healthy)."""
+        def delta(key):
+            return current.get(key, 0) - previous.get(key, 0)
+
+        reasons = []
+        if delta("dropped_batches") > 0:
+            reasons.append(f"{delta('dropped_batches')} batches dropped")
+        if delta("rejected_batches") > 0:
+            reasons.append(f"server refused {delta('rejected_batches')} batches")
+        if current.get("queued_batches", 0) >= self.max_queued:
+            reasons.append(f"{current['queued_batches']} batches queued")
+        sent = delta("sent_batches")
+        if sent > 0 and delta("send_seconds") / sent > self.max_send_seconds:
+            reasons.append(f"uploads take {delta('send_seconds') / sent:.2f} s")
+        return reasons
+
+    def due(self) -> bool:
+        """True once an interval has passed since the last evaluation."""
+        return time.monotonic() - self._checked >= self.interval
+
+    def update(self, snapshot: dict) -> bool:
+        """Feed the camera's current upload snapshot; True when the level changed.
+        Only evaluates once per interval; check due() first to skip taking snapshots."""
+        if not self.due():
+            return False
+        self._checked = time.monotonic()
+        idle = snapshot.get("activity") == "idle"
+        if idle != self.idle:
+            self.idle = idle
+            return self._changed("server reports no motion" if idle else "server reports motion")
+        if idle:
+            return False
+        previous, self._previous = self._previous, snapshot
+        if previous is None:
+            return False
+        reasons = self.congestion(previous, snapshot)
+        if reasons:
+            self._healthy = 0
+            if self._probing:
+                # the last step up did not hold: wait longer before trying again
+                self.recover_after = min(self.recover_after * 2, MAX_RECOVER_AFTER)
+            self._probing = False
+            if self.level == len(LEVELS) - 1:
+                return False
+            return self._step(self.level + 1, "; ".join(reasons))
+        self._healthy += 1
+        if self._probing and self._healthy >= self.base_recover_after:
+            # the step up held: later probes are back to the normal wait
+            self.recover_after = self.base_recover_after
+            self._probing = False
+        if self.level > 0 and self._healthy >= self.recover_after:
+            self._healthy = 0
+            self._probing = True
+            return self._step(self.level - 1, "uplink healthy")
+        return False
+
+    def _step(self, level: int, reason: str) -> bool:
+        self.level = level
+        return self._changed(reason)
+
+    def _changed(self, reason: str) -> bool:
+        self.changes += 1
+        # the pipeline still holds data from the old level; judge the new one on fresh counters
+        self._previous = None
+        settings = self.settings()
+        self.log(f"level {self.level}{' (idle)' if self.idle else ''} ({settings['bitrate'] // 1000} kbit/s, "
+                 f"scale {settings['scale']}, fps 1/{settings['fps_divisor']}): {reason}")
+        return True
@@ -0,0 +1,339 @@
+"""
+Headless load generator and benchmark for the MultiFlow server.
+
+Spins up synthetic cameras from ffmpeg's built-in test source (no video files
+needed), ramps their number against a server and measures each step from the
+server's /metrics and /latency endpoints. Results are written as JSON so runs
+can be compared across versions.
+
+By default a local server (`server/server.py`) is started on --port and
+stopped afterwards, and the recordings of the run are deleted; pass
+--server-url to load an already running server.
+
+Example:
+    python client/testing/benchmark.py --start 2 --step 2 --max-cameras 16 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+# share the upload layer with client.py one directory up
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from uploader import ChunkUploader, read_chunks, DEFAULT_BATCH_BYTES, DEFAULT_BATCH_INTERVAL, DEFAULT_MAX_IN_FLIGHT  # noqa: E402
+from latency import LatencyStamper  # noqa: E402
+
+REPO_ROOT = Path(__file__).resolve().parent.parent.parent
+SERVER_SCRIPT = REPO_ROOT / "server" / "server.py"
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)$')
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_metrics(text):
+    """Prometheus text format -> list of (name, labels dict, value)."""
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        match = _SAMPLE_RE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        samples.append((name, dict(_LABEL_RE.findall(labels or "")), value))
+    return samples
+
+
+def per_camera(samples, name, cameras):
+    """{camera: value} for one metric, limited to the benchmark's cameras."""
+    return {labels["camera"]: value for n, labels, value in samples
+            if n == name and labels.get("camera") in cameras}
+
+
+class SyntheticCamera:
+    """One ffmpeg testsrc2 encoder streaming into the shared uploader."""
+
+    def __init__(self, uploader, camera_id, width, height, fps, bitrate):
+        self.uploader = uploader
+        self.camera_id = camera_id
+        cmd = [
+            "ffmpeg", "-nostdin", "-loglevel", "error",
+            "-re",
+            "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}",
+            "-c:v", "libx264",
+            "-preset", "veryfast",
+            "-tune", "zerolatency",
+            "-b:v", bitrate, "-maxrate", bitrate, "-bufsize", bitrate,
+            "-pix_fmt", "yuv420p",
+            "-g", str(fps * 2),
+            "-f", "h264",
+            "-"
+        ]
+        self.ffmpeg = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.stop_event = threading.Event()
+        upload = uploader.open(camera_id, headers={"Camera-FPS": str(fps)})
+        self._reader = threading.Thread(
+            target=read_chunks,
+            args=(self.ffmpeg.stdout, upload, self.ffmpeg, self.stop_event),
+            kwargs={"stamper": LatencyStamper(clock_offset=uploader.clock_offset)},
+            daemon=True
+        )
+        self._reader.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.ffmpeg.terminate()
+        try:
+            self.ffmpeg.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.ffmpeg.kill()
+        self._reader.join(timeout=5)
+        return self.uploader.close(self.camera_id)
+
+
+class LocalServer:
+    """server/server.py in a subprocess, for benchmarking without a separate terminal.
+
+    The server indexes recordings in a throwaway catalog, and stop() deletes the
+    benchmark cameras' recordings (chunks/<camera_prefix>*), so a run leaves
+    nothing behind for retention or convert-all to treat as real recordings.
+    """
+
+    def __init__(self, port, camera_prefix, extra_args=(), log_path=None):
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.camera_prefix = camera_prefix
+        self.state_dir = tempfile.mkdtemp(prefix="multiflow-bench-")
+        self.log = open(log_path, "w") if log_path else subprocess.DEVNULL
+        self.proc = subprocess.Popen(
+            [sys.executable, str(SERVER_SCRIPT), "--port", str(port),
+             "--catalog", os.path.join(self.state_dir, "catalog.sqlite3"), *extra_args],
+            cwd=str(SERVER_SCRIPT.parent), stdin=subprocess.DEVNULL, stdout=self.log, stderr=subprocess.STDOUT
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"Server exited with code {self.proc.returncode}")
+            try:
+                requests.get(self.base_url + "/clock", timeout=1)
+                return
+            except requests.exceptions.RequestException:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("Server did not start within 30 s")
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        if self.log is not subprocess.DEVNULL:
+            self.log.close()
+        chunks = SERVER_SCRIPT.parent / "chunks"
+        # including <camera>-partN left by decoder restarts
+        for path in chunks.glob(self.camera_prefix + "*"):
+            shutil.rmtree(path, ignore_errors=True)
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+
+def snapshot(base_url, uploader):
+    return {
+        "time": time.monotonic(),
+        "metrics": parse_metrics(requests.get(base_url + "/metrics", timeout=5).text),
+        "latency": requests.get(base_url + "/latency", timeout=5).json(),
+        "client": uploader.stats(),
+    }
+
+
+def _delta(before, after, name, cameras):
+    b = per_camera(before["metrics"], name, cameras)
+    a = per_camera(after["metrics"], name, cameras)
+    return {cam: a.get(cam, 0.0) - b.get(cam, 0.0) for cam in cameras}
+
+
+def _summary(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {"min": round(min(values), 3), "median": round(statistics.median(values), 3), "max": round(max(values), 3)}
+
+
+def measure_step(before, after, cameras, args):
+    """Turn two snapshots into the step's result."""
+    elapsed = after["time"] - before["time"]
+    cameras = set(cameras)
+    ingest = _delta(before, after, "multiflow_ingest_bytes_total", cameras)
+    cpu = _delta(before, after, "multiflow_decoder_cpu_seconds", cameras)
+    server_dropped = _delta(before, after, "multiflow_ingest_dropped_bytes_total", cameras)
+    segment_sum = _delta(before, after, "multiflow_segment_interval_seconds_sum", cameras)
+    segment_count = _delta(before, after, "multiflow_segment_interval_seconds_count", cameras)
+    rss = per_camera(after["metrics"], "multiflow_decoder_resident_bytes", cameras)
+    speed = per_camera(after["metrics"], "multiflow_encoder_speed", cameras)
+    queue_bytes = per_camera(after["metrics"], "multiflow_ingest_queue_bytes", cameras)
+
+    rejected = 0.0
+    for phase, sign in ((before, -1), (after, 1)):
+        for name, labels, value in phase["metrics"]:
+            if name == "multiflow_upload_requests_total" and labels.get("camera") in cameras \
+                    and labels.get("status") != "200":
+                rejected += sign * value
+
+    def client_delta(key):
+        return sum(after["client"].get(cam, {}).get(key, 0) - before["client"].get(cam, {}).get(key, 0)
+                   for cam in cameras)
+
+    segment_intervals = [segment_sum[c] / segment_count[c] for c in cameras if segment_count[c] > 0]
+    segment_lag, glass_to_segment = [], []
+    for cam in cameras:
+        summary = after["latency"].get(cam) or {}
+        stage = (summary.get("stages") or {}).get("segment")
+        if stage:
+            segment_lag.append(stage["median"])
+        if summary.get("glass_to_segment"):
+            glass_to_segment.append(summary["glass_to_segment"]["median"])
+
+    behind = []
+    if len(speed) < len(cameras):
+        behind.append(f"{len(cameras) - len(speed)} cameras report no encoder speed")
+    if speed and min(speed.values()) < args.min_speed:
+        behind.append(f"encoder speed {min(speed.values()):.2f}x < {args.min_speed}x")
+    if queue_bytes and max(queue_bytes.values()) > args.max_queue_kb * 1024:
+        behind.append(f"ingest queue {max(queue_bytes.values()) / 1024:.0f} KB > {args.max_queue_kb} KB")
+    dropped_batches = client_delta("dropped_batches")
+    if dropped_batches or sum(server_dropped.values()) or rejected:
+        behind.append("uploads dropped or rejected")
+
+    return {
+        "cameras": len(cameras),
+        "seconds": round(elapsed, 1),
+        "ingest_bytes_per_s": round(sum(ingest.values()) / elapsed),
+        "ingest_mbit_per_s": round(sum(ingest.values()) * 8 / elapsed / 1e6, 3),
+        "offered_bytes_per_s": round((client_delta("sent_bytes") + client_delta("unconfirmed_bytes")) / elapsed),
+        "dropped": {
+            "client_batches": dropped_batches,
+            "client_bytes": client_delta("dropped_bytes"),
+            "server_bytes": int(sum(server_dropped.values())),
+            "rejected_uploads": int(rejected),
+        },
+        "server_per_camera": {
+            "cpu_percent": _summary([100 * cpu[c] / elapsed for c in cameras if c in rss]),
+            "rss_mb": _summary([v / 2 ** 20 for v in rss.values()]),
+            "encoder_speed": _summary(speed.values()),
+        },
+        "segment_interval_s": _summary(segment_intervals),
+        "segment_lag_s": _summary(segment_lag),
+        "glass_to_segment_s": _summary(glass_to_segment),
+        "realtime": not behind,
+        "behind_reasons": behind,
+    }
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=str(REPO_ROOT),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+    server = None
+    if args.server_url:
+        base_url = args.server_url.rstrip("/")
+        if base_url.endswith("/upload"):
+            base_url = base_url[:-len("/upload")]
+    else:
+        server = LocalServer(args.port, f"bench-{run_id}-", args.server_args.split(), args.server_log)
+        base_url = server.base_url
+    uploader = ChunkUploader(base_url + "/upload", batch_bytes=args.batch_bytes,
+                             batch_interval=args.batch_ms / 1000, max_in_flight=args.in_flight,
+                             streaming=args.stream)
+    cameras = []
+    steps = []
+    result = {
+        "version": git_version(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "server_log")},
+        "steps": steps,
+    }
+    try:
+        count = args.start
+        while count <= args.max_cameras:
+            while len(cameras) < count:
+                camera_id = f"bench-{run_id}-{len(cameras)}"
+                cameras.append(SyntheticCamera(uploader, camera_id, args.width, args.height, args.fps, args.bitrate))
+            print(f"[Benchmark] {count} cameras: settling {args.settle:g} s, measuring {args.step_seconds:g} s")
+            time.sleep(args.settle)
+            before = snapshot(base_url, uploader)
+            time.sleep(args.step_seconds)
+            after = snapshot(base_url, uploader)
+            step = measure_step(before, after, [c.camera_id for c in cameras], args)
+            steps.append(step)
+            state = "realtime" if step["realtime"] else "behind: " + "; ".join(step["behind_reasons"])
+            print(f"[Benchmark] {count} cameras: {step['ingest_mbit_per_s']} Mbit/s ingested, {state}")
+            if not step["realtime"] and not args.keep_going:
+                break
+            count += args.step
+    finally:
+        for camera in cameras:
+            camera.stop()
+        if server:
+            server.stop()
+    realtime = [s["cameras"] for s in steps if s["realtime"]]
+    result["max_realtime_cameras"] = max(realtime) if realtime else 0
+    result["finished"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MultiFlow headless load generator and benchmark')
+    parser.add_argument('--server-url', help='Benchmark a running server (e.g. http://127.0.0.1:5000); default starts a local one')
+    parser.add_argument('--port', type=int, default=5099, help='Port for the local server')
+    parser.add_argument('--server-args', default='', help='Extra arguments for the local server, e.g. "--packaging copy"')
+    parser.add_argument('--server-log', help='Write the local server output to this file')
+    parser.add_argument('--width', type=int, default=1280, help='Synthetic camera width')
+    parser.add_argument('--height', type=int, default=720, help='Synthetic camera height')
+    parser.add_argument('--fps', type=int, default=30, help='Synthetic camera frame rate')
+    parser.add_argument('--bitrate', default='2M', help='Synthetic camera bitrate (ffmpeg syntax)')
+    parser.add_argument('--start', type=int, default=1, help='Cameras in the first step')
+    parser.add_argument('--step', type=int, default=1, help='Cameras added per step')
+    parser.add_argument('--max-cameras', type=int, default=16, help='Stop ramping after this many cameras')
+    parser.add_argument('--settle', type=float, default=10, help='Seconds to wait after adding cameras before measuring')
+    parser.add_argument('--step-seconds', type=float, default=20, help='Seconds measured per step')
+    parser.add_argument('--min-speed', type=float, default=0.95, help='Server encoder speed (x realtime) below which a step is behind')
+    parser.add_argument('--max-queue-kb', type=float, default=1024, help='Ingest queue depth above which a step is behind')
+    parser.add_argument('--keep-going', action='store_true', help='Keep ramping after a step falls behind')
+    parser.add_argument('--batch-bytes', type=int, default=DEFAULT_BATCH_BYTES, help='Upload once this many bytes are buffered')
+    parser.add_argument('--batch-ms', type=float, default=DEFAULT_BATCH_INTERVAL * 1000, help='Upload buffered bytes at least this often')
+    parser.add_argument('--in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT, help='Max batches queued per camera before dropping the oldest')
+    parser.add_argument('--stream', action='store_true', help='Send each camera over one long-lived chunked POST to /ingest')
+    parser.add_argument('--output', help='JSON results file (default: benchmark-<time>.json)')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    output = args.output or f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"[Benchmark] max realtime cameras: {result['max_realtime_cameras']}; results in {output}")
+
+
+if __name__ == '__main__':
+    main()
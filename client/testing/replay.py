@@ -0,0 +1,256 @@
+"""
+Pre-encoded looping camera sources for the test client.
+
+Encoding every test file live with ffmpeg costs the load generator more CPU
+than the server spends receiving it. In replay mode each file is encoded to an
+H.264 elementary stream once and cached under a name derived from the file's
+content hash and the encoder settings. The cached stream is memory-mapped,
+split into frames by scanning for the first slice of each picture, and written
+to the uploader by a single pacing thread at the stream's frame rate, looping
+back to the first (IDR) frame at the end.
+
+A replayed camera costs one memoryview slice per frame, so one machine can
+simulate hundreds of cameras.
+"""
+import bisect
+import hashlib
+import mmap
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from latency import DEFAULT_STAMP_INTERVAL, latency_sei  # noqa: E402
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent / "cache"
+# The pacing thread sleeps at most this long between passes
+MAX_TICK = 0.01
+# Frames a camera may fall behind before it skips ahead instead of bursting
+MAX_BACKLOG_SECONDS = 2.0
+# Bump when the encoder command changes so old cache entries are not reused
+CACHE_VERSION = 1
+
+_START_CODE = b"\x00\x00\x01"
+_VCL_TYPES = (1, 5)
+_IDR_TYPE = 5
+# SEI, SPS, PPS, AUD: belong to the access unit of the slice that follows them
+_PREFIX_TYPES = (6, 7, 8, 9)
+
+
+def encoder_args(fps: int):
+    """ffmpeg output options; the same encoding testclient.py uses live."""
+    return [
+        "-r", str(fps),
+        "-an",
+        "-c:v", "libx264",
+        "-preset", "veryfast",
+        "-tune", "zerolatency",
+        "-pix_fmt", "yuv420p",
+        "-g", str(fps * 2),
+        "-f", "h264",
+    ]
+
+
+def cache_key(path, fps: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(repr((CACHE_VERSION, encoder_args(fps))).encode())
+    return digest.hexdigest()[:20]
+
+
+def encode_cached(path, fps: int, cache_dir=DEFAULT_CACHE_DIR) -> Path:
+    """Path of the cached elementary stream for path, encoding it first if needed."""
+    path = Path(path)
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    target = cache_dir / f"{path.stem}-{cache_key(path, fps)}.h264"
+    if target.exists():
+        return target
+    tmp = target.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    print(f"[Replay] Encoding {path.name} -> {target.name}")
+    cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", str(path), *encoder_args(fps), str(tmp)]
+    try:
+        subprocess.run(cmd, check=True)
+        os.replace(tmp, target)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return target
+
+
+def frame_offsets(data, keyframes=None) -> list:
+    """Byte offsets of each access unit in an Annex-B stream, plus len(data) at the end.
+    An access unit starts at the first SEI/SPS/PPS/AUD before a picture's first slice.
+    If keyframes is a list, the index of every IDR frame is appended to it."""
+    offsets = []
+    prefix = None
+    pos = data.find(_START_CODE)
+    while pos != -1 and pos + 4 < len(data):
+        start = pos - 1 if pos > 0 and data[pos - 1] == 0 else pos
+        nal_type = data[pos + 3] & 0x1F
+        if nal_type in _PREFIX_TYPES:
+            if prefix is None:
+                prefix = start
+        elif nal_type in _VCL_TYPES:
+            # first_mb_in_slice == 0 is ue(v) "1": the slice header's first bit is set
+            if data[pos + 4] & 0x80:
+                if keyframes is not None and nal_type == _IDR_TYPE:
+                    keyframes.append(len(offsets))
+                offsets.append(prefix if prefix is not None else start)
+            prefix = None
+        pos = data.find(_START_CODE, pos + 3)
+    offsets.append(len(data))
+    return offsets
+
+
+class ReplaySource:
+    """A cached elementary stream mapped into memory and indexed by frame."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+        self.keyframes = []
+        self.offsets = frame_offsets(self.data, self.keyframes)
+        if len(self.offsets) < 2 or self.offsets[0] != 0 or self.keyframes[:1] != [0]:
+            raise ValueError(f"{self.path} does not start with a decodable frame")
+        self.frames = len(self.offsets) - 1
+
+    def next_keyframe(self, first: int) -> int:
+        """The first frame at or after frame index `first` (counting across loops) that is an IDR frame."""
+        loop, index = divmod(first, self.frames)
+        at = bisect.bisect_left(self.keyframes, index)
+        if at == len(self.keyframes):
+            return (loop + 1) * self.frames
+        return loop * self.frames + self.keyframes[at]
+
+    def slices(self, first: int, count: int):
+        """memoryviews covering `count` frames from frame index `first`, wrapping at the end."""
+        out = []
+        while count > 0:
+            index = first % self.frames
+            n = min(count, self.frames - index)
+            out.append(self.view[self.offsets[index]:self.offsets[index + n]])
+            first += n
+            count -= n
+        return out
+
+
+_sources = {}
+_sources_lock = threading.Lock()
+_encode_locks = {}
+
+
+def load_source(path, fps: int, cache_dir=DEFAULT_CACHE_DIR) -> ReplaySource:
+    """Shared ReplaySource for a test file; cameras replaying the same file share one mapping."""
+    key = (str(Path(path).resolve()), fps, str(cache_dir))
+    with _sources_lock:
+        source = _sources.get(key)
+        if source is not None:
+            return source
+        lock = _encode_locks.setdefault(key, threading.Lock())
+    # encode outside the global lock so different files encode in parallel
+    with lock:
+        with _sources_lock:
+            source = _sources.get(key)
+        if source is None:
+            source = ReplaySource(encode_cached(path, fps, cache_dir))
+            with _sources_lock:
+                _sources[key] = source
+    return source
+
+
+class ReplayCamera:
+    def __init__(self, source, upload, fps, clock_offset, stamp_interval):
+        self.source = source
+        self.upload = upload
+        self.fps = fps
+        self.clock_offset = clock_offset
+        self.stamp_interval = stamp_interval
+        self.started = time.monotonic()
+        self.started_wall = time.time()
+        self.sent = 0
+        self.skipped = 0
+        self._last_stamp = 0.0
+
+    def due(self, now):
+        return int((now - self.started) * self.fps) + 1
+
+    def pump(self, now):
+        due = self.due(now)
+        if due <= self.sent:
+            return
+        backlog = int(MAX_BACKLOG_SECONDS * self.fps)
+        if due - self.sent > backlog:
+            # the pacer stalled: skip like a live camera would, keeping the phase, and resume
+            # at a keyframe (waiting for it if need be) so the stream stays decodable
+            resume = self.source.next_keyframe(due - 1)
+            self.skipped += resume - self.sent
+            self.sent = resume
+            if due <= self.sent:
+                return
+        wall = time.time()
+        if self.stamp_interval is not None and wall - self._last_stamp >= self.stamp_interval:
+            # the frame's capture time is when the pacer scheduled it
+            captured = self.started_wall + self.sent / self.fps
+            self.upload.write(latency_sei(captured, captured, wall, self.clock_offset()))
+            self._last_stamp = wall
+        for view in self.source.slices(self.sent, due - self.sent):
+            self.upload.write(view)
+        self.sent = due
+
+
+class Replayer:
+    """One thread that paces every replayed camera."""
+
+    def __init__(self):
+        self._cameras = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, source, upload, fps, clock_offset=lambda: 0.0, stamp_interval=DEFAULT_STAMP_INTERVAL):
+        """Start replaying source into upload; returns a handle for remove()."""
+        camera = ReplayCamera(source, upload, fps, clock_offset, stamp_interval)
+        with self._lock:
+            self._cameras.append(camera)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return camera
+
+    def remove(self, camera):
+        with self._lock:
+            if camera in self._cameras:
+                self._cameras.remove(camera)
+
+    def count(self):
+        with self._lock:
+            return len(self._cameras)
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                cameras = list(self._cameras)
+            if not cameras:
+                self._wake.wait(1)
+                self._wake.clear()
+                continue
+            now = time.monotonic()
+            next_due = now + MAX_TICK
+            for camera in cameras:
+                try:
+                    camera.pump(now)
+                except Exception as e:
+                    print(f"[Replay] {camera.upload.camera_id}: {e}")
+                    self.remove(camera)
+                    continue
+                next_due = min(next_due, camera.started + camera.due(now) / camera.fps)
+            time.sleep(max(0.0, next_due - time.monotonic()))
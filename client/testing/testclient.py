@@ -9,18 +9,46 @@ Commands (single-char or with name):
  q               - quit (stop everything)
 
 Place mp4 files in `client/testing/tests/<testname>/` directories.
+
+With --replay each file is encoded once, cached, and replayed in Python (see
+replay.py) instead of being re-encoded live by one ffmpeg per camera; combine
+with --replicas to run many cameras per file.
 """
 import socket
-import requests
 import subprocess
+import sys
 import threading
 import time
 import argparse
 from pathlib import Path
 import urllib.parse
 
+# share the upload layer with client.py one directory up
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from uploader import ChunkUploader, read_chunks, DEFAULT_BATCH_BYTES, DEFAULT_BATCH_INTERVAL, DEFAULT_MAX_IN_FLIGHT  # noqa: E402
+from latency import LatencyStamper  # noqa: E402
+import replay  # noqa: E402
+
 DEFAULT_SERVER_URL = "http://127.0.0.1:5000/upload"
 SERVER_URL = DEFAULT_SERVER_URL
+# Test files are re-timed to this rate so the server knows it without probing
+TEST_FPS = 30
+UPLOADER = None
+# Extra per-camera upload headers (e.g. ABR-Ladder) set from the command line
+CAMERA_HEADERS = {}
+# Replay pre-encoded files instead of running ffmpeg per camera (--replay)
+REPLAY = False
+REPLAY_CACHE_DIR = replay.DEFAULT_CACHE_DIR
+REPLAYER = replay.Replayer()
+# Cameras started per test file (--replicas)
+REPLICAS = 1
+
+
+def get_uploader() -> ChunkUploader:
+    global UPLOADER
+    if UPLOADER is None:
+        UPLOADER = ChunkUploader(SERVER_URL)
+    return UPLOADER
 
 
 def build_server_url(host: str, port: int) -> str:
@@ -28,25 +56,10 @@ def build_server_url(host: str, port: int) -> str:
     return urllib.parse.urljoin(base, "/upload")
 
 def _reader_loop(ffmpeg, cam_unique_id, stop_event):
-    while not stop_event.is_set():
-        data = ffmpeg.stdout.read(4096)
-        if not data:
-            if ffmpeg.poll() is not None:
-                break
-            time.sleep(0.01)
-            continue
-        try:
-            requests.post(
-                SERVER_URL,
-                data=data,
-                headers={
-                    "Content-Type": "application/octet-stream",
-                    "Camera-ID": str(cam_unique_id)
-                },
-                timeout=1
-            )
-        except requests.exceptions.RequestException:
-            pass
+    uploader = get_uploader()
+    upload = uploader.open(cam_unique_id, headers={**CAMERA_HEADERS, "Camera-FPS": str(TEST_FPS)})
+    # file sources have no capture clock: frames count as captured when they leave the encoder
+    read_chunks(ffmpeg.stdout, upload, ffmpeg, stop_event, stamper=LatencyStamper(clock_offset=uploader.clock_offset))
 
 
 class CameraController:
@@ -75,15 +88,21 @@ class CameraController:
             self._thread = None
 
     def _run(self):
+        if REPLAY:
+            self._run_replay()
+            return
         print(self.source)
         ffmpeg_cmd = [
             "ffmpeg",
             "-re",
             "-nostdin",
             "-i", f"{self.source}",
+            "-r", str(TEST_FPS),
             "-c:v", "libx264",
             "-preset", "veryfast",
             "-tune", "zerolatency",
+            "-pix_fmt", "yuv420p",
+            "-g", str(TEST_FPS * 2),
             "-f", "h264",
             "-"
         ]
@@ -107,10 +126,26 @@ class CameraController:
         except Exception:
             pass
         if self.unique_id_timestamped:
-            try:
-                requests.delete(SERVER_URL, headers={"Camera-ID": str(self.unique_id_timestamped)}, timeout=1)
-            except requests.exceptions.RequestException:
-                pass
+            stats = get_uploader().close(self.unique_id_timestamped)
+            if stats:
+                print(f"Camera {self.unique_id_timestamped} upload stats: {stats}")
+
+
+    def _run_replay(self):
+        try:
+            source = replay.load_source(self.source, TEST_FPS, REPLAY_CACHE_DIR)
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            print(f"Camera {self.unique_id_timestamped}: cannot prepare {self.source}: {e}")
+            return
+        uploader = get_uploader()
+        upload = uploader.open(self.unique_id_timestamped, headers={**CAMERA_HEADERS, "Camera-FPS": str(TEST_FPS)})
+        handle = REPLAYER.add(source, upload, TEST_FPS, clock_offset=uploader.clock_offset)
+        print(f"Started camera {self.unique_id_timestamped} (replaying {source.path.name}, {source.frames} frames)")
+        self.stop_event.wait()
+        REPLAYER.remove(handle)
+        stats = uploader.close(self.unique_id_timestamped)
+        if stats:
+            print(f"Camera {self.unique_id_timestamped} upload stats: {stats}, skipped frames: {handle.skipped}")
 
 
 def detect_tests(tests_dir: Path):
@@ -139,6 +174,8 @@ def interactive_menu(server_url: str = DEFAULT_SERVER_URL):
         print('\nAvailable test sets:')
         for name, files in sets.items():
             print(f" - {name}: {len(files)} file(s)")
+        for uid, stats in get_uploader().stats().items():
+            print(f"   {uid}: sent {stats['sent_bytes']} B, retried {stats['retried_bytes']} B, dropped {stats['dropped_bytes']} B")
         print('\nCommands:')
         print(' l <opt> - list test sets or list <setname> to see files')
         print(' s <set> - start all cameras in <set>')
@@ -184,8 +221,9 @@ def interactive_menu(server_url: str = DEFAULT_SERVER_URL):
 
             ctrls = {}
             for i, fp in enumerate(sets[arg]):
-                uid = make_unique_id(hostname, arg, i)
-                ctrls[uid] = CameraController(str(fp), uid)
+                for r in range(REPLICAS):
+                    uid = make_unique_id(hostname, arg, i * REPLICAS + r)
+                    ctrls[uid] = CameraController(str(fp), uid)
             controllers_by_set[arg] = ctrls
             for ctrl in ctrls.values():
                 ctrl.start()
@@ -215,6 +253,14 @@ def main(argv=None):
     group.add_argument('--server-url', help='Full server upload URL (overrides --host/--port)')
     parser.add_argument('--host', help='Server host to connect to (used with --port)', default='127.0.0.1')
     parser.add_argument('--port', type=int, help='Server port to connect to (used with --host)', default=5000)
+    parser.add_argument('--batch-bytes', type=int, default=DEFAULT_BATCH_BYTES, help='Upload once this many bytes are buffered')
+    parser.add_argument('--batch-ms', type=float, default=DEFAULT_BATCH_INTERVAL * 1000, help='Upload buffered bytes at least this often')
+    parser.add_argument('--in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT, help='Max batches queued per camera before dropping the oldest')
+    parser.add_argument('--stream', action='store_true', help='Send each camera over one long-lived chunked POST to /ingest')
+    parser.add_argument('--abr', choices=('on', 'off'), help="Ask the server to encode (or skip) its bitrate ladder for these cameras")
+    parser.add_argument('--replay', action='store_true', help='Encode each file once and replay the cached stream instead of encoding live')
+    parser.add_argument('--cache-dir', default=str(replay.DEFAULT_CACHE_DIR), help='Where --replay keeps encoded streams')
+    parser.add_argument('--replicas', type=int, default=1, help='Cameras to start per test file')
     args = parser.parse_args(argv)
 
     if args.server_url:
@@ -222,8 +268,20 @@ def main(argv=None):
     else:
         server_url = build_server_url(args.host, args.port)
 
-    global SERVER_URL
+    global SERVER_URL, UPLOADER, REPLAY, REPLAY_CACHE_DIR, REPLICAS
     SERVER_URL = server_url
+    REPLAY = args.replay
+    REPLAY_CACHE_DIR = args.cache_dir
+    REPLICAS = max(1, args.replicas)
+    if args.abr:
+        CAMERA_HEADERS["ABR-Ladder"] = args.abr
+    UPLOADER = ChunkUploader(
+        server_url,
+        batch_bytes=args.batch_bytes,
+        batch_interval=args.batch_ms / 1000,
+        max_in_flight=args.in_flight,
+        streaming=args.stream
+    )
 
     interactive_menu(server_url=server_url)
 
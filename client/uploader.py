@@ -0,0 +1,382 @@
+"""
+Shared upload layer used by `client.py` and `testing/testclient.py`.
+
+All cameras share one keep-alive `requests.Session`. Each camera gets its own
+`CameraUpload`, which coalesces small stdout reads into larger batches and
+sends them in order from a per-camera sender thread.
+
+A batch is cut when it reaches `batch_bytes` or when its oldest byte has waited
+`batch_interval` seconds, whichever comes first. A camera's batches are sent
+one request at a time: the server copies each upload straight into the
+camera's ffmpeg and does not reorder them, so overlapping requests could
+deliver bytes out of order. `max_in_flight` therefore bounds the batches
+waiting behind the one being sent, not concurrent requests. When that queue is
+full the oldest batch is dropped, so a stalled server never grows client
+memory without bound. Cameras upload concurrently with each other over the
+shared connection pool.
+
+With `streaming=True` each camera instead keeps one chunked-transfer POST open
+to the server's `/ingest` route and writes batches into its body, reconnecting
+if the connection breaks or the server refuses it (after Retry-After, or a
+growing delay). Batches written into a channel count as sent only once the
+server answers it with 200.
+"""
+import datetime
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_READ_SIZE = 64 * 1024
+DEFAULT_BATCH_BYTES = 64 * 1024
+DEFAULT_BATCH_INTERVAL = 0.05
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_RETRIES = 2
+DEFAULT_TIMEOUT = 1
+MAX_RETRY_AFTER = 2.0
+# How often the estimate of the server's clock is refreshed
+CLOCK_SYNC_INTERVAL = 60
+
+
+def _retry_after(resp, default: float) -> float:
+    try:
+        return min(float(resp.headers.get("Retry-After", default)), MAX_RETRY_AFTER)
+    except ValueError:
+        return default
+
+
+class CameraUpload:
+    """Ordered, batched upload pipeline for a single camera."""
+
+    def __init__(self, uploader, camera_id: str, headers=None):
+        self.uploader = uploader
+        self.camera_id = str(camera_id)
+        self.headers = {
+            "Content-Type": "application/octet-stream",
+            **(headers or {}),
+            "Camera-ID": self.camera_id
+        }
+        self.stats = {
+            "sent_bytes": 0,
+            "sent_batches": 0,
+            "retried_bytes": 0,
+            "dropped_bytes": 0,
+            "dropped_batches": 0,
+            # uploads the server refused with 429/503 (backpressure)
+            "rejected_batches": 0,
+            # time spent in successful uploads, for the average upload latency
+            "send_seconds": 0.0,
+            # written into an open /ingest channel whose response has not arrived yet
+            "unconfirmed_bytes": 0,
+        }
+        # the server's Camera-Activity hint ("idle"/"active") from the last upload, if it analyses motion
+        self.activity = None
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self._buffer_started = None
+        self._batches = queue.Queue(maxsize=uploader.max_in_flight)
+        self._closed = False
+        self._thread = threading.Thread(target=self._sender_loop, daemon=True)
+        self._thread.start()
+
+    def write(self, data: bytes):
+        """Append encoded bytes; cuts a batch once it is large enough."""
+        if not data:
+            return
+        with self._lock:
+            if self._closed:
+                return
+            if not self._buffer:
+                self._buffer_started = time.monotonic()
+            self._buffer += data
+            if len(self._buffer) >= self.uploader.batch_bytes:
+                self._cut_locked()
+
+    def close(self):
+        """Flush what is buffered, wait for the sender and stop accepting data."""
+        with self._lock:
+            if self._closed:
+                return
+            self._cut_locked()
+            self._closed = True
+        # The sentinel may need to wait for room; the sender keeps draining.
+        self._batches.put(None)
+        self._thread.join()
+
+    def snapshot(self) -> dict:
+        """Counters plus the number of batches waiting to be sent and the server's activity hint."""
+        with self._lock:
+            return {**self.stats, "queued_batches": self._batches.qsize(), "activity": self.activity}
+
+    def _cut_locked(self):
+        if not self._buffer:
+            return
+        batch = bytes(self._buffer)
+        self._buffer.clear()
+        self._buffer_started = None
+        while True:
+            try:
+                self._batches.put_nowait(batch)
+                return
+            except queue.Full:
+                try:
+                    oldest = self._batches.get_nowait()
+                except queue.Empty:
+                    continue
+                if oldest is None:
+                    # never drop the close sentinel
+                    self._batches.put_nowait(None)
+                    return
+                self._count("dropped_bytes", len(oldest))
+                self._count("dropped_batches", 1)
+
+    def _flush_if_stale(self):
+        with self._lock:
+            if self._buffer_started is None:
+                return
+            if time.monotonic() - self._buffer_started >= self.uploader.batch_interval:
+                self._cut_locked()
+
+    def _count(self, key, amount):
+        self.stats[key] += amount
+
+    def _sender_loop(self):
+        while True:
+            try:
+                batch = self._batches.get(timeout=self.uploader.batch_interval)
+            except queue.Empty:
+                self._flush_if_stale()
+                continue
+            if batch is None:
+                break
+            self._send(batch)
+            self._flush_if_stale()
+
+    def _send(self, batch: bytes):
+        for attempt in range(self.uploader.retries + 1):
+            delay = 0.05 * (attempt + 1)
+            started = time.monotonic()
+            try:
+                resp = self.uploader.session.post(
+                    self.uploader.server_url,
+                    data=batch,
+                    headers=self.headers,
+                    timeout=self.uploader.timeout
+                )
+                if resp.status_code in (429, 503):
+                    # server-side backpressure: wait as long as it asks (within reason)
+                    delay = _retry_after(resp, delay)
+                    with self._lock:
+                        self._count("rejected_batches", 1)
+                elif 200 <= resp.status_code < 300:
+                    with self._lock:
+                        self._count("sent_bytes", len(batch))
+                        self._count("sent_batches", 1)
+                        self._count("send_seconds", time.monotonic() - started)
+                        self.activity = resp.headers.get("Camera-Activity", self.activity)
+                    return
+                elif resp.status_code < 500:
+                    # refused for good (e.g. 409 streaming over /ingest, 410 closed): retrying cannot help
+                    break
+            except requests.exceptions.RequestException:
+                pass
+            if attempt < self.uploader.retries:
+                with self._lock:
+                    self._count("retried_bytes", len(batch))
+                time.sleep(delay)
+        with self._lock:
+            self._count("dropped_bytes", len(batch))
+            self._count("dropped_batches", 1)
+
+
+class StreamingCameraUpload(CameraUpload):
+    """Camera pipeline that writes batches into one long-lived POST to /ingest."""
+
+    def _sender_loop(self):
+        self._finished = False
+        failures = 0
+        while not self._finished:
+            # batches written into this connection; they only count as sent once the server answers 200
+            self._unconfirmed = [0, 0, 0.0]
+            # back off while the server keeps refusing or dropping the channel
+            delay = min(0.5 * 2 ** failures, MAX_RETRY_AFTER)
+            try:
+                resp = self.uploader.session.post(
+                    self.uploader.ingest_url,
+                    data=self._body(),
+                    headers=self.headers,
+                    # no read timeout: the response only arrives once the body ends
+                    timeout=(self.uploader.timeout, None)
+                )
+            except requests.exceptions.RequestException:
+                resp = None
+            confirmed = resp is not None and resp.status_code == 200
+            self._settle(confirmed)
+            failures = 0 if confirmed else failures + 1
+            if resp is not None and resp.status_code in (429, 503):
+                # server at capacity: reconnect no sooner than it asks
+                delay = _retry_after(resp, 1.0)
+                with self._lock:
+                    self._count("rejected_batches", 1)
+            # on 409 (another channel still open) or 410 (closed by the server) the camera
+            # is reopened after the delay, like after a broken connection
+            if not self._finished:
+                time.sleep(delay)
+
+    def _settle(self, confirmed):
+        batch_bytes, batches, seconds = self._unconfirmed
+        with self._lock:
+            if confirmed:
+                self._count("sent_bytes", batch_bytes)
+                self._count("sent_batches", batches)
+                self._count("send_seconds", seconds)
+            else:
+                self._count("dropped_bytes", batch_bytes)
+                self._count("dropped_batches", batches)
+            self._count("unconfirmed_bytes", -batch_bytes)
+
+    def _body(self):
+        # a fresh generator per connection; requests sends each yield as one chunk
+        while True:
+            try:
+                batch = self._batches.get(timeout=self.uploader.batch_interval)
+            except queue.Empty:
+                self._flush_if_stale()
+                continue
+            if batch is None:
+                self._finished = True
+                return
+            # requests resumes the generator once the previous chunk is written to the socket
+            started = time.monotonic()
+            yield batch
+            self._unconfirmed[0] += len(batch)
+            self._unconfirmed[1] += 1
+            self._unconfirmed[2] += time.monotonic() - started
+            with self._lock:
+                self._count("unconfirmed_bytes", len(batch))
+
+
+class ChunkUploader:
+    """Connection-pooled uploader shared by every camera in the process."""
+
+    def __init__(self, server_url: str, batch_bytes: int = DEFAULT_BATCH_BYTES,
+                 batch_interval: float = DEFAULT_BATCH_INTERVAL,
+                 max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 retries: int = DEFAULT_RETRIES, timeout: float = DEFAULT_TIMEOUT,
+                 pool_size: int = 64, streaming: bool = False):
+        self.server_url = server_url
+        self.ingest_url = ingest_url_for(server_url)
+        self.streaming = streaming
+        self.batch_bytes = batch_bytes
+        self.batch_interval = batch_interval
+        self.max_in_flight = max(1, max_in_flight)
+        self.retries = retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._cameras = {}
+        self._lock = threading.Lock()
+        self._clock_offset = 0.0
+        self._clock_synced = None
+        self._clock_syncing = False
+
+    def clock_offset(self) -> float:
+        """Seconds to add to time.time() to get the server's clock.
+        Returns the cached estimate and refreshes it in the background when stale."""
+        with self._lock:
+            stale = self._clock_synced is None or time.monotonic() - self._clock_synced > CLOCK_SYNC_INTERVAL
+            if stale and not self._clock_syncing:
+                self._clock_syncing = True
+                threading.Thread(target=self._sync_clock, daemon=True).start()
+            return self._clock_offset
+
+    def _sync_clock(self, samples: int = 5):
+        # NTP-style: keep the sample with the shortest round trip
+        best = None
+        for _ in range(samples):
+            try:
+                sent = time.time()
+                resp = self.session.get(clock_url_for(self.server_url), timeout=self.timeout)
+                received = time.time()
+                server = datetime.datetime.fromisoformat(resp.text.strip().replace("Z", "+00:00")).timestamp()
+            except (requests.exceptions.RequestException, ValueError):
+                continue
+            rtt = received - sent
+            if best is None or rtt < best[0]:
+                best = (rtt, server - (sent + received) / 2)
+        with self._lock:
+            if best is not None:
+                self._clock_offset = best[1]
+            self._clock_synced = time.monotonic()
+            self._clock_syncing = False
+
+    def open(self, camera_id: str, headers=None) -> CameraUpload:
+        """Return the upload pipeline for a camera, creating it if needed.
+        headers (e.g. Camera-FPS, Packaging) are sent with every upload for that camera.
+        """
+        camera_id = str(camera_id)
+        with self._lock:
+            upload = self._cameras.get(camera_id)
+            if upload is None:
+                cls = StreamingCameraUpload if self.streaming else CameraUpload
+                upload = cls(self, camera_id, headers)
+                self._cameras[camera_id] = upload
+            return upload
+
+    def close(self, camera_id: str, notify_server: bool = True):
+        """Flush and stop a camera's pipeline, then tell the server it ended."""
+        camera_id = str(camera_id)
+        with self._lock:
+            upload = self._cameras.pop(camera_id, None)
+        if upload is not None:
+            upload.close()
+        if notify_server:
+            try:
+                self.session.delete(self.server_url, headers={"Camera-ID": camera_id}, timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                pass
+        return upload.stats if upload is not None else None
+
+    def stats(self) -> dict:
+        """Snapshot of per-camera counters."""
+        with self._lock:
+            uploads = list(self._cameras.values())
+        return {u.camera_id: u.snapshot() for u in uploads}
+
+
+def _server_base(server_url: str) -> str:
+    base = server_url.rstrip("/")
+    if base.endswith("/upload"):
+        base = base[:-len("/upload")]
+    return base
+
+
+def ingest_url_for(server_url: str) -> str:
+    """Derive the /ingest URL from an /upload URL."""
+    return _server_base(server_url) + "/ingest"
+
+
+def clock_url_for(server_url: str) -> str:
+    """Derive the /clock URL from an /upload URL."""
+    return _server_base(server_url) + "/clock"
+
+
+def read_chunks(stream, upload: CameraUpload, ffmpeg, stop_event=None, read_size: int = DEFAULT_READ_SIZE,
+                stamper=None):
+    """Pump an ffmpeg stdout pipe into an upload pipeline until EOF or stop.
+    stamper (see latency.py) may rewrite each chunk, e.g. to embed capture timestamps."""
+    while stop_event is None or not stop_event.is_set():
+        # read1 returns whatever is available instead of waiting for a full buffer
+        data = stream.read1(read_size)
+        if not data:
+            if ffmpeg.poll() is not None:
+                break
+            time.sleep(0.01)
+            continue
+        if stamper is not None:
+            data = stamper(data)
+        upload.write(data)
@@ -3,46 +3,85 @@ import './styles.css'
 import SingleVideo from './components/SingleVideo'
 import AllVideos from './components/AllVideos'
 import ConvertPanel from './components/ConvertPanel'
+import DashVideo from './components/DashVideo'
 
 function App() {
   const [videoMode, setVideoMode] = useState(0);
   const [cameras, setCameras] = useState([]);
   const [pastCameras, setPastCameras] = useState([]);
+  const [lowLatencyCameras, setLowLatencyCameras] = useState([]);
+  const [mosaicUrl, setMosaicUrl] = useState(null);
   const [convertedFiles, setConvertedFiles] = useState([])
   const [converting, setConverting] = useState([])
+  const [progress, setProgress] = useState({})
+  const applyInfo = (data) => {
+    setCameras(data.cameras);
+    setPastCameras(data.past_recordings);
+    setLowLatencyCameras(data.low_latency_cameras || []);
+    setMosaicUrl(data.mosaic || null);
+    setConvertedFiles(data.converted_files)
+    setConverting(data.conversions_in_progress)
+    setProgress(Object.fromEntries((data.conversion_queue || []).map(job => [job.camera_id, { ...job, status: job.state }])))
+  }
   const getInfo = () => {
     fetch('/info')
       .then(res => res.json())
-      .then(data => {
-        setCameras(data.cameras);
-        setPastCameras(data.past_recordings);
-        setConvertedFiles(data.converted_files)
-        setConverting(data.conversions_in_progress)
-      })
+      .then(applyInfo)
       .catch(err => {
         console.error("Error fetching camera info:", err);
       })
   }
 
+  // The server pushes a snapshot of /info and then every change; nothing is polled
   useEffect(() => {
-    getInfo();
+    const events = new EventSource('/events?topics=camera,recording,conversion')
+    const on = (topic, handler) => events.addEventListener(topic, e => handler(JSON.parse(e.data)))
+    const without = (list, item) => list.filter(x => x !== item)
+    on('snapshot', applyInfo)
+    on('camera', ({ camera_id, live, low_latency }) => {
+      setCameras(prev => live ? (prev.includes(camera_id) ? prev : [...prev, camera_id]) : without(prev, camera_id))
+      setLowLatencyCameras(prev => live && low_latency ? [...without(prev, camera_id), camera_id] : without(prev, camera_id))
+    })
+    on('recording', ({ camera_id, state, converted_file }) => {
+      setPastCameras(prev => state === 'recorded' ? [...without(prev, camera_id), camera_id].sort() : without(prev, camera_id))
+      setConvertedFiles(prev => {
+        const rest = prev.filter(f => f !== `${camera_id}.mp4` && f !== converted_file)
+        return converted_file ? [...rest, converted_file].sort() : rest
+      })
+    })
+    on('conversion', (job) => {
+      if (job.status === 'queued' || job.status === 'in_progress') {
+        setConverting(prev => prev.includes(job.camera_id) ? prev : [...prev, job.camera_id])
+        setProgress(prev => ({ ...prev, [job.camera_id]: job }))
+      } else {
+        // completed, failed or cancelled; a completed one shows up through its recording event
+        setConverting(prev => without(prev, job.camera_id))
+        setProgress(({ [job.camera_id]: _, ...rest }) => rest)
+      }
+    })
+    return () => events.close()
   }, []);
   const renderMode = () => {
     switch (videoMode) {
       case 0:
-        return <SingleVideo cameras={cameras} setCameras={setCameras} getCameras={getInfo} />;
+        return <SingleVideo cameras={cameras} setCameras={setCameras} getCameras={getInfo} lowLatencyCameras={lowLatencyCameras} />;
       case 1:
-        return <AllVideos cameras={cameras} setCameras={setCameras} getCameras={getInfo} />;
+        return <AllVideos cameras={cameras} setCameras={setCameras} getCameras={getInfo} lowLatencyCameras={lowLatencyCameras} />;
       case 2:
-        return <SingleVideo cameras={pastCameras} getCameras={getInfo} />;
+        return <SingleVideo cameras={pastCameras} getCameras={getInfo} live={false} />;
       case 3:
         return <ConvertPanel
             pastRecordings={pastCameras}
             convertedFiles={convertedFiles}
             converting={converting}
             setConverting={setConverting}
-            fetchInfo={getInfo}
+            progress={progress}
           />;
+      case 4:
+        // one server-composited stream of every live camera (server --mosaic)
+        return mosaicUrl
+          ? <div className="card"><DashVideo url={mosaicUrl} /></div>
+          : <div className="empty-state">The server is not publishing a mosaic (start it with --mosaic)</div>;
       default:
         // Placeholder for future modes
         return <div>Unknown mode: {videoMode}</div>;
@@ -56,6 +95,7 @@ function App() {
           {videoMode !== 1 && <button onClick={() => setVideoMode(1)}>Switch to Multi-Video</button>}
           {videoMode !== 2 && <button onClick={() => setVideoMode(2)}>Switch to Past Recordings</button>}
           {videoMode !== 3 && <button onClick={() => setVideoMode(3)}>Switch to Convert/Downloads</button>}
+          {videoMode !== 4 && mosaicUrl && <button onClick={() => setVideoMode(4)}>Switch to Mosaic</button>}
           <button onClick={getInfo}>{cameras.length > 0 || pastCameras.length > 0 ? "Refresh" : "Get"} Past/Current Recordings</button>
         </div>
       </div>
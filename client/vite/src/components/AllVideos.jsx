@@ -1,14 +1,25 @@
 import DashVideo from './DashVideo';
+import Thumbnail from './Thumbnail';
 import React, { useState, useEffect } from 'react';
-function AllVideos({cameras, setCameras, getCameras}) {
+// The grid shows cheap snapshots; only the selected camera gets a DASH player
+function AllVideos({cameras, setCameras, getCameras, lowLatencyCameras = []}) {
+    const [selected, setSelected] = useState(null);
     return (
     	<>
     	  {cameras.length > 0 ? (
     	    <div className="grid">
     	      {cameras.map((camera, index) => (
     		<div key={index} className="card">
-    		  <h3>Camera {camera}</h3>
-    		  <DashVideo url={`/dash/${camera}/manifest.mpd`} />
+    		  <h3>
+    		    Camera {camera}
+    		    {selected === camera && <button className="ml-8" onClick={() => setSelected(null)}>Close</button>}
+    		  </h3>
+    		  {selected === camera ? (
+    		    <DashVideo url={`/dash/${camera}/live/manifest.mpd`} cameraId={camera} lowBandwidth
+    		               lowLatency={lowLatencyCameras.includes(camera)} />
+    		  ) : (
+    		    <Thumbnail cameraId={camera} onClick={() => setSelected(camera)} />
+    		  )}
     		</div>
     	      ))}
     	    </div>
@@ -1,54 +1,24 @@
-import React, { useEffect, useRef } from 'react'
+import React from 'react'
+
+// "42% · 35.1x · ETA 12s" from a conversion event
+function formatProgress(p) {
+  if (!p) return '⏳ in progress'
+  if (p.status === 'queued') return `🕒 queued #${p.position}`
+  const parts = []
+  parts.push(p.percent != null ? `${p.percent.toFixed(0)}%` : '⏳')
+  if (p.speed != null) parts.push(`${p.speed.toFixed(1)}x`)
+  if (p.eta != null) parts.push(`ETA ${Math.ceil(p.eta)}s`)
+  if (p.mode) parts.push(p.mode)
+  return parts.join(' · ')
+}
 
 function ConvertPanel({ 
   pastRecordings,
   convertedFiles,
   converting, setConverting,
-  fetchInfo
+  progress
 }) {
-  const eventSources = useRef({})
-
-  useEffect(() => {
-    // Ensure event sources exist for active conversions
-    converting.forEach(id => {
-      if (!eventSources.current[id]) {
-        const es = new EventSource(`/convert-status/${encodeURIComponent(id)}`)
-        es.onmessage = (e) => {
-          const status = (e.data || '').trim()
-          if (status === 'in_progress') {
-            setConverting(prev => Array.from(new Set([...prev, id])))
-          } else if (status === 'completed') {
-            // conversion done — remove from converting and refresh info
-            setConverting(prev => prev.filter(x => x !== id))
-            fetchInfo()
-            es.close()
-            delete eventSources.current[id]
-          } else if (status === 'not_found') {
-            setConverting(prev => prev.filter(x => x !== id))
-            es.close()
-            delete eventSources.current[id]
-            fetchInfo()
-          }
-        }
-        es.onerror = () => {
-          // keep trying; close if readyState closed
-          if (es.readyState === EventSource.CLOSED) {
-            es.close()
-            delete eventSources.current[id]
-          }
-        }
-        eventSources.current[id] = es
-      }
-    })
-    // Cleanup function to close EventSource connections for items no longer in converting
-    return () => {
-      Object.keys(eventSources.current).forEach(id => {
-        eventSources.current[id].close();
-        delete eventSources.current[id];
-      });
-    };
-  }, [converting, fetchInfo, setConverting])
-
+  // converting, progress and the lists are kept current by App's /events stream
   const startConversion = (cameraId) => {
     fetch(`/convert/${encodeURIComponent(cameraId)}`, { method: 'POST' })
       .then(res => {
@@ -56,7 +26,7 @@ function ConvertPanel({
         return res.json().then(err => Promise.reject(err))
       })
       .then(() => {
-        // add to converting and open eventsource (effect hook will do the rest)
+        // shown at once; its conversion events take over from here
         setConverting(prev => Array.from(new Set([...prev, cameraId])))
       })
       .catch(err => {
@@ -65,6 +35,20 @@ function ConvertPanel({
       })
   }
 
+  const convertAll = () => {
+    fetch('/convert-all', { method: 'POST' })
+      .then(res => res.json())
+      .then(data => {
+        setConverting(prev => Array.from(new Set([...prev, ...(data.queued || [])])))
+      })
+      .catch(err => console.error('Failed to queue conversions', err))
+  }
+
+  const cancelConversion = (cameraId) => {
+    fetch(`/convert/${encodeURIComponent(cameraId)}`, { method: 'DELETE' })
+      .catch(err => console.error('Failed to cancel conversion', err))
+  }
+
   const downloadFile = (filename) => {
     // open the download endpoint in a new tab/window to trigger download
     window.open(`/download/${encodeURIComponent(filename)}`, '_blank')
@@ -80,6 +64,7 @@ function ConvertPanel({
       <div className="panel-rows">
         <div className="panel-col">
           <h3>Available for conversion</h3>
+          {availableToConvert.length > 1 && <button onClick={convertAll}>Convert all</button>}
           {availableToConvert.length === 0 ? <div className="empty-state">No available recordings to convert</div> : (
             <ul>
               {availableToConvert.map(id => (
@@ -99,7 +84,8 @@ function ConvertPanel({
               {converting.map(id => (
                 <li key={id} className="list-item">
                   <strong>{id}</strong>
-                  <span className="ml-8">⏳ in progress</span>
+                  <span className="ml-8">{formatProgress(progress[id])}</span>
+                  <button className="ml-8" onClick={() => cancelConversion(id)}>Cancel</button>
                 </li>
               ))}
             </ul>
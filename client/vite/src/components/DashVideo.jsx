@@ -1,7 +1,38 @@
 import {useEffect, useRef} from "react"
 import { MediaPlayer } from "dashjs"
 
-function DashVideo({player, url}) {
+// Grid tiles start low and never pick a rendition larger than the tile itself
+const LOW_BANDWIDTH_SETTINGS = {
+    streaming: {
+        abr: {
+            limitBitrateByPortal: true,
+            initialBitrate: { video: 800 },
+        },
+    },
+};
+
+// Cameras the server packages as chunked CMAF (low_latency_cameras in /info). The manifest
+// carries the same target latency and playback-rate range; these make dash.js follow them.
+const LOW_LATENCY_SETTINGS = {
+    streaming: {
+        delay: { liveDelay: 1.5 },
+        liveCatchup: {
+            enabled: true,
+            maxDrift: 3,
+            playbackRate: { min: -0.1, max: 0.1 },
+        },
+    },
+};
+
+function applySettings(p, lowBandwidth, lowLatency) {
+    if (lowBandwidth) p.updateSettings(LOW_BANDWIDTH_SETTINGS);
+    if (lowLatency) p.updateSettings(LOW_LATENCY_SETTINGS);
+}
+
+// How often a live player tells the server how far behind live it is (see /latency)
+const LATENCY_REPORT_MS = 5000;
+
+function DashVideo({player, url, lowBandwidth = false, lowLatency = false, cameraId = null}) {
     const video = useRef(null);
     const localPlayer = useRef(null);
 
@@ -23,6 +54,7 @@ function DashVideo({player, url}) {
         const p = localPlayer.current || player;
         if (video.current && url && p) {
             try {
+                applySettings(p, lowBandwidth, lowLatency);
                 p.initialize(video.current, url, true);
             } catch (e) {
                 console.error('Initialize failed', e);
@@ -31,7 +63,23 @@ function DashVideo({player, url}) {
                 try { if (localPlayer.current) localPlayer.current.reset(); else if (player) player.reset(); } catch (e) { /* ignore */ }
             };
         }
-    }, [url, player]);
+    }, [url, player, lowBandwidth, lowLatency]);
+
+    useEffect(() => {
+        if (!cameraId) return;
+        const timer = setInterval(() => {
+            const p = localPlayer.current || player;
+            let liveLatency = NaN;
+            try { liveLatency = p ? p.getCurrentLiveLatency() : NaN; } catch (e) { /* not playing yet */ }
+            if (!Number.isFinite(liveLatency) || liveLatency <= 0) return;
+            fetch(`/latency/${encodeURIComponent(cameraId)}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ live_latency: liveLatency }),
+            }).catch(() => { /* reporting is best effort */ });
+        }, LATENCY_REPORT_MS);
+        return () => clearInterval(timer);
+    }, [cameraId, player]);
 
     const reload = () => {
         const p = localPlayer.current || player;
@@ -39,7 +87,10 @@ function DashVideo({player, url}) {
             if (p) p.reset();
         } catch (e) { /* ignore */ }
         try {
-            if (video.current && url && p) p.initialize(video.current, url, true);
+            if (video.current && url && p) {
+                applySettings(p, lowBandwidth, lowLatency);
+                p.initialize(video.current, url, true);
+            }
         } catch (e) { console.error('Reload failed', e); }
     };
 
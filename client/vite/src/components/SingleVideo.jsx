@@ -1,6 +1,7 @@
 import DashVideo from './DashVideo'
 import { useEffect, useRef, useState } from 'react'
-function SingleVideo({cameras, setCameras, getCameras}) {
+// live cameras play their short live window; past recordings have only the full archive manifest
+function SingleVideo({cameras, setCameras, getCameras, lowLatencyCameras = [], live = true}) {
     const [selectedCamera, setSelectedCamera] = useState(cameras.length > 0 ? cameras[0] : null);
     useEffect(() => {
         setSelectedCamera(cameras.length > 0 ? cameras[0] : null);
@@ -18,7 +19,8 @@ function SingleVideo({cameras, setCameras, getCameras}) {
                             ))}
                         </select>
                     </div>
-                    <DashVideo url={`/dash/${selectedCamera}/manifest.mpd`} />
+                    <DashVideo url={`/dash/${selectedCamera}/${live ? 'live/' : ''}manifest.mpd`} cameraId={selectedCamera}
+                               lowLatency={lowLatencyCameras.includes(selectedCamera)} />
                 </div>
             ) : (
                 <div className="empty-state">No cameras available</div>
@@ -0,0 +1,49 @@
+import { useEffect, useState } from 'react'
+
+// How often a grid tile checks its camera's snapshot (the server refreshes it every --snapshot-interval s)
+const REFRESH_MS = 5000;
+
+function Thumbnail({cameraId, onClick}) {
+    const [src, setSrc] = useState(null);
+
+    useEffect(() => {
+        // One stable URL: the response is no-cache, so the browser revalidates its copy with
+        // If-None-Match and an unchanged snapshot costs a 304. Only a new ETag swaps the image.
+        const url = `/snapshot/${encodeURIComponent(cameraId)}`;
+        let etag = null;
+        let objectUrl = null;
+        let cancelled = false;
+        const load = () => {
+            fetch(url)
+                .then(res => {
+                    const tag = res.headers.get('ETag');
+                    if (!res.ok || (tag && tag === etag)) return null;
+                    etag = tag;
+                    return res.blob();
+                })
+                .then(blob => {
+                    if (!blob || cancelled) return;
+                    if (objectUrl) URL.revokeObjectURL(objectUrl);
+                    objectUrl = URL.createObjectURL(blob);
+                    setSrc(objectUrl);
+                })
+                .catch(() => { /* try again on the next tick */ });
+        };
+        load();
+        const timer = setInterval(load, REFRESH_MS);
+        return () => {
+            cancelled = true;
+            clearInterval(timer);
+            if (objectUrl) URL.revokeObjectURL(objectUrl);
+        };
+    }, [cameraId]);
+
+    return (
+        <div className="thumbnail" onClick={onClick} title="Play live">
+            {src
+                ? <img src={src} alt={`Camera ${cameraId}`} style={{ display: 'block' }} />
+                : <div className="empty-state">Waiting for a picture…</div>}
+        </div>
+    )
+}
+export default Thumbnail
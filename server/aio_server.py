@@ -0,0 +1,429 @@
+"""
+Asyncio engine for the MultiFlow server (`server.py --engine aiohttp`).
+
+Serves the same routes as the Flask app from one event loop instead of one OS
+thread per request:
+- ingest is written to each camera's ffmpeg through a non-blocking pipe writer
+  task instead of a `writer_thread`
+- the frontend, downloads and DASH files the segment cache does not hold go out
+  through `web.FileResponse`, which uses sendfile; cached DASH files are sent
+  from memory
+- `/events` and `/convert-status` streams are coroutines rather than threads,
+  woken by the event bus
+
+Camera state, conversions and validation stay in `server.py`; this module only
+adapts them to aiohttp. It needs the optional `aiohttp` package.
+"""
+import asyncio
+import json
+import os
+import queue
+import time
+
+from aiohttp import web
+
+from h264 import KeyframeGate
+from supervisor import CapacityError
+from segcache import GrowingSegment, UncachedFile
+
+
+async def _wait_events(subscription, wake, timeout):
+    """Subscription.wait for a coroutine whose subscription sets `wake` on new events."""
+    try:
+        await asyncio.wait_for(wake.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    wake.clear()
+    return subscription.take()
+
+
+async def _pipe_writer(pipe):
+    """Wrap a subprocess pipe in a non-blocking asyncio StreamWriter."""
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, pipe)
+    return asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+def _respond(body, status=200, headers=None):
+    if isinstance(body, dict):
+        return web.json_response(body, status=status, headers=headers)
+    if isinstance(body, bytes):
+        return web.Response(body=body, status=status, headers=headers)
+    return web.Response(text=str(body), status=status, headers=headers)
+
+
+class AsyncEngine:
+    """aiohttp routes plus the per-camera pipe writers they feed."""
+
+    def __init__(self, core):
+        self.core = core
+        self.wakeups = {}
+        self.writers = {}
+        # camera -> ffmpeg behind its writer, and the lock serialising reconnects after a crash
+        self.decoders = {}
+        self.reconnecting = {}
+        self.loop = None
+
+    def create_app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("POST", "/upload", self.upload)
+        app.router.add_route("DELETE", "/upload", self.close)
+        app.router.add_post("/ingest", self.ingest)
+        app.router.add_get("/info", self.info)
+        app.router.add_get("/dash/{camera_id}/{filename:.+}", self.dash)
+        app.router.add_post("/convert/{camera_id}", self.convert)
+        app.router.add_delete("/convert/{camera_id}", self.cancel_convert)
+        app.router.add_post("/convert-all", self.convert_all)
+        app.router.add_get("/convert-status/{camera_id}", self.convert_status)
+        app.router.add_get("/events", self.events)
+        app.router.add_get("/download/{filename}", self.download)
+        app.router.add_get("/metrics", self.metrics)
+        app.router.add_get("/snapshot/{camera_id}", self.snapshot)
+        app.router.add_get("/activity/{camera_id}", self.activity)
+        app.router.add_get("/clock", self.clock)
+        app.router.add_get("/latency", self.latency)
+        app.router.add_get("/latency/{camera_id}", self.latency)
+        app.router.add_post("/latency/{camera_id}", self.report_latency)
+        app.router.add_get("/", self.index)
+        app.router.add_get("/{filename:.+}", self.web_file)
+        app.on_startup.append(self._on_startup)
+        return app
+
+    async def _on_startup(self, app):
+        self.loop = asyncio.get_running_loop()
+        self.core.stop_callbacks.append(self._wake_all_threadsafe)
+        self.core.close_callbacks.append(self._wake_threadsafe)
+
+    def _wake_all_threadsafe(self):
+        # stop_all_streams runs on the menu thread
+        for event in list(self.wakeups.values()):
+            self.loop.call_soon_threadsafe(event.set)
+
+    def _wake_threadsafe(self, cam_id):
+        # close_camera may run on a decoder's watch thread, which the feeder would never hear from
+        event = self.wakeups.get(cam_id)
+        if event is not None:
+            self.loop.call_soon_threadsafe(event.set)
+
+    async def _camera_writer(self, cam_id, first_chunk=b"", options=None):
+        """Return the pipe writer for a camera, starting its decoder if needed.
+        Raises CapacityError if a new camera is not admitted."""
+        # off the loop: starting a decoder moves an earlier recording aside and spawns ffmpeg,
+        # under the lock every other camera's requests take
+        if cam_id not in self.core.camera_streams and await asyncio.get_running_loop().run_in_executor(
+                None, self.core.ensure_camera, cam_id, False, first_chunk, options):
+            ffmpeg = self.core.camera_decoders.get(cam_id)
+            if ffmpeg is None:
+                # closed again before this got back to the loop
+                return None
+            stale = self.writers.pop(cam_id, None)
+            if stale is not None:
+                # the pipe of this id's previous decoder, whose feeder has not finished yet
+                stale.close()
+            self.wakeups[cam_id] = asyncio.Event()
+            self.decoders[cam_id] = ffmpeg
+            self.writers[cam_id] = await _pipe_writer(ffmpeg.stdin)
+            asyncio.create_task(self._feed_decoder(cam_id, self.core.camera_streams[cam_id]))
+        while cam_id in self.core.camera_streams and cam_id not in self.writers:
+            # another request is still wiring up this camera
+            await asyncio.sleep(0)
+        return self.writers.get(cam_id)
+
+    async def _reconnect(self, cam_id):
+        """Pipe writer for the decoder that replaced a crashed one, or None once the camera is gone."""
+        async with self.reconnecting.setdefault(cam_id, asyncio.Lock()):
+            ffmpeg = self.decoders.get(cam_id)
+            current = self.core.camera_decoders.get(cam_id)
+            if current is ffmpeg:
+                # not replaced yet: the supervisor restarts it from the decoder's watch thread
+                current = await asyncio.get_running_loop().run_in_executor(
+                    None, self.core.wait_for_decoder, cam_id, ffmpeg)
+            if current is None:
+                return None
+            if self.decoders.get(cam_id) is not current:
+                old = self.writers.get(cam_id)
+                if old is not None:
+                    old.close()
+                self.writers[cam_id] = await _pipe_writer(current.stdin)
+                self.decoders[cam_id] = current
+            return self.writers[cam_id]
+
+    async def _feed_decoder(self, cam_id, buf):
+        """Async counterpart of writer_thread: drain the ingest buffer into ffmpeg."""
+        wakeup = self.wakeups[cam_id]
+        gate = None
+        try:
+            while True:
+                try:
+                    chunk = buf.get(timeout=0)
+                except queue.Empty:
+                    wakeup.clear()
+                    await wakeup.wait()
+                    continue
+                if chunk is None:
+                    break
+                if gate is not None:
+                    # a restarted decoder starts on the camera's next keyframe
+                    chunk = gate(chunk)
+                    if gate.open:
+                        gate = None
+                    if not chunk:
+                        continue
+                writer = self.writers[cam_id]
+                try:
+                    writer.write(chunk)
+                    await writer.drain()
+                except (BrokenPipeError, ConnectionResetError) as e:
+                    if await self._reconnect(cam_id) is None:
+                        print("FFmpeg process ended:", e)
+                        break
+                    gate = KeyframeGate()
+                    continue
+                self.core.record_written(cam_id, chunk)
+        finally:
+            # unless the camera id was opened again meanwhile, and the entries are its own
+            if self.wakeups.get(cam_id) is wakeup:
+                writer = self.writers.pop(cam_id, None)
+                if writer is not None:
+                    writer.close()
+                self.wakeups.pop(cam_id, None)
+                self.decoders.pop(cam_id, None)
+                self.reconnecting.pop(cam_id, None)
+
+    async def upload(self, request):
+        cam_id = request.headers.get("Camera-ID", "0")
+        chunk = await request.read()
+        options = self.core.camera_options(request.headers)
+        if chunk and cam_id not in self.core.streaming_ingests:
+            try:
+                await self._camera_writer(cam_id, chunk, options)
+            except CapacityError as e:
+                return _respond(*self.core.refuse_camera(cam_id, e))
+        body, status, headers = self.core.accept_chunk(cam_id, chunk, start_writer=False, options=options)
+        event = self.wakeups.get(cam_id)
+        if event is not None:
+            event.set()
+        return _respond(body, status, headers)
+
+    async def close(self, request):
+        cam_id = request.headers.get("Camera-ID", "0")
+        # close_camera wakes the camera's feeder through close_callbacks
+        if not self.core.close_camera(cam_id):
+            return web.Response(text=f"Camera {cam_id} not found", status=404)
+        return web.Response(text=f"Closed camera {cam_id}")
+
+    async def ingest(self, request):
+        cam_id = request.headers.get("Camera-ID", "0")
+        with self.core.streaming_ingests_lock:
+            if cam_id in self.core.streaming_ingests:
+                return web.Response(text=f"Camera {cam_id} already streaming", status=409)
+            self.core.streaming_ingests.add(cam_id)
+        try:
+            chunk = await request.content.readany()
+            if not chunk:
+                return web.Response(text="No data", status=400)
+            options = self.core.camera_options(request.headers)
+            try:
+                writer = await self._camera_writer(cam_id, chunk, options)
+            except CapacityError as e:
+                return _respond(*self.core.refuse_camera(cam_id, e))
+            gate = None
+            while chunk:
+                if writer is None or cam_id not in self.core.camera_streams:
+                    return web.Response(text=f"Camera {cam_id} closed", status=410)
+                self.core.record_ingest(cam_id, chunk)
+                if gate is not None:
+                    chunk = gate(chunk)
+                    if gate.open:
+                        gate = None
+                try:
+                    if chunk:
+                        # the feeder task may have moved the camera onto a restarted decoder
+                        writer = self.writers.get(cam_id, writer)
+                        writer.write(chunk)
+                        await writer.drain()
+                        self.core.record_written(cam_id, chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    writer = await self._reconnect(cam_id)
+                    if writer is None:
+                        return web.Response(text=f"Camera {cam_id} decoder closed", status=410)
+                    gate = KeyframeGate()
+                chunk = await request.content.readany()
+            return web.Response(text="OK")
+        finally:
+            with self.core.streaming_ingests_lock:
+                self.core.streaming_ingests.discard(cam_id)
+
+    async def info(self, request):
+        return _respond(*self.core.info_request(request.query))
+
+    async def dash(self, request):
+        started = time.perf_counter()
+        camera_id, filename = request.match_info["camera_id"], request.match_info["filename"]
+        etag = request.headers.get("If-None-Match")
+        result = self.core.dash_file(camera_id, filename, etag, load=False)
+        if result is None:
+            # not cached: read it from disk off the event loop
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, self.core.dash_file, camera_id, filename, etag)
+        body, status, headers = result
+        if status == 404:
+            raise web.HTTPNotFound()
+        self.core.record_dash_request(camera_id, filename, request.remote, time.perf_counter() - started)
+        if isinstance(body, GrowingSegment):
+            return await self._stream_segment(request, body, headers)
+        if isinstance(body, UncachedFile):
+            return web.FileResponse(body.path, headers=headers)
+        return web.Response(body=body, status=status, headers=headers)
+
+    async def _stream_segment(self, request, segment, headers):
+        """Send a low-latency segment fragment by fragment while ffmpeg writes it."""
+        resp = web.StreamResponse(headers=headers)
+        resp.enable_chunked_encoding()
+        try:
+            await resp.prepare(request)
+            while True:
+                data, done = segment.read()
+                if data:
+                    await resp.write(data)
+                if done:
+                    break
+                if not data:
+                    await asyncio.sleep(GrowingSegment.POLL_SECONDS)
+        finally:
+            segment.close()
+        await resp.write_eof()
+        return resp
+
+    async def snapshot(self, request):
+        return _respond(*self.core.snapshot_request(request.match_info["camera_id"],
+                                                    request.headers.get("If-None-Match")))
+
+    async def activity(self, request):
+        # one indexed SQLite query plus a manifest read
+        return _respond(*await asyncio.get_running_loop().run_in_executor(
+            None, self.core.activity_request, request.match_info["camera_id"], request.query))
+
+    async def clock(self, request):
+        return web.Response(text=self.core.server_clock())
+
+    async def latency(self, request):
+        return _respond(*self.core.latency_summary(request.match_info.get("camera_id")))
+
+    async def report_latency(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        return _respond(*self.core.report_player_latency(request.match_info["camera_id"], body))
+
+    async def metrics(self, request):
+        return web.Response(body=self.core.metrics_text().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def convert(self, request):
+        # off the loop: a live camera's segments may be moved out of the RAM tier first
+        body, status = await asyncio.get_running_loop().run_in_executor(
+            None, self.core.request_conversion,
+            request.match_info["camera_id"],
+            request.query.get("mode", self.core.conversion.MODE_AUTO),
+            request.query.get("priority", 0),
+            self.core.query_flag(request.query.get("active")),
+            request.query.get("min_activity"),
+            request.query.get("start"),
+            request.query.get("end")
+        )
+        return _respond(body, status)
+
+    async def cancel_convert(self, request):
+        return _respond(*self.core.cancel_conversion(request.match_info["camera_id"]))
+
+    async def convert_all(self, request):
+        # off the loop, like convert: a catalog query and one request_conversion per recording
+        body, status = await asyncio.get_running_loop().run_in_executor(
+            None, self.core.request_convert_all,
+            request.query.get("mode", self.core.conversion.MODE_AUTO),
+            request.query.get("priority", 0)
+        )
+        return _respond(body, status)
+
+    async def convert_status(self, request):
+        camera_id = request.match_info["camera_id"]
+        if os.path.basename(camera_id) != camera_id:
+            return web.json_response({"error": "Invalid filename"}, status=400)
+        loop, wake = asyncio.get_running_loop(), asyncio.Event()
+        subscription = self.core.Subscription(self.core.event_bus, ("conversion",),
+                                              on_pending=lambda: loop.call_soon_threadsafe(wake.set))
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        try:
+            await resp.prepare(request)
+            status = self.core.conversion_status(camera_id)
+            while True:
+                if status is not None:
+                    await resp.write(f"data: {json.dumps(status)}\n\n".encode())
+                    if status["status"] in ("completed", "not_found"):
+                        break
+                events, resync = await _wait_events(subscription, wake, self.core.EVENTS_KEEPALIVE)
+                if resync:
+                    status = self.core.conversion_status(camera_id)
+                else:
+                    status = self.core.follow_conversion(camera_id, events)
+                if status is None and not events:
+                    await resp.write(b": keepalive\n\n")
+            await resp.write_eof()
+        except ConnectionResetError:
+            pass
+        finally:
+            subscription.close()
+        return resp
+
+    async def events(self, request):
+        loop, wake = asyncio.get_running_loop(), asyncio.Event()
+        value, error = self.core.open_event_stream(request.query, request.headers.get("Last-Event-ID"),
+                                                   on_pending=lambda: loop.call_soon_threadsafe(wake.set))
+        if error:
+            return _respond(*error)
+        subscription, first = value
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        try:
+            await resp.prepare(request)
+            await resp.write(first.encode())
+            while True:
+                events, resync = await _wait_events(subscription, wake, self.core.EVENTS_KEEPALIVE)
+                if resync:
+                    await resp.write(self.core.event_snapshot().encode())
+                if events:
+                    await resp.write("".join(event.sse() for event in events).encode())
+                elif not resync:
+                    await resp.write(b": keepalive\n\n")
+        except ConnectionResetError:
+            pass
+        finally:
+            subscription.close()
+        return resp
+
+    async def download(self, request):
+        filename = request.match_info["filename"]
+        file_path, error = self.core.resolve_download(filename)
+        if error:
+            return _respond(*error)
+        return web.FileResponse(file_path, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+    async def index(self, request):
+        return self._web_response("index.html")
+
+    async def web_file(self, request):
+        return self._web_response(request.match_info["filename"])
+
+    def _web_response(self, filename):
+        web_root = os.path.abspath(os.path.join(self.core.SERVER_ROOT, "..", "client", "web"))
+        path = os.path.normpath(os.path.join(web_root, filename))
+        if not path.startswith(os.path.join(web_root, "")) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return web.FileResponse(path)
+
+
+def run(core, host, port):
+    """Serve `core` (the server module) with aiohttp until interrupted."""
+    engine = AsyncEngine(core)
+    web.run_app(engine.create_app(), host=host, port=port, print=None)
@@ -0,0 +1,235 @@
+"""
+Persistent index of recordings, so /info never has to walk chunks/ and converted/.
+
+One row per camera id (each camera session is its own timestamped id). Rows
+are updated incrementally as cameras start and stop and as conversions finish;
+`sync_from_disk` reconciles the index with the directories once at startup.
+
+Segments of recordings made since the index existed have rows of their own:
+when each was finished (wall clock) and, with motion analysis on, its activity
+score. Segments deleted by retention keep their rows until the whole
+recording is gone.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from conversion import manifest_duration
+
+STATE_LIVE = "live"
+STATE_RECORDED = "recorded"
+# Segments are gone but a converted MP4 is still around
+STATE_REMOVED = "removed"
+STATES = (STATE_LIVE, STATE_RECORDED, STATE_REMOVED)
+# One file per segment and rendition (retention.segment_name); segments are counted on stream 0
+_SEGMENT_RE = re.compile(r"chunk-stream0-\d+\.m4s$")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    camera_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    started REAL,
+    ended REAL,
+    duration REAL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    segments INTEGER NOT NULL DEFAULT 0,
+    converted_file TEXT,
+    converted_bytes INTEGER,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS recordings_state ON recordings (state, camera_id);
+CREATE TABLE IF NOT EXISTS segments (
+    camera_id TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    started REAL NOT NULL,
+    ended REAL NOT NULL,
+    activity REAL,
+    PRIMARY KEY (camera_id, number)
+);
+"""
+
+
+def scan_recording(chunks_dir):
+    """(segment count, total bytes, duration) for one recording directory."""
+    segments = size = 0
+    try:
+        with os.scandir(chunks_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                size += entry.stat().st_size
+                if _SEGMENT_RE.match(entry.name):
+                    segments += 1
+    except FileNotFoundError:
+        pass
+    return segments, size, manifest_duration(os.path.join(chunks_dir, "manifest.mpd"))
+
+
+class RecordingCatalog:
+    def __init__(self, db_path, on_change=None):
+        self.db_path = db_path
+        # Called with a recording's row after it changed ({"camera_id", "state": "removed"} once deleted)
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+
+    def _upsert(self, camera_id, state, **fields):
+        """Update the given columns, inserting the row (in `state`) if it is new.
+        A state of None keeps an existing row's state."""
+        fields["updated"] = time.time()
+        updates = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._db:
+            if state is not None:
+                updates += ", state = ?"
+            params = (*fields.values(), *((state,) if state is not None else ()), camera_id)
+            if not self._db.execute(f"UPDATE recordings SET {updates} WHERE camera_id = ?", params).rowcount:
+                fields["state"] = state or STATE_REMOVED
+                names = ", ".join(fields)
+                placeholders = ", ".join("?" for _ in fields)
+                self._db.execute(f"INSERT INTO recordings (camera_id, {names}) VALUES (?, {placeholders})",
+                                 (camera_id, *fields.values()))
+        self._changed(camera_id)
+
+    def _changed(self, camera_id):
+        if self.on_change is not None:
+            self.on_change(self.get(camera_id) or {"camera_id": camera_id, "state": STATE_REMOVED})
+
+    def camera_started(self, camera_id):
+        self._upsert(camera_id, STATE_LIVE, started=time.time(), ended=None)
+
+    def camera_stopped(self, camera_id, chunks_dir, ended=None):
+        segments, size, duration = scan_recording(chunks_dir)
+        self._upsert(camera_id, STATE_RECORDED, ended=ended or time.time(),
+                     duration=duration, bytes=size, segments=segments)
+
+    def camera_restarted(self, camera_id, part_id, part_dir):
+        """Index the recording an earlier decoder left behind (moved to part_dir) as part_id:
+        one that crashed, or one whose camera id is being opened again. The camera itself
+        carries on live from now."""
+        previous = self.get(camera_id)
+        segments, size, duration = scan_recording(part_dir)
+        self._upsert(part_id, STATE_RECORDED, started=previous["started"] if previous else None,
+                     ended=(previous["ended"] if previous else None) or time.time(),
+                     duration=duration, bytes=size, segments=segments)
+        with self._lock, self._db:
+            self._db.execute("UPDATE segments SET camera_id = ? WHERE camera_id = ?", (part_id, camera_id))
+        self.camera_started(camera_id)
+
+    def update_stats(self, camera_id, segments, size, duration):
+        """Record what is left of a recording after segments were deleted."""
+        self._upsert(camera_id, None, segments=segments, bytes=size, duration=duration)
+
+    def conversion_finished(self, camera_id, output_path):
+        try:
+            size = os.path.getsize(output_path)
+        except OSError:
+            return
+        # A conversion with no indexed recording behind it only has the MP4 left
+        self._upsert(camera_id, None, converted_file=os.path.basename(output_path), converted_bytes=size)
+
+    def recording_removed(self, camera_id):
+        """Segments deleted: keep the row only while a converted file refers to it."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM recordings WHERE camera_id = ? AND converted_file IS NULL", (camera_id,))
+            self._db.execute("UPDATE recordings SET state = ?, bytes = 0, segments = 0, updated = ? WHERE camera_id = ?",
+                             (STATE_REMOVED, time.time(), camera_id))
+            self._db.execute("DELETE FROM segments WHERE camera_id = ?", (camera_id,))
+        self._changed(camera_id)
+
+    def segment_finished(self, camera_id, number, started, ended, activity=None):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO segments (camera_id, number, started, ended, activity) "
+                             "VALUES (?, ?, ?, ?, ?)", (camera_id, number, started, ended, activity))
+
+    def segment_at(self, camera_id, when):
+        """The recording's last indexed segment that started at or before `when` (epoch seconds), or None."""
+        with self._lock:
+            row = self._db.execute("SELECT number, started, ended, activity FROM segments "
+                                   "WHERE camera_id = ? AND started <= ? ORDER BY number DESC LIMIT 1",
+                                   (camera_id, when)).fetchone()
+        return dict(row) if row else None
+
+    def segments(self, camera_id, min_activity=None):
+        """Indexed segments of a recording ordered by number, optionally only those with
+        at least min_activity."""
+        clause, params = "", [camera_id]
+        if min_activity is not None:
+            clause = " AND activity >= ?"
+            params.append(min_activity)
+        with self._lock:
+            rows = self._db.execute(f"SELECT number, started, ended, activity FROM segments "
+                                    f"WHERE camera_id = ?{clause} ORDER BY number", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, camera_id):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM recordings WHERE camera_id = ?", (camera_id,)).fetchone()
+        return dict(row) if row else None
+
+    def query(self, state=None, search=None, converted=None, limit=None, offset=0):
+        """Filtered, paginated rows ordered by camera id. Returns (rows, total)."""
+        where, params = [], []
+        if state:
+            where.append("state = ?")
+            params.append(state)
+        if search:
+            where.append("instr(camera_id, ?) > 0")
+            params.append(search)
+        if converted is not None:
+            where.append("converted_file IS NOT NULL" if converted else "converted_file IS NULL")
+        clause = f" WHERE {' AND '.join(where)}" if where else ""
+        page = " LIMIT ? OFFSET ?" if limit is not None else ""
+        page_params = [limit, offset] if limit is not None else []
+        with self._lock:
+            total = self._db.execute(f"SELECT COUNT(*) FROM recordings{clause}", params).fetchone()[0]
+            rows = self._db.execute(f"SELECT * FROM recordings{clause} ORDER BY camera_id{page}",
+                                    params + page_params).fetchall()
+        return [dict(row) for row in rows], total
+
+    def converted_files(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT converted_file FROM recordings WHERE converted_file IS NOT NULL ORDER BY converted_file"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def sync_from_disk(self, chunks_root, converted_dir, live_ids=()):
+        """Reconcile with the directories: index unknown recordings, close stale live rows
+        left by a previous run, and drop rows whose files are gone."""
+        on_disk = set()
+        if os.path.isdir(chunks_root):
+            on_disk = {d for d in os.listdir(chunks_root) if os.path.isdir(os.path.join(chunks_root, d))}
+        converted = {}
+        if os.path.isdir(converted_dir):
+            for f in os.listdir(converted_dir):
+                path = os.path.join(converted_dir, f)
+                if f.lower().endswith(".mp4") and os.path.isfile(path):
+                    converted[os.path.splitext(f)[0]] = path
+        with self._lock:
+            known = {row["camera_id"]: dict(row) for row in self._db.execute("SELECT * FROM recordings")}
+        for camera_id in on_disk:
+            row = known.get(camera_id)
+            if camera_id in live_ids:
+                continue
+            if row is None or row["state"] != STATE_RECORDED:
+                chunks_dir = os.path.join(chunks_root, camera_id)
+                self.camera_stopped(camera_id, chunks_dir, ended=os.path.getmtime(chunks_dir))
+        for camera_id, row in known.items():
+            if camera_id not in on_disk and camera_id not in live_ids and row["state"] != STATE_REMOVED:
+                self.recording_removed(camera_id)
+        for camera_id, path in converted.items():
+            row = known.get(camera_id)
+            if row is None or row["converted_file"] != os.path.basename(path):
+                self.conversion_finished(camera_id, path)
+        with self._lock, self._db:
+            # converted files deleted behind our back
+            for camera_id, row in known.items():
+                if row["converted_file"] and camera_id not in converted:
+                    self._db.execute("UPDATE recordings SET converted_file = NULL, converted_bytes = NULL WHERE camera_id = ?",
+                                     (camera_id,))
+            self._db.execute("DELETE FROM recordings WHERE state = ? AND converted_file IS NULL", (STATE_REMOVED,))
@@ -0,0 +1,359 @@
+"""
+Turning recorded DASH segments into a single MP4 with ffmpeg, with progress reporting.
+
+A whole recording is read through its manifest. An `Excerpt` (a time range,
+or only the segments with activity) is read through an ffconcat list of the
+segment files instead, so its cost follows the excerpt's length rather than
+the recording's. Stream copy can only cut at keyframes, i.e. segment
+boundaries, and keeps whole segments. Re-encoding trims exactly and is split
+at segment boundaries into pieces that are encoded by parallel ffmpeg
+processes. The pieces are then joined by stream copy, which loses nothing.
+"""
+import collections
+import os
+import re
+import subprocess
+import threading
+import time
+
+# Remux the segments when the codec allows it, fall back to libx264 if that fails
+MODE_AUTO = "auto"
+MODE_COPY = "copy"
+MODE_TRANSCODE = "transcode"
+MODES = (MODE_AUTO, MODE_COPY, MODE_TRANSCODE)
+
+_DURATION_RE = re.compile(r'mediaPresentationDuration="P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?"')
+_TEMPLATE_RE = re.compile(r'<SegmentTemplate\b([^>]*)>\s*<SegmentTimeline>(.*?)</SegmentTimeline>', re.S)
+_S_RE = re.compile(r'<S\b([^>]*?)/>')
+_ATTR_RE = re.compile(r'(\w+)="([^"]*)"')
+# Excerpts are read through an ffconcat list of concat: URLs (init segment + media segments)
+EXCERPT_INPUT_ARGS = ["-protocol_whitelist", "file,concat", "-f", "concat", "-safe", "0"]
+# Re-encoded excerpt pieces are at least this long, so short clips don't pay for many processes
+MIN_PIECE_SECONDS = 10
+# Last stderr lines of a conversion ffmpeg kept for the error message
+STDERR_TAIL_LINES = 50
+
+
+def manifest_duration(manifest_path):
+    """Total duration in seconds from an MPD's mediaPresentationDuration, or None."""
+    try:
+        with open(manifest_path, encoding="utf-8", errors="ignore") as f:
+            head = f.read(4096)
+    except OSError:
+        return None
+    match = _DURATION_RE.search(head)
+    if not match:
+        return None
+    days, hours, minutes, seconds = (float(g) if g else 0.0 for g in match.groups())
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def segment_timeline(manifest_path):
+    """[(number, start, duration)] in seconds of the first representation's segments, from an
+    MPD with a SegmentTimeline. Empty if the manifest is missing or has no timeline."""
+    try:
+        with open(manifest_path, encoding="utf-8", errors="ignore") as f:
+            match = _TEMPLATE_RE.search(f.read())
+    except OSError:
+        return []
+    if not match:
+        return []
+    template = dict(_ATTR_RE.findall(match.group(1)))
+    timescale = int(template.get("timescale", 1))
+    number = int(template.get("startNumber", 1))
+    segments, t = [], 0
+    for s in _S_RE.finditer(match.group(2)):
+        attrs = dict(_ATTR_RE.findall(s.group(1)))
+        t = int(attrs.get("t", t))
+        d = int(attrs["d"])
+        for _ in range(int(attrs.get("r", 0)) + 1):
+            segments.append((number, t / timescale, d / timescale))
+            number += 1
+            t += d
+    return segments
+
+
+def _quote(path):
+    return "'" + path.replace("'", "'\\''") + "'"
+
+
+class Excerpt:
+    """Segments of one stream of a recording, played back to back.
+
+    segments are (number, start, duration) in media seconds, as from
+    segment_timeline. Consecutive segments are read as one ffconcat entry with
+    an explicit duration, so gaps between entries are closed. start and end
+    (media seconds) trim the excerpt when it is re-encoded.
+    """
+
+    def __init__(self, chunks_dir, segments, start=None, end=None, stream=0):
+        self.chunks_dir = chunks_dir
+        self.segments = sorted(segments)
+        self.start = start
+        self.end = end
+        self.stream = stream
+
+    def _runs(self):
+        """[[numbers, start, end]] of consecutive segments, in media seconds."""
+        runs = []
+        for number, start, duration in self.segments:
+            if runs and runs[-1][0][-1] == number - 1:
+                runs[-1][0].append(number)
+                runs[-1][2] = start + duration
+            else:
+                runs.append([[number], start, start + duration])
+        return runs
+
+    def lead(self, trim=True):
+        """Seconds to drop from the front of the list's output to start at self.start."""
+        if not trim or self.start is None or not self.segments:
+            return 0.0
+        return max(0.0, self.start - self.segments[0][1])
+
+    def duration(self, trim=True):
+        total = sum(end - start for _, start, end in self._runs())
+        if trim and self.end is not None and self.segments:
+            number, start, duration = self.segments[-1]
+            total -= max(0.0, start + duration - self.end)
+        return max(0.0, total - self.lead(trim))
+
+    def trim_args(self, trim=True):
+        """ffmpeg output options cutting the list's output to [start, end) (decoding, so exact)."""
+        args = []
+        if self.lead(trim):
+            args += ["-ss", f"{self.lead(trim):.6f}"]
+        if trim and self.end is not None:
+            args += ["-t", f"{self.duration(trim):.6f}"]
+        return args
+
+    def write_list(self, list_path):
+        init = os.path.join(self.chunks_dir, f"init-stream{self.stream}.m4s")
+        lines = ["ffconcat version 1.0"]
+        for numbers, start, end in self._runs():
+            names = [os.path.join(self.chunks_dir, f"chunk-stream{self.stream}-{n:05d}.m4s") for n in numbers]
+            lines.append(f"file {_quote('concat:' + '|'.join([init, *names]))}")
+            lines.append(f"duration {end - start:.6f}")
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def split(self, pieces):
+        """Up to `pieces` consecutive excerpts of similar duration covering this one, cut at
+        segment boundaries (each segment starts with a keyframe)."""
+        pieces = max(1, min(pieces, len(self.segments)))
+        target = self.duration() / pieces
+        parts, current, covered = [], [], 0.0
+        for segment in self.segments:
+            current.append(segment)
+            number, start, duration = segment
+            # only the part of the segment inside [start, end) counts
+            covered += max(0.0, min(start + duration, self.end if self.end is not None else start + duration)
+                           - max(start, self.start if self.start is not None else start))
+            if len(parts) < pieces - 1 and covered >= target * (len(parts) + 1):
+                parts.append(current)
+                current = []
+        if current:
+            parts.append(current)
+        return [Excerpt(self.chunks_dir, segments, self.start, self.end, self.stream) for segments in parts]
+
+
+def ffmpeg_command(manifest_path, output_path, mode, input_args=(), output_args=()):
+    """Conversion command writing MP4 to output_path and key=value progress to stdout.
+    input_args go before -i (e.g. EXCERPT_INPUT_ARGS for an Excerpt's list), output_args after it."""
+    if mode == MODE_COPY:
+        codec_args = ["-c", "copy"]
+    else:
+        codec_args = ["-c:v", "libx264", "-pix_fmt", "yuv420p"]
+    return [
+        "ffmpeg", "-y",
+        "-loglevel", "error",
+        "-nostats",
+        "-progress", "pipe:1",
+        *input_args,
+        "-i", manifest_path,
+        *output_args,
+        *codec_args,
+        # moov atom up front so downloads can start playing immediately
+        "-movflags", "+faststart",
+        "-f", "mp4",
+        output_path
+    ]
+
+
+class ConversionCancelled(Exception):
+    pass
+
+
+def run_with_progress(cmd, duration, on_progress, cwd=None, on_start=None, popen_kwargs=None):
+    """Run an ffmpeg command that has -progress pipe:1, reporting as it goes.
+
+    on_progress receives a dict with percent, speed (x realtime), eta (seconds)
+    and out_time (seconds); values ffmpeg has not reported yet are None.
+    on_start receives the Popen right after launch (e.g. so it can be killed).
+    Returns (returncode, the last STDERR_TAIL_LINES lines of stderr).
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, **(popen_kwargs or {}))
+    # drained alongside stdout: a damaged recording can log more than a pipe buffer, which
+    # would block ffmpeg (and this loop) if stderr were only read at the end
+    stderr = collections.deque(maxlen=STDERR_TAIL_LINES)
+    drain = threading.Thread(target=_drain_lines, args=(proc.stderr, stderr), daemon=True)
+    drain.start()
+    if on_start:
+        on_start(proc)
+    started = time.monotonic()
+    block = {}
+    for raw in proc.stdout:
+        key, _, value = raw.decode(errors="ignore").strip().partition("=")
+        block[key] = value
+        if key != "progress":
+            continue
+        # one complete progress block per "progress=continue|end" line
+        on_progress(_progress_from_block(block, duration, started))
+        block = {}
+    proc.wait()
+    drain.join()
+    return proc.returncode, "\n".join(stderr)
+
+
+def _drain_lines(pipe, lines):
+    for line in pipe:
+        lines.append(line.decode(errors="ignore").rstrip())
+
+
+def _progress_from_block(block, duration, started):
+    out_time = None
+    try:
+        out_time = int(block.get("out_time_us", "")) / 1_000_000
+    except ValueError:
+        pass
+    speed = None
+    try:
+        speed = float(block.get("speed", "").rstrip("x"))
+    except ValueError:
+        pass
+    if speed is None and out_time:
+        elapsed = time.monotonic() - started
+        speed = out_time / elapsed if elapsed > 0 else None
+    percent = eta = None
+    if duration and out_time is not None:
+        percent = min(100.0, 100.0 * out_time / duration)
+        if speed:
+            eta = max(0.0, (duration - out_time) / speed)
+    if block.get("progress") == "end":
+        percent, eta = 100.0, 0.0
+    return {
+        "percent": round(percent, 1) if percent is not None else None,
+        "speed": speed,
+        "eta": round(eta, 1) if eta is not None else None,
+        "out_time": out_time,
+    }
+
+
+def convert_recording(manifest_path, output_path, mode=MODE_AUTO, on_progress=None, log=print,
+                      on_start=None, cancel_event=None, popen_kwargs=None, excerpt=None, workers=1,
+                      part_path=None):
+    """Convert a DASH recording, or an Excerpt of it, to MP4; returns the mode that succeeded,
+    or raises RuntimeError. A re-encoded excerpt is split over up to `workers` ffmpegs.
+
+    Output is written to a .part file (part_path, by default output_path + ".part") and
+    renamed on success, so a failed or interrupted conversion never looks like a finished
+    download. If cancel_event is set (and the running ffmpegs killed via on_start's handles),
+    no further attempt is made and ConversionCancelled is raised.
+    """
+    report = on_progress or (lambda progress: None)
+    part_path = part_path or output_path + ".part"
+    attempts = [MODE_COPY, MODE_TRANSCODE] if mode == MODE_AUTO else [mode]
+    run = dict(cwd=os.path.dirname(output_path), on_start=on_start, popen_kwargs=popen_kwargs)
+    error = None
+    for attempt in attempts:
+        report({"mode": attempt, "percent": 0.0, "speed": None, "eta": None, "out_time": 0.0})
+        progress = lambda progress, attempt=attempt: report({"mode": attempt, **progress})
+        if excerpt is None:
+            cmd = ffmpeg_command(manifest_path, part_path, attempt)
+            log(f"Running ({attempt}): {' '.join(cmd)}")
+            returncode, stderr = run_with_progress(cmd, manifest_duration(manifest_path), progress, **run)
+        elif attempt == MODE_COPY:
+            returncode, stderr = _convert_excerpt(excerpt, part_path, MODE_COPY, progress, log, run)
+        else:
+            returncode, stderr = _transcode_excerpt(excerpt, part_path, workers, progress, log, cancel_event, run)
+        if cancel_event is not None and cancel_event.is_set():
+            _remove(part_path)
+            raise ConversionCancelled(output_path)
+        if returncode == 0:
+            os.replace(part_path, output_path)
+            return attempt
+        error = f"ffmpeg {attempt} failed (code {returncode}): {stderr.strip()}"
+        log(error)
+        _remove(part_path)
+    raise RuntimeError(error)
+
+
+def _convert_excerpt(excerpt, output_path, mode, on_progress, log, run):
+    """One ffmpeg over the excerpt's list; stream copy keeps whole segments."""
+    list_path = output_path + ".ffconcat"
+    excerpt.write_list(list_path)
+    trim = mode != MODE_COPY
+    cmd = ffmpeg_command(list_path, output_path, mode, EXCERPT_INPUT_ARGS, excerpt.trim_args(trim))
+    log(f"Running ({mode}): {' '.join(cmd)}")
+    try:
+        return run_with_progress(cmd, excerpt.duration(trim), on_progress, **run)
+    finally:
+        _remove(list_path)
+
+
+def _transcode_excerpt(excerpt, output_path, workers, on_progress, log, cancel_event, run):
+    """Re-encode an excerpt as pieces in parallel, then join them by stream copy."""
+    total = excerpt.duration()
+    pieces = excerpt.split(min(workers, int(total // MIN_PIECE_SECONDS)))
+    if len(pieces) == 1:
+        return _convert_excerpt(excerpt, output_path, MODE_TRANSCODE, on_progress, log, run)
+    log(f"Re-encoding {total:.1f} s in {len(pieces)} pieces")
+    piece_paths = [f"{output_path}.{index}.mp4" for index in range(len(pieces))]
+    results = [None] * len(pieces)
+    out_times = [0.0] * len(pieces)
+    started = time.monotonic()
+    lock = threading.Lock()
+
+    def piece_progress(index, progress):
+        with lock:
+            out_times[index] = progress["out_time"] or out_times[index]
+            done = sum(out_times)
+        elapsed = time.monotonic() - started
+        speed = done / elapsed if elapsed > 0 else None
+        on_progress({"percent": round(min(100.0, 100.0 * done / total), 1) if total else None, "speed": speed,
+                     "eta": round(max(0.0, (total - done) / speed), 1) if speed else None, "out_time": done})
+
+    def encode(index):
+        results[index] = _convert_excerpt(pieces[index], piece_paths[index], MODE_TRANSCODE,
+                                          lambda progress: piece_progress(index, progress), log, run)
+
+    threads = [threading.Thread(target=encode, args=(index,), daemon=True) for index in range(len(pieces))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        for result in results:
+            if result is None or result[0] != 0:
+                return result or (-1, "piece failed to run")
+        if cancel_event is not None and cancel_event.is_set():
+            return -1, "cancelled"
+        # every piece starts with a keyframe, so they join without re-encoding
+        list_path = output_path + ".pieces"
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.write("ffconcat version 1.0\n" + "".join(f"file {_quote(path)}\n" for path in piece_paths))
+        cmd = ffmpeg_command(list_path, output_path, MODE_COPY, ["-f", "concat", "-safe", "0"])
+        log(f"Joining: {' '.join(cmd)}")
+        try:
+            return run_with_progress(cmd, total, lambda progress: None, **run)
+        finally:
+            _remove(list_path)
+    finally:
+        for path in piece_paths:
+            _remove(path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,137 @@
+"""
+In-process publish/subscribe bus behind the /events feed.
+
+The server publishes what dashboards show as it happens:
+- cameras going live and stopping
+- recordings changing in the catalog
+- finished segments
+- conversions being queued, progressing and ending
+
+Each event gets the next sequence number and is handed to every subscriber
+while the bus lock is held, so each subscriber sees events in order. That is
+also why delivery only appends to the subscriber's pending list. A consumer
+thread blocks on that list, and an asyncio consumer is woken through
+`on_pending`. An open dashboard then costs one short list: no polling and no
+filesystem calls.
+
+The last REPLAY events are kept. A client that reconnects with the id of the
+last event it saw gets the events it missed. A client that fell further
+behind, or whose pending list overflowed, gets a fresh snapshot instead.
+"""
+import collections
+import json
+import threading
+import time
+
+REPLAY = 1024
+# Events a subscriber may have waiting; beyond this it is resynchronised with a snapshot
+MAX_PENDING = 512
+
+
+class Event:
+    __slots__ = ("id", "topic", "data")
+
+    def __init__(self, event_id, topic, data):
+        self.id = event_id
+        self.topic = topic
+        self.data = data
+
+    def sse(self):
+        """The event as a server-sent events message."""
+        return sse_message(self.topic, self.data, self.id)
+
+
+def sse_message(name, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {name}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+class EventBus:
+    def __init__(self, replay=REPLAY):
+        # ids continue from the start time in ms, so a client's id from before a restart
+        # is older than anything kept now and gets it a snapshot
+        self.last_id = int(time.time() * 1000)
+        self._recent = collections.deque(maxlen=replay)
+        self._subscribers = {}
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    def publish(self, topic, **data):
+        with self._lock:
+            self.last_id += 1
+            event = Event(self.last_id, topic, data)
+            self._recent.append(event)
+            for topics, deliver in self._subscribers.values():
+                if topics is None or topic in topics:
+                    deliver(event)
+        return event
+
+    def subscribe(self, deliver, topics=None, after=None):
+        """Call deliver(event) for every event on `topics` (None: all) from now on.
+        With `after` (an event id), the kept events since then are delivered first.
+        Returns (token, last_id, complete): complete is False if some of those are no
+        longer kept (or after is not an id of this bus)."""
+        with self._lock:
+            oldest = self._recent[0].id if self._recent else self.last_id + 1
+            complete = after is not None and oldest - 1 <= after <= self.last_id
+            if complete:
+                for event in self._recent:
+                    if event.id > after and (topics is None or event.topic in topics):
+                        deliver(event)
+            self._tokens += 1
+            self._subscribers[self._tokens] = (topics, deliver)
+            return self._tokens, self.last_id, complete
+
+    def unsubscribe(self, token):
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def subscribers(self):
+        return len(self._subscribers)
+
+
+class Subscription:
+    """A subscriber's pending events, taken by one consumer.
+
+    Threads block in wait(); an asyncio consumer passes on_pending, which is
+    called (from the publishing thread) whenever events arrive, and calls take().
+    """
+
+    def __init__(self, bus, topics=None, after=None, on_pending=None, max_pending=MAX_PENDING):
+        self.bus = bus
+        self.on_pending = on_pending
+        self.max_pending = max_pending
+        self._pending = []
+        self._overflowed = False
+        self._cond = threading.Condition()
+        self.token, self.last_id, self.complete = bus.subscribe(self._deliver, topics, after)
+
+    def _deliver(self, event):
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                # the consumer is too slow to keep up event by event
+                self._pending.clear()
+                self._overflowed = True
+            self._pending.append(event)
+            self._cond.notify()
+        if self.on_pending is not None:
+            self.on_pending()
+
+    def take(self):
+        """(events, resync): the pending events, and whether some were dropped since the
+        last take (the consumer should send a fresh snapshot)."""
+        with self._cond:
+            events, self._pending = self._pending, []
+            resync, self._overflowed = self._overflowed, False
+        return events, resync
+
+    def wait(self, timeout):
+        """take(), after waiting up to timeout seconds for events."""
+        with self._cond:
+            if not self._pending and not self._overflowed:
+                self._cond.wait(timeout)
+        return self.take()
+
+    def close(self):
+        self.bus.unsubscribe(self.token)
@@ -0,0 +1,82 @@
+"""
+Small raw copies of every live camera's frames for in-process consumers.
+
+When a consumer is enabled (the mosaic, motion analysis), each camera's ffmpeg
+gets one more output: its video scaled to SIZE at the tap frame rate, as raw
+BGR frames on an extra pipe (see `tap_output_args`). The camera is decoded
+once for its packaging and all consumers; copy-mode cameras pay one decode
+here. A reader thread per camera hands every frame to the subscribers.
+
+Subscribers implement on_frame(camera_id, frame) and on_ended(camera_id). The
+frame array is never reused, so subscribers may keep it. on_ended is called
+when the camera's frames stop, i.e. its decoder exited or the camera closed.
+"""
+import numpy as np
+
+# Letterboxed to this 16:9 shape, the size of a mosaic tile
+SIZE = (480, 270)
+DEFAULT_FPS = 10
+
+
+def tap_output_args(fd, fps=DEFAULT_FPS, size=SIZE):
+    """ffmpeg output options adding the camera's tap stream as raw BGR on pipe:fd."""
+    w, h = size
+    return [
+        "-map", "0:v:0",
+        "-vf", f"fps={fps},scale={w}:{h}:force_original_aspect_ratio=decrease,"
+               f"pad={w}:{h}:(ow-iw)/2:(oh-ih)/2",
+        "-pix_fmt", "bgr24",
+        "-f", "rawvideo", f"pipe:{fd}",
+    ]
+
+
+class FrameTap:
+    def __init__(self, fps=DEFAULT_FPS, size=SIZE, log=print):
+        self.fps = fps
+        self.size = size
+        self.log = log
+        self.subscribers = []
+        self._readers = {}
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+
+    def output_args(self, fd):
+        return tap_output_args(fd, self.fps, self.size)
+
+    def feed(self, camera_id, pipe):
+        """Read a camera's frames from pipe until EOF (run in a thread). Reads even without
+        subscribers: a full pipe would stall the camera's ffmpeg."""
+        w, h = self.size
+        self._readers[camera_id] = pipe
+        try:
+            while True:
+                frame = np.empty((h, w, 3), np.uint8)
+                view = memoryview(frame).cast("B")
+                got = 0
+                while got < len(view):
+                    n = pipe.readinto(view[got:])
+                    if not n:
+                        return
+                    got += n
+                if self._readers.get(camera_id) is pipe:
+                    for subscriber in self.subscribers:
+                        try:
+                            subscriber.on_frame(camera_id, frame)
+                        except Exception as e:
+                            # the reader must keep draining the pipe
+                            self.log(f"{camera_id}: {type(subscriber).__name__} failed: {e}")
+        finally:
+            pipe.close()
+            # a restarted decoder's reader may already have taken over
+            if self._readers.get(camera_id) is pipe:
+                del self._readers[camera_id]
+                self._ended(camera_id)
+
+    def remove(self, camera_id):
+        if self._readers.pop(camera_id, None) is not None:
+            self._ended(camera_id)
+
+    def _ended(self, camera_id):
+        for subscriber in self.subscribers:
+            subscriber.on_ended(camera_id)
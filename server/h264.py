@@ -0,0 +1,161 @@
+"""Helpers for inspecting raw H.264 Annex-B byte streams as uploaded by the clients."""
+
+NAL_IDR = 5
+NAL_SPS = 7
+
+
+def iter_nal_units(data: bytes):
+    """Yield (offset, nal_type) for every start code found in data.
+
+    The offset points at the first byte of the start code, so slicing from it
+    yields a stream a decoder can resynchronise on.
+    """
+    pos = data.find(b"\x00\x00\x01")
+    while pos != -1 and pos + 3 < len(data):
+        start = pos - 1 if pos > 0 and data[pos - 1] == 0 else pos
+        yield start, data[pos + 3] & 0x1F
+        pos = data.find(b"\x00\x00\x01", pos + 3)
+
+
+def find_keyframe(data: bytes) -> int:
+    """Offset of the first SPS or IDR NAL unit in data, or -1 if there is none."""
+    for offset, nal_type in iter_nal_units(data):
+        if nal_type in (NAL_SPS, NAL_IDR):
+            return offset
+    return -1
+
+
+# Profiles that carry chroma format / bit depth fields in the SPS
+_HIGH_PROFILES = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135)
+# Baseline, Main and High are what browsers' MSE decoders reliably accept
+PLAYABLE_PROFILES = (66, 77, 100)
+
+
+class _BitReader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def bit(self) -> int:
+        byte = self.data[self.pos >> 3]
+        value = (byte >> (7 - (self.pos & 7))) & 1
+        self.pos += 1
+        return value
+
+    def bits(self, n: int) -> int:
+        value = 0
+        for _ in range(n):
+            value = (value << 1) | self.bit()
+        return value
+
+    def ue(self) -> int:
+        zeros = 0
+        while self.bit() == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+
+def _unescape(payload: bytes) -> bytes:
+    # strip emulation prevention bytes (00 00 03 -> 00 00)
+    return payload.replace(b"\x00\x00\x03", b"\x00\x00")
+
+
+def parse_sps(data: bytes):
+    """Parse the first SPS in an Annex-B stream.
+
+    Returns a dict with profile_idc, level_idc, chroma_format_idc and bit_depth,
+    or None if data holds no complete SPS.
+    """
+    for offset, nal_type in iter_nal_units(data):
+        if nal_type != NAL_SPS:
+            continue
+        start = data.find(b"\x00\x00\x01", offset) + 4
+        reader = _BitReader(_unescape(data[start:start + 64]))
+        try:
+            profile_idc = reader.bits(8)
+            reader.bits(8)  # constraint flags
+            level_idc = reader.bits(8)
+            reader.ue()  # seq_parameter_set_id
+            chroma_format_idc, bit_depth = 1, 8
+            if profile_idc in _HIGH_PROFILES:
+                chroma_format_idc = reader.ue()
+                if chroma_format_idc == 3:
+                    reader.bit()  # separate_colour_plane_flag
+                bit_depth = 8 + reader.ue()
+        except IndexError:
+            return None
+        return {
+            "profile_idc": profile_idc,
+            "level_idc": level_idc,
+            "chroma_format_idc": chroma_format_idc,
+            "bit_depth": bit_depth,
+        }
+    return None
+
+
+def is_browser_playable(sps) -> bool:
+    """True if a stream with this SPS can be packaged for dash.js without re-encoding."""
+    return (
+        sps is not None
+        and sps["profile_idc"] in PLAYABLE_PROFILES
+        and sps["chroma_format_idc"] == 1
+        and sps["bit_depth"] == 8
+    )
+
+
+# user_data_unregistered UUID of the capture-time SEI the clients insert (client/latency.py)
+LATENCY_SEI_UUID = b"MultiFlowLatency"
+_LATENCY_FIELDS = {"c": "captured", "q": "client_queue", "e": "client_encode", "o": "clock_offset"}
+
+
+def find_latency_stamps(data: bytes):
+    """Decode every client latency SEI in data into a dict of captured (client clock),
+    client_queue, client_encode and clock_offset seconds. Stamps cut off by a chunk
+    boundary are skipped."""
+    stamps = []
+    pos = data.find(LATENCY_SEI_UUID)
+    while pos != -1:
+        end = data.find(b"\x80", pos)
+        if end == -1:
+            break
+        stamp = {}
+        for field in data[pos + len(LATENCY_SEI_UUID):end].split(b";"):
+            key, _, value = field.partition(b"=")
+            name = _LATENCY_FIELDS.get(key.decode(errors="ignore"))
+            try:
+                if name:
+                    stamp[name] = float(value)
+            except ValueError:
+                pass
+        if len(stamp) == len(_LATENCY_FIELDS):
+            stamps.append(stamp)
+        pos = data.find(LATENCY_SEI_UUID, end)
+    return stamps
+
+
+class KeyframeGate:
+    """Drops a stream's bytes until its next SPS/IDR, then passes everything through.
+
+    Used when a decoder is (re)started partway through a camera's stream, so it
+    begins on a clean frame. The last bytes of dropped input are kept so a start
+    code split across two chunks is still found.
+    """
+
+    def __init__(self):
+        self.open = False
+        self.dropped = 0
+        self._tail = b""
+
+    def __call__(self, chunk: bytes) -> bytes:
+        if self.open:
+            return chunk
+        data = self._tail + chunk
+        offset = find_keyframe(data)
+        if offset < 0:
+            self._tail = data[-4:]
+            self.dropped += len(chunk)
+            return b""
+        self.open = True
+        self.dropped += max(0, offset - len(self._tail))
+        self._tail = b""
+        return data[offset:]
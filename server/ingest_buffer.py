@@ -0,0 +1,103 @@
+"""Byte-bounded per-camera buffer between /upload and the camera's ffmpeg writer."""
+import collections
+import queue
+import threading
+
+from h264 import KeyframeGate
+
+POLICY_BLOCK = "block"
+POLICY_DROP_OLDEST = "drop-oldest"
+POLICY_DROP_TO_KEYFRAME = "drop-to-keyframe"
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_DROP_TO_KEYFRAME)
+
+
+class IngestBuffer:
+    """
+    Queue-like chunk buffer holding at most `max_bytes` of encoded video.
+
+    When full, the policy decides what happens:
+    - block: refuse the new chunk; /upload turns that into a 503 with Retry-After
+    - drop-oldest: discard the oldest buffered chunks to make room
+    - drop-to-keyframe: discard incoming data until the next SPS/IDR so ffmpeg
+      resumes on a clean frame instead of a torn one
+
+    `get` mirrors `queue.Queue.get` (raises `queue.Empty` on timeout) so the
+    writer thread does not care which buffer it drains. `None` is the close
+    sentinel and is never dropped.
+    """
+
+    def __init__(self, max_bytes: int, policy: str = POLICY_BLOCK, on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown ingest policy {policy!r}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        # called with the number of bytes whenever some are dropped (e.g. to count them in /metrics)
+        self.on_drop = on_drop
+        self._chunks = collections.deque()
+        self._bytes = 0
+        self._cond = threading.Condition()
+        # KeyframeGate while dropping to the next keyframe; it scans across chunk boundaries
+        self._skipping = None
+        self.dropped_bytes = 0
+        self.dropped_chunks = 0
+        self.rejected_chunks = 0
+
+    def put(self, chunk) -> bool:
+        """Buffer a chunk. Returns False only when the block policy refuses it."""
+        with self._cond:
+            if chunk is None:
+                self._chunks.append(None)
+                self._cond.notify()
+                return True
+            if self._skipping is not None:
+                dropped = self._skipping.dropped
+                chunk = self._skipping(chunk)
+                self._drop(self._skipping.dropped - dropped)
+                if not self._skipping.open:
+                    return True
+                self._skipping = None
+            # An empty buffer always takes the chunk so oversized chunks still flow
+            if self._chunks and self._bytes + len(chunk) > self.max_bytes:
+                if self.policy == POLICY_BLOCK:
+                    self.rejected_chunks += 1
+                    return False
+                if self.policy == POLICY_DROP_OLDEST:
+                    while self._chunks and self._chunks[0] is not None and self._bytes + len(chunk) > self.max_bytes:
+                        self._bytes -= len(self._chunks[0])
+                        self._drop(len(self._chunks.popleft()))
+                else:
+                    self._drop(len(chunk))
+                    self._skipping = KeyframeGate()
+                    return True
+            self._chunks.append(chunk)
+            self._bytes += len(chunk)
+            self._cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._chunks and not self._cond.wait_for(lambda: self._chunks, timeout):
+                raise queue.Empty
+            chunk = self._chunks.popleft()
+            if chunk is not None:
+                self._bytes -= len(chunk)
+            return chunk
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "policy": self.policy,
+                "depth_bytes": self._bytes,
+                "depth_chunks": len(self._chunks),
+                "max_bytes": self.max_bytes,
+                "dropped_bytes": self.dropped_bytes,
+                "dropped_chunks": self.dropped_chunks,
+                "rejected_chunks": self.rejected_chunks,
+            }
+
+    def _drop(self, nbytes):
+        if nbytes:
+            self.dropped_bytes += nbytes
+            self.dropped_chunks += 1
+            if self.on_drop is not None:
+                self.on_drop(nbytes)
@@ -0,0 +1,112 @@
+"""
+Per-camera glass-to-playback latency breakdown.
+
+Clients embed capture timestamps in the H.264 stream (h264.find_latency_stamps).
+Each stamp is followed through the server: when its chunk arrives, when it is
+written to the camera's ffmpeg, and when the first segment after that is
+published. Players report their live latency separately. Stages, in order:
+
+- client_queue: capture to hand-off to the client encoder
+- client_encode: client ffmpeg
+- upload: client batching plus the network, on the server's clock
+- server_queue: waiting in the camera's ingest buffer
+- segment: server ffmpeg plus waiting for the segment to close
+- player: what the player adds on top of a published segment
+"""
+import collections
+import statistics
+import time
+
+from h264 import LATENCY_SEI_UUID, find_latency_stamps
+
+STAGES = ("client_queue", "client_encode", "upload", "server_queue", "segment", "player")
+# Samples kept per stage for the summary
+WINDOW = 120
+# Stamps waiting for their chunk to be written / their segment; older ones are given up on
+MAX_PENDING = 256
+
+
+class CameraLatency:
+    """Follows one camera's stamps; observe(stage, seconds) also gets every sample."""
+
+    def __init__(self, observe=lambda stage, seconds: None):
+        self.observe = observe
+        self.samples = {stage: collections.deque(maxlen=WINDOW) for stage in STAGES}
+        self.glass_to_segment = collections.deque(maxlen=WINDOW)
+        # capture time (server clock) -> receive time, until the chunk reaches ffmpeg
+        self._received = collections.OrderedDict()
+        # (capture time, written time) waiting for the next published segment
+        self._in_encoder = collections.deque(maxlen=MAX_PENDING)
+
+    def _record(self, stage, seconds):
+        seconds = max(0.0, seconds)
+        self.samples[stage].append(seconds)
+        self.observe(stage, seconds)
+
+    def _stamps(self, chunk):
+        # Cheap common case: one substring search per chunk
+        if LATENCY_SEI_UUID not in chunk:
+            return ()
+        return find_latency_stamps(chunk)
+
+    def received(self, chunk, now=None):
+        """A chunk arrived from the client."""
+        now = now or time.time()
+        for stamp in self._stamps(chunk):
+            captured = stamp["captured"] + stamp["clock_offset"]
+            self._record("client_queue", stamp["client_queue"])
+            self._record("client_encode", stamp["client_encode"])
+            self._record("upload", now - captured - stamp["client_queue"] - stamp["client_encode"])
+            self._received[captured] = now
+            while len(self._received) > MAX_PENDING:
+                self._received.popitem(last=False)
+
+    def written(self, chunk, now=None):
+        """A chunk was written to the camera's ffmpeg."""
+        now = now or time.time()
+        for stamp in self._stamps(chunk):
+            captured = stamp["captured"] + stamp["clock_offset"]
+            received = self._received.pop(captured, None)
+            if received is None:
+                continue
+            self._record("server_queue", now - received)
+            self._in_encoder.append((captured, now))
+
+    def segment_published(self, published):
+        """A new segment file appeared (mtime `published`)."""
+        while self._in_encoder and self._in_encoder[0][1] <= published:
+            captured, written = self._in_encoder.popleft()
+            self._record("segment", published - written)
+            self.glass_to_segment.append(max(0.0, published - captured))
+
+    def player_latency(self, live_latency):
+        """A player reported its live latency (how far its playhead is behind the live edge clock).
+        The part beyond the usual segment stage is attributed to the player."""
+        segment = self.samples["segment"]
+        typical = statistics.median(segment) if segment else 0.0
+        self._record("player", live_latency - typical)
+
+    def summary(self):
+        """Median / p95 / latest per stage plus glass-to-segment and glass-to-playback estimates."""
+        stages = {}
+        for stage, samples in self.samples.items():
+            stages[stage] = _describe(samples)
+        medians = [s["median"] for s in stages.values() if s]
+        return {
+            "stages": stages,
+            "glass_to_segment": _describe(self.glass_to_segment),
+            # sum of stage medians: an estimate, since stages are sampled independently
+            "glass_to_playback": round(sum(medians), 3) if stages["player"] else None,
+        }
+
+
+def _describe(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        "median": round(statistics.median(ordered), 3),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        "last": round(samples[-1], 3),
+        "samples": len(ordered),
+    }
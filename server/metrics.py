@@ -0,0 +1,186 @@
+"""
+Minimal Prometheus text-format metrics without external dependencies.
+
+Updates are cheap on the hot path: `inc` and `observe` only append to a deque
+(atomic under the GIL, no lock). The pending updates are folded into totals
+when a scrape reads them, or by the writer that pushes the backlog past
+FOLD_AT, so the fold lock is taken once per few thousand updates, not per chunk.
+"""
+import collections
+import os
+import threading
+
+FOLD_AT = 4096
+
+# Seconds; suits both segment/file serving and segment production times
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{_escape(v)}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._pending = collections.deque()
+        self._fold_lock = threading.Lock()
+
+    def _push(self, item):
+        self._pending.append(item)
+        if len(self._pending) > FOLD_AT:
+            self._fold()
+
+    def _fold(self):
+        with self._fold_lock:
+            pending = self._pending
+            while True:
+                try:
+                    item = pending.popleft()
+                except IndexError:
+                    break
+                self._apply(*item)
+
+    def _apply(self, key, value):
+        raise NotImplementedError
+
+    def lines(self):
+        raise NotImplementedError
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.lines()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        # an unlabelled counter is exposed as 0 before its first increment
+        self._totals = {} if self.labels else {(): 0}
+
+    def inc(self, labelvalues=(), amount=1):
+        self._push((tuple(labelvalues), amount))
+
+    def _apply(self, key, value):
+        if value is None:
+            self._totals.pop(key, None)
+        else:
+            self._totals[key] = self._totals.get(key, 0) + value
+
+    def remove(self, labelvalues):
+        """Forget a series (e.g. a camera that was closed)."""
+        self._push((tuple(labelvalues), None))
+
+    def values(self):
+        self._fold()
+        return dict(self._totals)
+
+    def lines(self):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in sorted(self.values().items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, labelvalues, value):
+        self._push((tuple(labelvalues), value))
+
+    def remove(self, labelvalues):
+        self._push((tuple(labelvalues), None))
+
+    def _apply(self, key, value):
+        if value is None:
+            self._series.pop(key, None)
+            return
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0, 0.0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        series[1] += 1
+        series[2] += value
+
+    def lines(self):
+        self._fold()
+        out = []
+        for key, (counts, count, total) in sorted(self._series.items()):
+            for bound, n in zip(self.buckets, counts):
+                out.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', _format_value(float(bound)))])} {n}")
+            out.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', '+Inf')])} {count}")
+            out.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+            out.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+        return out
+
+
+class Gauge(_Metric):
+    """Read at scrape time from `collect()`, which returns {labelvalues: value}.
+    kind="counter" exposes a monotonic value sampled the same way (e.g. CPU seconds)."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=dict, kind=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        if kind:
+            self.kind = kind
+
+    def lines(self):
+        out = []
+        for key, value in sorted(self.collect().items()):
+            if value is None:
+                continue
+            key = key if isinstance(key, tuple) else (key,)
+            out.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return out
+
+
+def render(metrics):
+    """Prometheus text exposition of the given metrics."""
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") and "SC_CLK_TCK" in os.sysconf_names else 100
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") and "SC_PAGE_SIZE" in os.sysconf_names else 4096
+
+
+def process_stats(pid):
+    """(cpu seconds, resident bytes) of a process from /proc, or None where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+        with open(f"/proc/{pid}/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    # utime and stime are fields 14 and 15; fields[0] here is field 3 (state)
+    cpu = (int(fields[11]) + int(fields[12])) / _CLK_TCK
+    return cpu, resident_pages * _PAGE_SIZE
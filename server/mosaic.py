@@ -0,0 +1,157 @@
+"""
+Server-side mosaic of every live camera, published as one DASH stream.
+
+The mosaic subscribes to the frame tap (see frametap.py), which delivers each
+camera's video scaled to a tile-sized picture at the mosaic frame rate. Only
+every camera's newest frame is kept.
+
+A compositor thread tiles the newest frames into a fixed-size canvas at the
+mosaic frame rate. The grid is recomputed from the cameras present, so tiles
+grow and shrink as cameras join and leave. Tiles are resized with cv2 and
+written into canvas slices. The canvas is fed to a single libx264 encoder that
+writes a windowed DASH stream. The canvas size never changes, so layout changes
+need no encoder restart, and a viewer decodes one stream instead of one per
+camera.
+"""
+import math
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+import cv2
+import numpy as np
+
+MOSAIC_ID = "mosaic"
+DEFAULT_SIZE = (1280, 720)
+DEFAULT_FPS = 10
+SEGMENT_SECONDS = 2
+# Seconds between attempts to restart a mosaic encoder that exited
+RESTART_DELAY = 2
+BACKGROUND = 16
+LABEL_COLOR = (255, 255, 255)
+
+
+def grid(count, width, height):
+    """(columns, rows) for count tiles on a width x height canvas with the largest 16:9 tiles
+    (wider grids win ties)."""
+    if count <= 0:
+        return 0, 0
+    best = None
+    for columns in range(1, count + 1):
+        rows = math.ceil(count / columns)
+        # tile area that fits a 16:9 picture in a cell
+        cell_w, cell_h = width / columns, height / rows
+        area = min(cell_w, cell_h * 16 / 9) * min(cell_h, cell_w * 9 / 16)
+        if best is None or area >= best[0]:
+            best = (area, columns, rows)
+    return best[1], best[2]
+
+
+def layout(cameras, width, height):
+    """[(camera, x, y, w, h)]: each camera's tile rectangle, fitted 16:9 and centred in its cell."""
+    columns, rows = grid(len(cameras), width, height)
+    tiles = []
+    for index, camera in enumerate(cameras):
+        column, row = index % columns, index // columns
+        cell_x, cell_y = column * width // columns, row * height // rows
+        cell_w = (column + 1) * width // columns - cell_x
+        cell_h = (row + 1) * height // rows - cell_y
+        w = min(cell_w, cell_h * 16 // 9)
+        h = min(cell_h, w * 9 // 16)
+        tiles.append((camera, cell_x + (cell_w - w) // 2, cell_y + (cell_h - h) // 2, w, h))
+    return tiles
+
+
+class Mosaic:
+    """Collects camera tile frames and publishes their mosaic as DASH under `directory`."""
+
+    def __init__(self, directory, size=DEFAULT_SIZE, fps=DEFAULT_FPS, window=6, log=print):
+        self.directory = directory
+        self.width, self.height = size
+        self.fps = fps
+        self.window = window
+        self.log = log
+        self.frames = {}
+        self._encoder = None
+        self._canvas = np.empty((self.height, self.width, 3), np.uint8)
+        self._stopped = threading.Event()
+
+    def start(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        encoder = self._encoder
+        if encoder is not None and encoder.poll() is None:
+            try:
+                encoder.stdin.close()
+                encoder.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                encoder.kill()
+
+    def on_frame(self, camera_id, frame):
+        self.frames[camera_id] = frame
+
+    def on_ended(self, camera_id):
+        self.frames.pop(camera_id, None)
+
+    def compose(self):
+        """Draw the current frames into the canvas and return it."""
+        canvas = self._canvas
+        canvas.fill(BACKGROUND)
+        frames = self.frames
+        for camera, x, y, w, h in layout(sorted(frames), self.width, self.height):
+            frame = frames.get(camera)
+            if frame is None or w <= 0 or h <= 0:
+                continue
+            if (h, w) != frame.shape[:2]:
+                frame = cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA if w < frame.shape[1] else cv2.INTER_LINEAR)
+            canvas[y:y + h, x:x + w] = frame
+            cv2.putText(canvas, camera, (x + 6, y + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, LABEL_COLOR, 1, cv2.LINE_AA)
+        if not frames:
+            cv2.putText(canvas, "No live cameras", (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, LABEL_COLOR, 2, cv2.LINE_AA)
+        return canvas
+
+    def encoder_command(self):
+        gop = str(self.fps * SEGMENT_SECONDS)
+        return [
+            "ffmpeg", "-nostats", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{self.width}x{self.height}",
+            # frames are written at wall-clock pace; timestamp them as they arrive
+            "-use_wallclock_as_timestamps", "1",
+            "-i", "pipe:0",
+            "-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency", "-pix_fmt", "yuv420p",
+            "-r", str(self.fps), "-g", gop, "-keyint_min", gop, "-sc_threshold", "0",
+            "-f", "dash", "-use_template", "1", "-use_timeline", "1", "-utc_timing_url", "/clock",
+            "-seg_duration", str(SEGMENT_SECONDS), "-window_size", str(self.window),
+            "-extra_window_size", "4", "-remove_at_exit", "1",
+            "manifest.mpd",
+        ]
+
+    def _loop(self):
+        period = 1 / self.fps
+        while not self._stopped.is_set():
+            self._encoder = subprocess.Popen(self.encoder_command(), stdin=subprocess.PIPE, cwd=self.directory)
+            self.log(f"Publishing {self.width}x{self.height} at {self.fps} fps")
+            next_frame = time.monotonic()
+            try:
+                while not self._stopped.is_set():
+                    self._encoder.stdin.write(self.compose())
+                    next_frame += period
+                    delay = next_frame - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        # behind: drop the missed frames instead of bursting
+                        next_frame = time.monotonic()
+            except (BrokenPipeError, ValueError, OSError) as e:
+                if self._stopped.is_set():
+                    return
+                self.log(f"Encoder exited ({e}); restarting")
+            self._encoder.kill()
+            self._encoder.wait()
+            time.sleep(RESTART_DELAY)
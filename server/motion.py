@@ -0,0 +1,116 @@
+"""
+Motion analysis of live cameras, for the per-segment activity index.
+
+Frames come from the frame tap (see frametap.py). At most `fps` of them per
+second are analysed. Each is reduced to a small blurred grayscale picture
+ANALYSIS_WIDTH pixels wide, which keeps sensor noise and compression artefacts
+out. The frame's activity is the share of pixels that changed by more than
+PIXEL_THRESHOLD grey levels since the previous analysed frame. That is one
+vectorised difference over ~14 000 pixels, so a camera costs well under a
+millisecond per analysed frame.
+
+When a camera finishes a segment, the server asks for the highest activity
+within the segment's time span and stores it in the catalog next to the
+segment. Operators can query the index for the stretches with activity and
+export only those segments.
+
+A camera counts as idle once no frame reached `threshold` for `idle_after`
+seconds; one frame above it makes the camera active again. The server passes
+this on to uploading clients. They drop to their cheapest encoder level
+while idle, which is what keeps empty corridors from being stored at full
+quality (see client/ratecontrol.py).
+"""
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+DEFAULT_FPS = 5
+# Share of changed pixels from which a frame counts as activity
+DEFAULT_THRESHOLD = 0.005
+DEFAULT_IDLE_AFTER = 30
+ANALYSIS_WIDTH = 160
+PIXEL_THRESHOLD = 25
+# Activity samples kept per camera; must cover the longest segment
+HISTORY_SECONDS = 120
+
+
+def prepare(frame, width=ANALYSIS_WIDTH):
+    """Small blurred grayscale copy of a BGR frame for differencing."""
+    height = max(1, frame.shape[0] * width // frame.shape[1])
+    gray = cv2.cvtColor(cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    return cv2.GaussianBlur(gray, (5, 5), 0)
+
+
+def frame_activity(previous, current, pixel_threshold=PIXEL_THRESHOLD):
+    """Share of pixels that changed by more than pixel_threshold between two prepared frames."""
+    return np.count_nonzero(cv2.absdiff(previous, current) > pixel_threshold) / current.size
+
+
+class _CameraMotion:
+    __slots__ = ("previous", "analysed", "active", "samples")
+
+    def __init__(self):
+        self.previous = None
+        self.analysed = 0.0
+        self.active = time.time()
+        # (time, activity), oldest first
+        self.samples = collections.deque()
+
+
+class MotionAnalyzer:
+    """Activity per camera from its tap frames; subscribe it to a FrameTap."""
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, idle_after=DEFAULT_IDLE_AFTER, fps=DEFAULT_FPS):
+        self.threshold = threshold
+        self.idle_after = idle_after
+        self.fps = fps
+        self.frames_analysed = 0
+        self._cameras = {}
+        self._lock = threading.Lock()
+
+    def on_frame(self, camera_id, frame):
+        now = time.time()
+        camera = self._cameras.get(camera_id)
+        if camera is None:
+            camera = self._cameras.setdefault(camera_id, _CameraMotion())
+        # tap frames arrive at the tap's rate; analyse at most fps of them
+        if now - camera.analysed < 0.9 / self.fps:
+            return
+        current = prepare(frame)
+        previous, camera.previous, camera.analysed = camera.previous, current, now
+        if previous is None or previous.shape != current.shape:
+            return
+        activity = frame_activity(previous, current)
+        self.frames_analysed += 1
+        if activity >= self.threshold:
+            camera.active = now
+        with self._lock:
+            camera.samples.append((now, activity))
+            while camera.samples[0][0] < now - HISTORY_SECONDS:
+                camera.samples.popleft()
+
+    def on_ended(self, camera_id):
+        camera = self._cameras.get(camera_id)
+        if camera is not None:
+            # a restarted decoder's first frame is not compared with the old one's last
+            camera.previous = None
+
+    def segment_activity(self, camera_id, start, end):
+        """Highest activity analysed between start and end (epoch seconds), or None without samples."""
+        camera = self._cameras.get(camera_id)
+        if camera is None:
+            return None
+        with self._lock:
+            values = [activity for t, activity in camera.samples if start < t <= end]
+        return max(values) if values else None
+
+    def idle(self, camera_id):
+        """True once the camera showed no activity for idle_after seconds."""
+        camera = self._cameras.get(camera_id)
+        return camera is not None and time.time() - camera.active >= self.idle_after
+
+    def forget(self, camera_id):
+        self._cameras.pop(camera_id, None)
@@ -0,0 +1,313 @@
+"""
+Background garbage collection of archived DASH segments.
+
+Each recording's segments are tracked incrementally: new segments are found by
+probing for the next segment number and old ones are deleted by number, so a
+collection pass never lists or rewrites anything proportional to how long a
+camera has been recording. Finished recordings get their manifest trimmed to
+the segments that are left so they can still be converted. The same timeline
+rewrite cuts a live camera's archive manifest down to its live window.
+"""
+import collections
+import os
+import re
+import shutil
+import threading
+import time
+
+from catalog import STATE_LIVE, STATE_RECORDED
+
+_INIT_RE = re.compile(r"init-stream(\d+)\.m4s$")
+_CHUNK_RE = re.compile(r"chunk-stream(\d+)-(\d+)\.m4s$")
+_TEMPLATE_RE = re.compile(
+    r'(<SegmentTemplate\b[^>]*>)\s*<SegmentTimeline>(.*?)</SegmentTimeline>', re.S)
+_S_RE = re.compile(r'<S\b([^>]*?)/>')
+_ATTR_RE = re.compile(r'(\w+)="([^"]*)"')
+_START_RE = re.compile(r'startNumber="(\d+)"')
+_DURATION_ATTR_RE = re.compile(r'mediaPresentationDuration="[^"]*"')
+_PUBLISH_TIME_RE = re.compile(r'(publishTime="[^"]*")')
+
+
+class RetentionPolicy:
+    """Limits enforced by the collector; None disables a limit."""
+
+    def __init__(self, max_age=None, max_camera_bytes=None, max_total_bytes=None):
+        self.max_age = max_age
+        self.max_camera_bytes = max_camera_bytes
+        self.max_total_bytes = max_total_bytes
+
+    def enabled(self):
+        return any(v is not None for v in (self.max_age, self.max_camera_bytes, self.max_total_bytes))
+
+
+def segment_name(stream, number):
+    return f"chunk-stream{stream}-{number:05d}.m4s"
+
+
+class RecordingSegments:
+    """Archived segments of one recording, oldest first: deque of (number, mtime, bytes)."""
+
+    def __init__(self, camera_id, chunks_dir):
+        self.camera_id = camera_id
+        self.chunks_dir = chunks_dir
+        self.streams = []
+        self.segments = collections.deque()
+        self.bytes = 0
+        self.next_number = None
+        # startNumber last written to (or read from) the archive manifest
+        self.manifest_start = None
+
+    def _bootstrap(self):
+        """One directory listing when tracking starts, to find streams and the segment range."""
+        numbers = []
+        streams = set()
+        try:
+            names = os.listdir(self.chunks_dir)
+        except FileNotFoundError:
+            return False
+        for name in names:
+            match = _INIT_RE.match(name)
+            if match:
+                streams.add(int(match.group(1)))
+                continue
+            match = _CHUNK_RE.match(name)
+            if match and match.group(1) == "0":
+                numbers.append(int(match.group(2)))
+        if not streams:
+            return False
+        self.streams = sorted(streams)
+        self.next_number = min(numbers) if numbers else 1
+        self.manifest_start = manifest_start_number(os.path.join(self.chunks_dir, "manifest.mpd"))
+        return True
+
+    def refresh(self, live):
+        """Pick up segments written since the last pass. While live, the newest
+        segment may still be growing, so it is only counted once its successor exists."""
+        if not self.streams and not self._bootstrap():
+            return
+        while True:
+            stats = self._stat(self.next_number)
+            if stats is None:
+                break
+            if live and self._stat(self.next_number + 1) is None:
+                break
+            mtime, size = stats
+            self.segments.append((self.next_number, mtime, size))
+            self.bytes += size
+            self.next_number += 1
+
+    def _stat(self, number):
+        mtime, size = None, 0
+        for stream in self.streams:
+            try:
+                st = os.stat(os.path.join(self.chunks_dir, segment_name(stream, number)))
+            except FileNotFoundError:
+                if stream == self.streams[0]:
+                    return None
+                continue
+            mtime = st.st_mtime if mtime is None else max(mtime, st.st_mtime)
+            size += st.st_size
+        return mtime, size
+
+    def oldest_mtime(self):
+        return self.segments[0][1] if self.segments else None
+
+    def delete_oldest(self):
+        number, _, size = self.segments.popleft()
+        for stream in self.streams:
+            try:
+                os.remove(os.path.join(self.chunks_dir, segment_name(stream, number)))
+            except FileNotFoundError:
+                pass
+        self.bytes -= size
+        return size
+
+    def first_number(self):
+        return self.segments[0][0] if self.segments else self.next_number
+
+
+def manifest_start_number(manifest_path):
+    """startNumber of the first SegmentTemplate in an MPD, or None."""
+    try:
+        with open(manifest_path, encoding="utf-8", errors="ignore") as f:
+            match = _START_RE.search(f.read(8192))
+    except OSError:
+        return None
+    return int(match.group(1)) if match else None
+
+
+def _rewrite_timelines(mpd, select):
+    """Rewrite every SegmentTimeline of an MPD to the entries select(entries, start_number)
+    returns as (entries, start_number); entries are (t, d) pairs. Returns the new MPD and
+    each timeline's remaining duration in seconds."""
+    durations = []
+
+    def rewrite_template(match):
+        template, timeline = match.group(1), match.group(2)
+        attrs = dict(_ATTR_RE.findall(template))
+        start = int(attrs.get("startNumber", "1"))
+        timescale = int(attrs.get("timescale", "1"))
+        entries = []
+        t = 0
+        for s in _S_RE.finditer(timeline):
+            s_attrs = dict(_ATTR_RE.findall(s.group(1)))
+            t = int(s_attrs.get("t", t))
+            d = int(s_attrs["d"])
+            for _ in range(int(s_attrs.get("r", "0")) + 1):
+                entries.append((t, d))
+                t += d
+        entries, start = select(entries, start)
+        durations.append(sum(d for _, d in entries) / timescale)
+        lines = []
+        for t, d in entries:
+            if lines and lines[-1][1] == d and lines[-1][0] + d * (lines[-1][2] + 1) == t:
+                lines[-1][2] += 1
+            else:
+                lines.append([t, d, 0])
+        body = "".join(
+            f'\n\t\t\t\t\t\t<S t="{t}" d="{d}"' + (f' r="{r}"' if r else "") + " />" for t, d, r in lines
+        )
+        template = _START_RE.sub(f'startNumber="{start}"', template)
+        return f"{template}\n\t\t\t\t\t<SegmentTimeline>{body}\n\t\t\t\t\t</SegmentTimeline>"
+
+    return _TEMPLATE_RE.sub(rewrite_template, mpd), durations
+
+
+def trim_manifest(manifest_path, first_number):
+    """Drop timeline entries before segment first_number from a static MPD.
+    Returns the remaining duration in seconds, or None if the manifest is unusable."""
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            mpd = f.read()
+    except OSError:
+        return None
+    mpd, durations = _rewrite_timelines(
+        mpd, lambda entries, start: (entries[max(0, first_number - start):], max(start, first_number)))
+    if not durations:
+        return None
+    duration = durations[0]
+    mpd = _DURATION_ATTR_RE.sub(f'mediaPresentationDuration="PT{duration:.1f}S"', mpd, count=1)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(mpd)
+    os.replace(tmp_path, manifest_path)
+    return duration
+
+
+def window_manifest(mpd, segments):
+    """A live MPD listing only the last `segments` segments of a dynamic archive MPD, with
+    the matching timeShiftBufferDepth. Players then refresh a manifest of constant size."""
+    mpd, durations = _rewrite_timelines(
+        mpd, lambda entries, start: (entries[-segments:], start + max(0, len(entries) - segments)))
+    if durations:
+        mpd = _PUBLISH_TIME_RE.sub(rf'\1\n\ttimeShiftBufferDepth="PT{durations[0]:.1f}S"', mpd, count=1)
+    return mpd
+
+
+class SegmentCollector:
+    """Enforces a RetentionPolicy over chunks/ every `interval` seconds.
+
+    Recordings come from the catalog; those still marked live are being written
+    by ffmpeg. is_busy(camera_id) protects recordings that are being converted.
+    """
+
+    def __init__(self, chunks_root, policy, catalog, is_busy=lambda camera_id: False, interval=30, log=print):
+        self.chunks_root = chunks_root
+        self.policy = policy
+        self.catalog = catalog
+        self.is_busy = is_busy
+        self.live = set()
+        self.interval = interval
+        self.log = log
+        self.recordings = {}
+        # cameras whose directory was replaced (decoder restart); re-tracked from scratch
+        self._reset = set()
+        self.deleted_bytes = 0
+        self.deleted_segments = 0
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                self.log(f"Collection failed: {e}")
+            time.sleep(self.interval)
+
+    def reset(self, camera_id):
+        """Forget what is known about a recording's segments, e.g. after its directory was moved."""
+        self._reset.add(camera_id)
+
+    def _track(self):
+        while self._reset:
+            self.recordings.pop(self._reset.pop(), None)
+        rows, _ = self.catalog.query(STATE_LIVE)
+        self.live = {row["camera_id"] for row in rows}
+        rows, _ = self.catalog.query(STATE_RECORDED)
+        ids = self.live | {row["camera_id"] for row in rows}
+        for camera_id in list(self.recordings):
+            if camera_id not in ids:
+                del self.recordings[camera_id]
+        for camera_id in ids:
+            rec = self.recordings.get(camera_id)
+            if rec is None:
+                rec = self.recordings[camera_id] = RecordingSegments(
+                    camera_id, os.path.join(self.chunks_root, camera_id))
+            rec.refresh(camera_id in self.live)
+
+    def collect(self):
+        """One collection pass. Returns the number of segments deleted."""
+        self._track()
+        policy = self.policy
+        now = time.time()
+        candidates = [rec for rec in self.recordings.values() if not self.is_busy(rec.camera_id)]
+        touched = set()
+        deleted = 0
+        for rec in candidates:
+            while rec.segments and (
+                (policy.max_age is not None and rec.oldest_mtime() < now - policy.max_age)
+                or (policy.max_camera_bytes is not None and rec.bytes > policy.max_camera_bytes)
+            ):
+                self.deleted_bytes += rec.delete_oldest()
+                deleted += 1
+                touched.add(rec)
+        if policy.max_total_bytes is not None:
+            total = sum(rec.bytes for rec in self.recordings.values())
+            while total > policy.max_total_bytes:
+                oldest = min((rec for rec in candidates if rec.segments), key=RecordingSegments.oldest_mtime,
+                             default=None)
+                if oldest is None:
+                    break
+                size = oldest.delete_oldest()
+                total -= size
+                self.deleted_bytes += size
+                deleted += 1
+                touched.add(oldest)
+        self.deleted_segments += deleted
+        for rec in candidates:
+            # also catches recordings trimmed while live once ffmpeg has written their final manifest
+            if rec in touched or rec.manifest_start != rec.first_number():
+                self._finish(rec, rec in touched)
+        if deleted:
+            self.log(f"Deleted {deleted} segments ({len(touched)} recordings)")
+        return deleted
+
+    def _finish(self, rec, trimmed):
+        """Bring a finished recording's manifest and catalog entry in line with its remaining segments."""
+        if rec.camera_id in self.live or not rec.streams:
+            return
+        if not rec.segments:
+            if not trimmed:
+                return
+            shutil.rmtree(rec.chunks_dir, ignore_errors=True)
+            self.catalog.recording_removed(rec.camera_id)
+            del self.recordings[rec.camera_id]
+            self.log(f"Removed {rec.camera_id}: no segments left")
+            return
+        first = rec.first_number()
+        if rec.manifest_start != first:
+            duration = trim_manifest(os.path.join(rec.chunks_dir, "manifest.mpd"), first)
+            rec.manifest_start = first
+            self.catalog.update_stats(rec.camera_id, len(rec.segments), rec.bytes, duration)
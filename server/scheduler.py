@@ -0,0 +1,239 @@
+"""
+Bounded, prioritised job queue for recording conversions.
+
+At most `max_workers` conversions run at once; the rest wait in a priority
+queue (higher priority first, FIFO within a priority). Conversion ffmpeg
+processes run at a lower CPU priority and, optionally, pinned to a subset of
+cores so they never starve the live ingest encoders. A re-encoded excerpt
+runs as up to `piece_workers` ffmpeg processes of its own (see conversion.py).
+
+Every change of a job is passed to `on_update` as it happens: queued (with
+its position), in_progress (with each progress report) and finally
+completed, failed or cancelled. The server publishes these on its event bus.
+"""
+import heapq
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import conversion
+
+STATE_QUEUED = "queued"
+STATE_RUNNING = "in_progress"
+# Final states, only ever passed to on_update
+STATE_COMPLETED = "completed"
+STATE_FAILED = "failed"
+STATE_CANCELLED = "cancelled"
+
+
+class ConversionJob:
+    """One queued or running conversion of chunks/<camera_id> (or an excerpt of it) into an MP4."""
+
+    def __init__(self, camera_id, manifest_path, output_path, mode, priority, excerpt=None):
+        self.camera_id = camera_id
+        self.manifest_path = manifest_path
+        self.output_path = output_path
+        self.mode = mode
+        self.priority = priority
+        # a conversion.Excerpt for part of the recording, None for all of it
+        self.excerpt = excerpt
+        self.state = STATE_QUEUED
+        self.submitted = time.time()
+        self.progress = {"percent": None, "speed": None, "eta": None, "out_time": None}
+        self.cancel_event = threading.Event()
+        # every ffmpeg the job started; an excerpt re-encode runs several at once
+        self.procs = []
+
+    def snapshot(self):
+        return {
+            "camera_id": self.camera_id,
+            "state": self.state,
+            "mode": self.mode,
+            "priority": self.priority,
+            "submitted": self.submitted,
+            **self.progress,
+        }
+
+
+class ConversionScheduler:
+    def __init__(self, max_workers=1, nice=10, cpus=None, log=print, on_finished=None, piece_workers=1,
+                 on_update=None):
+        self.max_workers = max(1, max_workers)
+        self.piece_workers = max(1, piece_workers)
+        self.nice = nice
+        self.cpus = cpus
+        self.log = log
+        # Called with the job after its MP4 has been written
+        self.on_finished = on_finished
+        # Called with {"status", "camera_id", ...} whenever a job changes (see status())
+        self.on_update = on_update
+        self._heap = []
+        self._seq = itertools.count()
+        self._jobs = {}
+        self._cond = threading.Condition()
+        for _ in range(self.max_workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, camera_id, manifest_path, output_path, mode=conversion.MODE_AUTO, priority=0,
+               excerpt=None):
+        """Queue a conversion (of only the excerpt, if given). Raises RuntimeError if the camera
+        is already queued or running."""
+        with self._cond:
+            if camera_id in self._jobs:
+                raise RuntimeError(f"Conversion already in progress for {camera_id}")
+            job = ConversionJob(camera_id, manifest_path, output_path, mode, priority, excerpt)
+            job.seq = next(self._seq)
+            self._jobs[camera_id] = job
+            heapq.heappush(self._heap, (-priority, job.seq, job))
+            self._cond.notify()
+        self._notify(job)
+        return job
+
+    def cancel(self, camera_id):
+        """Drop a queued job or kill a running one. Returns False if there was none."""
+        with self._cond:
+            job = self._jobs.pop(camera_id, None)
+            if job is None:
+                return False
+            job.cancel_event.set()
+            procs = list(job.procs)
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+        self.log(f"Cancelled {camera_id}")
+        self._notify(job, STATE_CANCELLED)
+        self._notify_queue()
+        return True
+
+    def is_active(self, camera_id):
+        with self._cond:
+            return camera_id in self._jobs
+
+    def status(self, camera_id):
+        """Snapshot of a queued/running job (queued ones include their 1-based position), or None."""
+        with self._cond:
+            job = self._jobs.get(camera_id)
+            if job is None:
+                return None
+            snap = job.snapshot()
+            if job.state == STATE_QUEUED:
+                snap["position"] = self._queued_locked().index(job) + 1
+            return snap
+
+    def jobs(self):
+        """Running jobs, then queued jobs in the order they will start."""
+        with self._cond:
+            running = [j.snapshot() for j in self._jobs.values() if j.state == STATE_RUNNING]
+            queued = []
+            for position, job in enumerate(self._queued_locked(), start=1):
+                queued.append({**job.snapshot(), "position": position})
+            return running + queued
+
+    def _queued_locked(self):
+        return [job for _, _, job in sorted(self._heap) if not job.cancel_event.is_set()]
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                while self._heap:
+                    _, _, job = heapq.heappop(self._heap)
+                    if not job.cancel_event.is_set():
+                        job.state = STATE_RUNNING
+                        return job
+                self._cond.wait()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            self._notify(job)
+            self._notify_queue()
+            final = None
+            try:
+                self.log(f"Starting conversion for {job.camera_id} ({job.mode})")
+                used = conversion.convert_recording(
+                    job.manifest_path, job.output_path, job.mode,
+                    on_progress=lambda p, job=job: self._on_progress(job, p),
+                    log=lambda msg, job=job: self.log(f"{job.camera_id}: {msg}"),
+                    on_start=lambda proc, job=job: self._on_start(job, proc),
+                    cancel_event=job.cancel_event,
+                    popen_kwargs=self._popen_kwargs(),
+                    excerpt=job.excerpt,
+                    workers=self.piece_workers,
+                    # its own: a cancelled job still cleaning up must not touch a resubmitted one's file
+                    part_path=f"{job.output_path}.{job.seq}.part"
+                )
+                self.log(f"Finished converting {job.camera_id} -> {job.output_path} ({used})")
+                if self.on_finished:
+                    self.on_finished(job)
+                final = (STATE_COMPLETED, {"mode": used, "output": os.path.basename(job.output_path)})
+            except conversion.ConversionCancelled:
+                pass
+            except Exception as e:
+                self.log(f"Exception while converting {job.camera_id}: {e}")
+                final = (STATE_FAILED, {"error": str(e)})
+            finally:
+                with self._cond:
+                    if self._jobs.get(job.camera_id) is job:
+                        del self._jobs[job.camera_id]
+            # only now, so a download right after "completed" finds the job gone
+            if final:
+                self._notify(job, final[0], **final[1])
+
+    def _on_start(self, job, proc):
+        self._lower_priority(proc)
+        with self._cond:
+            job.procs.append(proc)
+        # cancel() may have run before the process existed
+        if job.cancel_event.is_set() and proc.poll() is None:
+            proc.kill()
+
+    def _on_progress(self, job, progress):
+        with self._cond:
+            job.mode = progress.pop("mode", job.mode)
+            job.progress.update(progress)
+        self._notify(job)
+
+    def _notify(self, job, state=None, **fields):
+        """Pass a job's current status, or the final state with fields, to on_update."""
+        if self.on_update is None:
+            return
+        if state is None:
+            status = self.status(job.camera_id)
+            if status is None:
+                return
+            state = status.pop("state")
+            fields = status
+        self.on_update({"status": state, "camera_id": job.camera_id, **fields})
+
+    def _notify_queue(self):
+        """Every queued job moved up a place."""
+        if self.on_update is None:
+            return
+        with self._cond:
+            queued = self._queued_locked()
+        for job in queued:
+            self._notify(job)
+
+    def _popen_kwargs(self):
+        if sys.platform == "win32":
+            return {"creationflags": subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+        return {}
+
+    def _lower_priority(self, proc):
+        """Run a conversion ffmpeg below normal priority (and on the configured cores) so live
+        cameras win. Set on the started process rather than in a preexec_fn, which can deadlock
+        the child of a threaded server; ffmpeg only starts its codec threads (which inherit
+        both) once it has probed its input, well after this."""
+        if sys.platform == "win32":
+            return
+        try:
+            if self.nice:
+                os.setpriority(os.PRIO_PROCESS, proc.pid, min(19, os.getpriority(os.PRIO_PROCESS, 0) + self.nice))
+            if self.cpus and hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(proc.pid, self.cpus)
+        except OSError:
+            # already exited, or not permitted here
+            pass
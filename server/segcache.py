@@ -0,0 +1,183 @@
+"""
+In-memory cache of recently written DASH files for /dash serving.
+
+Every viewer of a live camera fetches the same few files: the manifest after
+each segment and the newest segment. `SegmentCache` keeps them in memory,
+least recently used first out, up to a byte budget. A wall of viewers then
+costs one disk read per file instead of one per viewer and file.
+
+Entries are keyed by path and checked against the file's (mtime, size) on
+every lookup. The caller already stats the file to resolve the request, so a
+rewritten manifest or a reused segment name after a decoder restart is never
+served stale. The same pair is the ETag, so unchanged files can be answered
+with 304 without hashing the body. A file the cache would not keep (too large
+for its share of the budget, or the cache is off) is not read at all: it is
+described by an `UncachedFile` and the engine sends it from disk.
+
+Low-latency cameras are packaged in streaming mode: ffmpeg writes each
+segment to <name>.tmp fragment by fragment and renames it when the segment is
+complete. `GrowingSegment` serves such a segment while it is still being
+written; it is never cached.
+"""
+import collections
+import os
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+# Files larger than this share of the budget are served but not cached
+MAX_ENTRY_SHARE = 8
+
+
+class CachedFile:
+    __slots__ = ("data", "mtime_ns", "size", "etag")
+
+    def __init__(self, data, mtime_ns):
+        self.data = data
+        self.mtime_ns = mtime_ns
+        self.size = len(data)
+        self.etag = file_etag(mtime_ns, len(data))
+
+    def matches(self, st):
+        return st.st_mtime_ns == self.mtime_ns and st.st_size == self.size
+
+
+class UncachedFile:
+    """A file the cache would not keep; engines send it from path (with sendfile where
+    they can) instead of reading it into memory."""
+    __slots__ = ("path", "etag")
+
+    def __init__(self, path, st):
+        self.path = path
+        self.etag = file_etag(st.st_mtime_ns, st.st_size)
+
+
+def file_etag(mtime_ns, size):
+    return f'"{mtime_ns:x}-{size:x}"'
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value lists etag (or is "*")."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # weak comparison: W/"x" matches "x"
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+class SegmentCache:
+    """Thread-safe LRU of file contents, bounded by total bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, st):
+        """Cached entry for path if it still matches the stat result st, else None."""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.matches(st):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def load(self, path):
+        """Read path from disk and cache it; returns the entry, or None if the file is gone.
+        The file is stat'ed around the read, so a file rewritten meanwhile is not cached."""
+        try:
+            with open(path, "rb") as f:
+                before = os.fstat(f.fileno())
+                data = f.read()
+            after = os.stat(path)
+        except OSError:
+            return None
+        entry = CachedFile(data, before.st_mtime_ns)
+        if after.st_ino == before.st_ino and entry.matches(after):
+            self.put(path, entry)
+        return entry
+
+    def holds(self, size):
+        """True if a file of size bytes would be cached."""
+        return bool(self.max_bytes) and size <= self.max_bytes // MAX_ENTRY_SHARE
+
+    def put(self, path, entry):
+        if not self.holds(entry.size):
+            return
+        with self._lock:
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self.bytes -= previous.size
+            self._entries[path] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.size
+
+    def discard(self, prefix):
+        """Drop every entry under the directory prefix (a camera that closed or restarted)."""
+        prefix = os.path.join(prefix, "")
+        with self._lock:
+            for path in [p for p in self._entries if p.startswith(prefix)]:
+                self.bytes -= self._entries.pop(path).size
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+class GrowingSegment:
+    """A segment ffmpeg is still writing to <path>.tmp, read as it grows until ffmpeg
+    renames it to path. Engines call read() until done, sleeping POLL_SECONDS when it
+    returns nothing, or iterate it (blocking)."""
+
+    POLL_SECONDS = 0.02
+
+    def __init__(self, file, path, idle_timeout):
+        self.file = file
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.grown = time.monotonic()
+
+    @classmethod
+    def open(cls, path, idle_timeout):
+        """The in-progress segment for path, or None if ffmpeg is not writing it."""
+        try:
+            return cls(open(path + ".tmp", "rb", buffering=0), path, idle_timeout)
+        except OSError:
+            return None
+
+    def read(self):
+        """(data, done): bytes written since the last call, and whether the segment is
+        complete (or stopped growing for idle_timeout)."""
+        data = self.file.readall()
+        now = time.monotonic()
+        if data:
+            self.grown = now
+            return data, False
+        if os.path.exists(self.path):
+            # renamed: the open file is the finished segment, read what is left of it
+            return self.file.readall(), True
+        return b"", now - self.grown > self.idle_timeout
+
+    def close(self):
+        self.file.close()
+
+    def __iter__(self):
+        try:
+            while True:
+                data, done = self.read()
+                if data:
+                    yield data
+                if done:
+                    return
+                if not data:
+                    time.sleep(self.POLL_SECONDS)
+        finally:
+            self.close()
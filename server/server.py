@@ -1,5 +1,6 @@
-from flask import Flask, request, send_from_directory, render_template
+from flask import Flask, request, send_file, send_from_directory, render_template
 import subprocess
+import shutil
 import threading
 import cv2
 import numpy as np
@@ -9,107 +10,866 @@ import argparse
 import signal
 import sys
 import time
+import json
 import logging
+import datetime
+import mimetypes
+import stat
+
+from ingest_buffer import IngestBuffer, POLICIES, POLICY_BLOCK
+from h264 import parse_sps, is_browser_playable, KeyframeGate
+import conversion
+from scheduler import ConversionScheduler
+from catalog import RecordingCatalog, STATES as RECORDING_STATES, STATE_RECORDED
+from retention import RetentionPolicy, SegmentCollector, segment_name, window_manifest
+from metrics import Counter, Gauge, Histogram, render as render_metrics_text, process_stats
+from latency import CameraLatency, STAGES as LATENCY_STAGES
+from supervisor import EncoderSupervisor, CapacityError
+from snapshots import SnapshotCache, FORMATS as SNAPSHOT_FORMATS
+from events import EventBus, Subscription, sse_message
+from tiering import SegmentMover, DEFAULT_DELAY as DEFAULT_RAM_FLUSH_DELAY, DEFAULT_BATCH_BYTES as DEFAULT_RAM_FLUSH_BATCH
+from mosaic import Mosaic, MOSAIC_ID, DEFAULT_SIZE as DEFAULT_MOSAIC_SIZE, DEFAULT_FPS as DEFAULT_MOSAIC_FPS
+from frametap import FrameTap
+from motion import MotionAnalyzer, DEFAULT_THRESHOLD as DEFAULT_MOTION_THRESHOLD, DEFAULT_IDLE_AFTER as DEFAULT_MOTION_IDLE_AFTER
+from motion import DEFAULT_FPS as DEFAULT_MOTION_FPS
+from segcache import (SegmentCache, GrowingSegment, UncachedFile, etag_matches,
+                      DEFAULT_MAX_BYTES as DEFAULT_DASH_CACHE_BYTES)
 
 template_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../client/web"))
 app = Flask(__name__, template_folder=template_dir)
 
-active_conversions = {}
-active_conversions_lock = threading.Lock()
+# Created in main() once --max-conversions and friends are known
+conversion_scheduler = None
+# Recording index behind /info (see catalog.py), opened in main() or on first use
+recording_catalog = None
+# Deletes archived segments per RETENTION (see retention.py); only runs when a limit is set
+segment_collector = None
+# Moves live cameras' segments from the RAM tier to chunks/ (--ram-dir); None keeps them on disk
+segment_mover = None
+# Admission control and crash recovery for camera decoders (see supervisor.py), built in main() or on first use
+encoder_supervisor = None
 
 camera_streams = {}
-telemetry_data_amounts = {}
-telemetry_data_locks = {}
+camera_streams_lock = threading.Lock()
+# Notified when a camera's decoder is replaced after a crash or the camera is closed
+decoders_changed = threading.Condition(camera_streams_lock)
+camera_decoders = {}
+camera_packaging = {}
+# camera -> (ffmpeg command, chunks dir, encoder kind), to restart a crashed decoder identically
+camera_commands = {}
+# Cameras currently encoding the full bitrate ladder (bounded by MAX_LADDER_ENCODES)
+ladder_cameras = set()
+# Cameras packaged as chunked CMAF for low-latency live viewing
+low_latency_cameras = set()
+# Closed cameras whose decoder is still writing its last segments; not reopened until indexed
+finalizing_cameras = set()
+# Cameras whose crashed decoder's files restart_decoder is moving aside
+restarting_cameras = set()
+streaming_ingests = set()
+streaming_ingests_lock = threading.Lock()
+# Latest fps/speed/frame from each decoder's -progress output (one writer per camera)
+camera_encoder_stats = {}
+# camera -> {client address: last /dash request time}
+dash_viewers = {}
+# camera -> CameraLatency following the capture timestamps in its stream
+camera_latency = {}
+# Hot manifests and segments for /dash (see segcache.py); replaced in main()
+segment_cache = SegmentCache()
+# Tiled stream of all live cameras at /dash/mosaic/ (see mosaic.py); None unless --mosaic
+mosaic = None
+# Per-segment activity of live cameras (see motion.py); None unless --motion
+motion_analyzer = None
+# Small raw frames of every camera for the two above (see frametap.py); None if neither is on
+frame_tap = None
+# Latest thumbnail per live camera for /snapshot (see snapshots.py); replaced in main()
+snapshot_cache = SnapshotCache(log=lambda msg: print(f"[Snapshot] {msg}"))
+# Camera, recording, segment and conversion changes for /events (see events.py)
+event_bus = EventBus()
+# Called after stop_all_streams queues the close sentinels (the async engine wakes its writers)
+stop_callbacks = []
+# Called with the camera id after close_camera queues its close sentinel, from whichever
+# thread closed it (a DELETE, or the supervisor giving up on a crashing decoder)
+close_callbacks = []
 
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
 SERVER_ROOT = os.path.abspath(os.path.dirname(__file__))
+# Outside chunks/ so the catalog and retention never treat the mosaic as a recording
+MOSAIC_DIR = os.path.join(SERVER_ROOT, "mosaic")
+CATALOG_PATH = os.path.join(SERVER_ROOT, "catalog.sqlite3")
+# Excerpts of recordings (e.g. only their segments with activity), next to converted/
+EXPORTS_DIR = os.path.join(SERVER_ROOT, "exports")
+# Seconds to wait for a closed camera's ffmpeg to finish its manifest before indexing it
+RECORDING_FINALIZE_TIMEOUT = 30
+
+# Read size for the long-lived /ingest channel. The dev server's dechunker only
+# returns once the buffer is full, so keep this small to keep latency low.
+INGEST_READ_SIZE = 4096
+
+# Per-camera ingest buffer bound and overflow policy (see ingest_buffer.py)
+INGEST_BUFFER_BYTES = 8 * 1024 * 1024
+INGEST_POLICY = POLICY_BLOCK
+# Seconds a blocked uploader is told to wait before retrying
+INGEST_RETRY_AFTER = 1
+
+# How uploads become DASH: re-encode, stream-copy the client's H.264, or copy
+# when the stream is browser-playable and re-encode otherwise.
+PACKAGING_TRANSCODE = "transcode"
+PACKAGING_COPY = "copy"
+PACKAGING_AUTO = "auto"
+PACKAGING_MODES = (PACKAGING_TRANSCODE, PACKAGING_COPY, PACKAGING_AUTO)
+PACKAGING_MODE = PACKAGING_TRANSCODE
+# Frame rate assumed for uploads that don't send a Camera-FPS header
+DEFAULT_FPS = 30
+
+# Adaptive bitrate ladder: (max height, video bitrate) per rendition, highest first.
+# Rungs taller than the source are capped at the source height.
+DEFAULT_LADDER = "1080:5000k,720:2500k,360:800k"
+LADDER = None
+# Whether cameras get the ladder unless their ABR-Ladder header says otherwise
+ABR_DEFAULT = False
+# Ladder encodes cost several libx264 instances each; cameras beyond this get one rendition
+MAX_LADDER_ENCODES = 2
+
+# Live viewers get a manifest of the last LIVE_WINDOW_SEGMENTS segments under /dash/<id>/live/,
+# cut from the archive manifest on request (see live_manifest). 0 serves the archive manifest live.
+LIVE_WINDOW_SEGMENTS = 6
+# A low-latency camera's live window is written by ffmpeg to chunks/<id>/live/ instead;
+# segments kept there past the window for players that are behind
+LIVE_WINDOW_EXTRA = 4
+LIVE_DIR = "live"
+# camera id -> (archive manifest ETag, live manifest body) of the last live window served
+live_manifests = {}
+
+# Low-latency live mode (opt-in per camera): the live output is chunked CMAF. Segments of
+# LL_SEGMENT_SECONDS are written in LL_FRAGMENT_SECONDS fragments, and /dash streams a segment
+# to players while ffmpeg is still writing it. The manifest asks players to stay
+# LL_TARGET_LATENCY behind live, adjusting their playback rate within LL_PLAYBACK_RATES.
+LOW_LATENCY_DEFAULT = False
+LL_SEGMENT_SECONDS = 2
+LL_FRAGMENT_SECONDS = 0.2
+LL_TARGET_LATENCY = 1.5
+LL_PLAYBACK_RATES = (0.9, 1.1)
+# Seconds an in-progress segment may stop growing before its response is ended
+LL_SEGMENT_IDLE_TIMEOUT = 5
+
+RETENTION = RetentionPolicy()
+GC_INTERVAL = 30
+
+# A client counts as viewing a camera if it fetched one of its /dash files this recently
+VIEWER_WINDOW = 10
+
+# Memory for recently written manifests and segments served to /dash viewers (0 disables)
+DASH_CACHE_BYTES = DEFAULT_DASH_CACHE_BYTES
+# Segment names never change content; manifests are revalidated on every refresh (a cheap 304)
+SEGMENT_CACHE_CONTROL = "public, max-age=86400, immutable"
+MANIFEST_CACHE_CONTROL = "no-cache"
+DASH_CONTENT_TYPES = {".mpd": "application/dash+xml", ".m4s": "video/iso.segment"}
+
+# Decoder admission: a fixed cap (None for no cap) and the share of all CPUs kept idle
+MAX_ENCODERS = None
+CPU_RESERVE = 0.1
+CPU_ADMISSION = True
+# Crashed decoders are restarted up to MAX_RESTARTS times per RESTART_WINDOW seconds
+MAX_RESTARTS = 3
+RESTART_WINDOW = 60
+# Seconds a fed decoder may go without progress before it is killed and restarted
+STALL_TIMEOUT = 20
+# Seconds ingest waits for a crashed decoder's replacement before giving up on the camera
+DECODER_RESTART_WAIT = 10
+EVENT_TOPICS = ("camera", "recording", "segment", "conversion")
+# Seconds between comments on an idle event stream, so dead connections are noticed
+EVENTS_KEEPALIVE = 15
+
+INGEST_BYTES = Counter("multiflow_ingest_bytes_total", "Encoded bytes received per camera", ("camera",))
+UPLOAD_REQUESTS = Counter("multiflow_upload_requests_total", "POST /upload requests per camera and response status",
+                          ("camera", "status"))
+INGEST_DROPPED_BYTES = Counter("multiflow_ingest_dropped_bytes_total", "Bytes a camera's ingest buffer has dropped",
+                               ("camera",))
+# Not write latency: about the segment duration, and longer while the encoder falls behind real time
+SEGMENT_INTERVAL_SECONDS = Histogram("multiflow_segment_interval_seconds",
+                                     "Wall-clock time between consecutive segments of a camera", ("camera",),
+                                     buckets=(0.5, 1, 2, 3, 4, 5, 6, 8, 10, 15, 30, 60))
+DASH_REQUEST_SECONDS = Histogram("multiflow_dash_request_seconds", "Time to answer a /dash request", ("kind",))
+LATENCY_SECONDS = Histogram("multiflow_latency_seconds", "Glass-to-playback latency per camera and stage",
+                            ("camera", "stage"), buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60))
+CONVERSIONS_FINISHED = Counter("multiflow_conversions_finished_total", "Recordings converted to MP4")
+DECODER_RESTARTS = Counter("multiflow_decoder_restarts_total", "Camera decoders restarted after crashing or stalling",
+                           ("camera",))
+ADMISSION_REJECTIONS = Counter("multiflow_admission_rejections_total", "New cameras refused for lack of capacity")
 
 
-def writer_thread(ffmpeg, frame_queue):
-    """Continuously feed encoded chunks into ffmpeg stdin."""
+def writer_thread(ffmpeg, frame_queue, camera_id=None):
+    """Continuously feed encoded chunks into ffmpeg stdin, moving on to the
+    replacement decoder if this one crashes."""
+    gate = None
     while True:
         try:
             chunk = frame_queue.get(timeout=1)
             if chunk is None:
                 ffmpeg.stdin.close()
                 break
+            if gate is not None:
+                # a restarted decoder starts on the camera's next keyframe
+                chunk = gate(chunk)
+                if gate.open:
+                    gate = None
+                if not chunk:
+                    continue
             ffmpeg.stdin.write(chunk)
+            record_written(camera_id, chunk)
         except queue.Empty:
             continue
         except BrokenPipeError as e:
-            print("FFmpeg process ended:", e)
-            break
+            replacement = wait_for_decoder(camera_id, ffmpeg) if camera_id is not None else None
+            if replacement is None:
+                print("FFmpeg process ended:", e)
+                break
+            ffmpeg, gate = replacement, KeyframeGate()
 
-def start_decoder(camera_id):
-    """Start a new ffmpeg decoder process and threads for a camera."""
-    # Ensure chunks/ are created under the server package directory
-    chunks_dir = os.path.join(SERVER_ROOT, "chunks", camera_id)
-    os.makedirs(chunks_dir, exist_ok=True)
-    ffmpeg_cmd = [
-        "ffmpeg",
-        # Ensure ffmpeg generates proper PTS when reading from a pipe
-        "-fflags", "+genpts",
-        # Use wallclock timestamps to keep segment timing consistent for live
-        "-use_wallclock_as_timestamps", "1",
-        "-i", "pipe:0",
-        # Low-latency encoding settings
+def parse_ladder(spec):
+    """Parse "1080:5000k,720:2500k" (a trailing p on heights is allowed) into [(1080, "5000k"), ...]."""
+    ladder = []
+    for rung in spec.split(","):
+        height, _, bitrate = rung.strip().partition(":")
+        height = int(height.rstrip("pP"))
+        if height <= 0 or not bitrate:
+            raise ValueError(f"Invalid ladder rung {rung!r}")
+        ladder.append((height, bitrate))
+    if not ladder:
+        raise ValueError("Empty ladder")
+    return ladder
+
+def _ladder_args(ladder, fps):
+    """Split, scale and encode one rendition per rung into a single adaptation set."""
+    outputs = "".join(f"[s{i}]" for i in range(len(ladder)))
+    graph = [f"[0:v]split={len(ladder)}{outputs}"]
+    maps = []
+    rate_args = []
+    for i, (height, bitrate) in enumerate(ladder):
+        graph.append(f"[s{i}]scale=-2:min(ih\\,{height})[v{i}]")
+        maps += ["-map", f"[v{i}]"]
+        rate_args += [f"-b:v:{i}", bitrate, f"-maxrate:v:{i}", bitrate, f"-bufsize:v:{i}", bitrate]
+    return [
+        "-filter_complex", ";".join(graph),
+        *maps,
         "-c:v", "libx264",
         "-preset", "ultrafast",
         "-tune", "zerolatency",
-        # Force a frame rate to stabilize segment durations (matching your source fps)
-        "-r", "30",
-        "-c:a", "aac",
-        "-f", "dash",
-        "-use_template", "1",
-        "-use_timeline", "1",
-        os.path.join(chunks_dir, "manifest.mpd")
+        "-r", str(fps),
+        # Identical, fixed GOPs keep segments aligned so players can switch renditions
+        "-g", str(fps * 2),
+        "-keyint_min", str(fps * 2),
+        "-sc_threshold", "0",
+        *rate_args,
     ]
-    ffmpeg = subprocess.Popen(
-        ffmpeg_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=chunks_dir
-    )
-    q = queue.Queue()
+
+def build_dash_command(chunks_dir, packaging=PACKAGING_TRANSCODE, fps=DEFAULT_FPS, ladder=None,
+                       live_window=None, low_latency=False):
+    """ffmpeg command turning the uploaded H.264 stream into DASH under chunks_dir
+    (the command must run with chunks_dir as its working directory).
+    With a ladder, every rung is transcoded regardless of packaging.
+    With low_latency, the live output is chunked CMAF (see LL_SEGMENT_SECONDS).
+    """
+    live_window = LIVE_WINDOW_SEGMENTS if live_window is None else live_window
+    if ladder:
+        input_args = [
+            "-fflags", "+genpts",
+            "-use_wallclock_as_timestamps", "1",
+            "-i", "pipe:0",
+        ]
+        codec_args = _ladder_args(ladder, fps)
+    elif packaging == PACKAGING_COPY:
+        input_args = [
+            # Raw H.264 carries no timestamps; generate them from the camera frame rate
+            "-f", "h264",
+            "-framerate", str(fps),
+            "-fflags", "+genpts",
+            "-i", "pipe:0",
+        ]
+        # Stream copy: the dash muxer cuts segments on the client's keyframes
+        codec_args = ["-map", "0", "-c:v", "copy"]
+    else:
+        input_args = [
+            # Ensure ffmpeg generates proper PTS when reading from a pipe
+            "-fflags", "+genpts",
+            # Use wallclock timestamps to keep segment timing consistent for live
+            "-use_wallclock_as_timestamps", "1",
+            "-i", "pipe:0",
+        ]
+        codec_args = [
+            "-map", "0",
+            # Low-latency encoding settings
+            "-c:v", "libx264",
+            "-preset", "ultrafast",
+            "-tune", "zerolatency",
+            # Force a frame rate to stabilize segment durations (matching your source fps)
+            "-r", str(fps),
+            "-c:a", "aac",
+        ]
+        if low_latency:
+            # A keyframe at every segment boundary; x264 would otherwise place one every 250 frames
+            gop = str(max(1, round(fps * LL_SEGMENT_SECONDS)))
+            codec_args += ["-g", gop, "-keyint_min", gop, "-sc_threshold", "0"]
+    # UTCTiming lets players sync to the server clock, so their live latency is comparable
+    dash_options = "use_template=1:utc_timing_url=/clock"
+    if ladder:
+        dash_options += ":adaptation_sets=id=0\\,streams=v"
+    archive_options = live_options = dash_options + ":use_timeline=1"
+    if low_latency:
+        # Both outputs cut segments at the same keyframes, so their segment numbers match
+        archive_options += f":seg_duration={LL_SEGMENT_SECONDS}"
+        # Chunked CMAF: each segment is written (and served) fragment by fragment as it is encoded,
+        # and the manifest carries the latency target and availabilityTimeOffset players need
+        live_options = (f"{dash_options}:use_timeline=0:seg_duration={LL_SEGMENT_SECONDS}"
+                        f":streaming=1:ldash=1:frag_type=duration:frag_duration={LL_FRAGMENT_SECONDS}"
+                        f":target_latency={LL_TARGET_LATENCY}:min_playback_rate={LL_PLAYBACK_RATES[0]}"
+                        f":max_playback_rate={LL_PLAYBACK_RATES[1]}:write_prft=1")
+    if not (live_window and low_latency):
+        # viewers watch the archive's segments: the whole manifest, or a window cut from it
+        archive_options = live_options
+    outputs = [f"[f=dash:{archive_options}]manifest.mpd"]
+    if live_window and low_latency:
+        # Chunked CMAF segments differ from the archive's, so the tee muxer packages the same
+        # encode twice: every segment is written twice, for a live window whose manifest stays
+        # small and whose old segments ffmpeg deletes itself
+        outputs.append(f"[f=dash:{live_options}:window_size={live_window}:extra_window_size={LIVE_WINDOW_EXTRA}"
+                       f":remove_at_exit=1]{LIVE_DIR}/manifest.mpd")
+    # Progress on stdout feeds the encoder fps/speed metrics (see watch_decoder);
+    # warnings and errors on stderr are kept by the supervisor for crash reports
+    return ["ffmpeg", "-nostats", "-loglevel", "warning", "-progress", "pipe:1",
+            *input_args, *codec_args, "-f", "tee", "|".join(outputs)]
+
+def choose_packaging(requested, first_chunk):
+    """Resolve a packaging mode to copy or transcode. Returns (mode, reason)."""
+    if requested == PACKAGING_TRANSCODE:
+        return PACKAGING_TRANSCODE, "requested"
+    if requested == PACKAGING_COPY:
+        return PACKAGING_COPY, "requested"
+    sps = parse_sps(first_chunk or b"")
+    if sps is None:
+        return PACKAGING_TRANSCODE, "no SPS in first chunk"
+    if not is_browser_playable(sps):
+        return PACKAGING_TRANSCODE, (f"profile {sps['profile_idc']}, chroma {sps['chroma_format_idc']}, "
+                                     f"{sps['bit_depth']}-bit is not browser-playable")
+    return PACKAGING_COPY, f"profile {sps['profile_idc']} is browser-playable"
+
+def camera_options(headers):
+    """Per-camera decoder options sent by the client alongside its first upload."""
+    packaging = headers.get("Packaging", PACKAGING_MODE)
+    if packaging not in PACKAGING_MODES:
+        packaging = PACKAGING_MODE
+    try:
+        fps = max(1, int(float(headers.get("Camera-FPS", DEFAULT_FPS))))
+    except ValueError:
+        fps = DEFAULT_FPS
+    return {"packaging": packaging, "fps": fps, "abr": _header_flag(headers, "ABR-Ladder", ABR_DEFAULT),
+            "low_latency": _header_flag(headers, "Low-Latency", LOW_LATENCY_DEFAULT)}
+
+def _header_flag(headers, name, default):
+    value = headers.get(name)
+    return default if value is None else value.strip().lower() in ("1", "true", "on", "yes")
+
+def start_decoder(camera_id, start_writer=True, first_chunk=b"", options=None):
+    """Start a new ffmpeg decoder process and threads for a camera.
+    The async engine passes start_writer=False and drains the buffer itself.
+    first_chunk is only inspected (to pick a packaging mode), not written.
+    Raises CapacityError if the supervisor does not admit another decoder.
+    """
+    options = options or {"packaging": PACKAGING_MODE, "fps": DEFAULT_FPS, "abr": ABR_DEFAULT,
+                          "low_latency": LOW_LATENCY_DEFAULT}
+    if mosaic is not None and camera_id == MOSAIC_ID:
+        raise CapacityError(f"Camera id {MOSAIC_ID!r} is reserved for the mosaic stream", 3600)
+    if camera_id in finalizing_cameras:
+        raise CapacityError(f"Camera {camera_id} was just closed and its recording is still being finalized", 1)
+    ladder = None
+    if options.get("abr"):
+        if len(ladder_cameras) < MAX_LADDER_ENCODES:
+            ladder = LADDER or parse_ladder(DEFAULT_LADDER)
+        else:
+            print(f"[Ingest] {camera_id}: ladder limit ({MAX_LADDER_ENCODES}) reached, using a single rendition")
+    if ladder:
+        packaging, reason = PACKAGING_TRANSCODE, f"{len(ladder)}-rendition ladder"
+    else:
+        packaging, reason = choose_packaging(options["packaging"], first_chunk)
+    kind = "ladder" if ladder else packaging
+    get_encoder_supervisor().admit(camera_id, kind)
+    if ladder:
+        ladder_cameras.add(camera_id)
+    low_latency = bool(options.get("low_latency"))
+    if low_latency:
+        low_latency_cameras.add(camera_id)
+    print(f"[Ingest] {camera_id}: {packaging} ({reason}){', low latency' if low_latency else ''}")
+    # A new ffmpeg numbers its segments from 1: keep an earlier recording under this id
+    set_aside_recording(camera_id)
+    # Ensure chunks/ are created under the server package directory
+    chunks_dir = os.path.join(SERVER_ROOT, "chunks", camera_id)
+    if segment_mover is not None:
+        # ffmpeg writes to RAM; the mover takes finished segments to chunks/
+        chunks_dir = segment_mover.camera_started(camera_id)
+    os.makedirs(os.path.join(chunks_dir, LIVE_DIR), exist_ok=True)
+    camera_commands[camera_id] = (build_dash_command(chunks_dir, packaging, options["fps"], ladder,
+                                                     low_latency=low_latency), chunks_dir, kind)
+    ffmpeg = spawn_decoder(camera_id)
+    q = IngestBuffer(INGEST_BUFFER_BYTES, INGEST_POLICY,
+                     on_drop=lambda nbytes: INGEST_DROPPED_BYTES.inc((camera_id,), nbytes))
     camera_streams[camera_id] = q
-    telemetry_data_amounts[camera_id] = 0
-    telemetry_data_locks[camera_id] = threading.Lock()
-    threading.Thread(target=writer_thread, args=(ffmpeg, q), daemon=True).start()
+    camera_decoders[camera_id] = ffmpeg
+    camera_packaging[camera_id] = packaging
+    camera_latency[camera_id] = CameraLatency(
+        observe=lambda stage, seconds: LATENCY_SECONDS.observe((camera_id, stage), seconds))
+    get_recording_catalog().camera_started(camera_id)
+    event_bus.publish("camera", camera_id=camera_id, live=True, packaging=packaging, ladder=bool(ladder),
+                      low_latency=low_latency)
+    if start_writer:
+        threading.Thread(target=writer_thread, args=(ffmpeg, q, camera_id), daemon=True).start()
 
-def aggregate_telemetry():
-    while True:
-        time.sleep(1)
-        total_traffic = 0
-        for cam_id in list(telemetry_data_amounts.keys()):
-            with telemetry_data_locks[cam_id]:
-                amount = telemetry_data_amounts[cam_id]
-                telemetry_data_amounts[cam_id] = 0
-            total_traffic += amount
-        print(f"[Telemetry] {time.strftime('%Y-%m-%d %H:%M:%S')} - Total incoming data: {total_traffic / 1024:.2f} KB/s")
+def spawn_decoder(camera_id):
+    """Start the ffmpeg for camera_commands[camera_id] under supervision.
+    With the frame tap on, the ffmpeg also writes small raw frames to an extra pipe."""
+    ffmpeg_cmd, chunks_dir, kind = camera_commands[camera_id]
+    tap_read = tap_write = None
+    if frame_tap is not None:
+        tap_read, tap_write = os.pipe()
+        # pass_fds keeps the descriptor number in the child, so ffmpeg can open pipe:<fd>
+        ffmpeg_cmd = ffmpeg_cmd + frame_tap.output_args(tap_write)
+    try:
+        ffmpeg = subprocess.Popen(
+            ffmpeg_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=chunks_dir,
+            pass_fds=(tap_write,) if tap_write is not None else ()
+        )
+    finally:
+        if tap_write is not None:
+            os.close(tap_write)
+    if tap_read is not None:
+        threading.Thread(target=frame_tap.feed, args=(camera_id, os.fdopen(tap_read, "rb", buffering=0)),
+                         daemon=True).start()
+    get_encoder_supervisor().track(camera_id, ffmpeg, kind)
+    threading.Thread(target=watch_decoder, args=(camera_id, ffmpeg, chunks_dir), daemon=True).start()
+    return ffmpeg
+
+def decoder_exited(camera_id, ffmpeg):
+    """Reap a decoder whose output ended; restart it if it died while its camera was still open."""
+    code = ffmpeg.wait()
+    supervisor = get_encoder_supervisor()
+    if camera_decoders.get(camera_id) is not ffmpeg or not supervisor.tracking(camera_id, ffmpeg):
+        return
+    print(f"[Supervisor] {camera_id}: decoder exited with code {code}")
+    for line in supervisor.stderr_tail(camera_id)[-5:]:
+        print(f"[Supervisor]   {line}")
+    if not supervisor.restart_allowed(camera_id):
+        print(f"[Supervisor] {camera_id}: decoder keeps failing, closing the camera")
+        close_camera(camera_id)
+        return
+    restart_decoder(camera_id, ffmpeg)
+
+def restart_decoder(camera_id, crashed):
+    """Replace a crashed decoder. What it recorded is moved aside and indexed as
+    <camera>-part<n>, since a new ffmpeg numbers its segments from 1 again.
+    The files are moved without holding camera_streams_lock, which every upload takes."""
+    with decoders_changed:
+        if camera_decoders.get(camera_id) is not crashed or camera_id in restarting_cameras:
+            return
+        restarting_cameras.add(camera_id)
+        chunks_dir = camera_commands[camera_id][1]
+    restarted = False
+    try:
+        if segment_mover is not None:
+            # the part is kept on disk, and the new decoder starts on an empty RAM directory
+            segment_mover.finish(camera_id)
+        if set_aside_recording(camera_id):
+            segment_cache.discard(chunks_dir)
+        if segment_mover is not None:
+            segment_mover.camera_started(camera_id)
+        os.makedirs(os.path.join(chunks_dir, LIVE_DIR), exist_ok=True)
+        with decoders_changed:
+            # closed meanwhile: finalize_recording waits for this and moves what is left
+            if camera_decoders.get(camera_id) is crashed:
+                camera_decoders[camera_id] = spawn_decoder(camera_id)
+                restarted = True
+    finally:
+        with decoders_changed:
+            restarting_cameras.discard(camera_id)
+            decoders_changed.notify_all()
+    if restarted:
+        DECODER_RESTARTS.inc((camera_id,))
+        print(f"[Supervisor] {camera_id}: decoder restarted")
+
+def set_aside_recording(camera_id):
+    """Move the recording in chunks/<camera_id>/ to the next free chunks/<camera_id>-part<n>/
+    and index it as that id. Returns the part id, or None if there is no recording."""
+    archive_dir = os.path.join(SERVER_ROOT, "chunks", camera_id)
+    if not os.path.exists(os.path.join(archive_dir, "manifest.mpd")):
+        return None
+    n = 1
+    while os.path.exists(f"{archive_dir}-part{n}"):
+        n += 1
+    part_id, part_dir = f"{camera_id}-part{n}", f"{archive_dir}-part{n}"
+    os.rename(archive_dir, part_dir)
+    shutil.rmtree(os.path.join(part_dir, LIVE_DIR), ignore_errors=True)
+    segment_cache.discard(archive_dir)
+    get_recording_catalog().camera_restarted(camera_id, part_id, part_dir)
+    if segment_collector is not None:
+        segment_collector.reset(camera_id)
+    print(f"[Supervisor] {camera_id}: recording so far kept as {part_id}")
+    return part_id
+
+def wait_for_decoder(camera_id, ffmpeg, timeout=None):
+    """The decoder that replaced ffmpeg after a crash, or None if the camera was closed
+    (or nothing replaced it within DECODER_RESTART_WAIT seconds)."""
+    with decoders_changed:
+        decoders_changed.wait_for(lambda: camera_decoders.get(camera_id) is not ffmpeg,
+                                  DECODER_RESTART_WAIT if timeout is None else timeout)
+        current = camera_decoders.get(camera_id)
+    return current if current is not ffmpeg else None
+
+def kill_stalled_decoder(camera_id, ffmpeg):
+    """Supervisor callback for a decoder that is fed but makes no progress; its exit triggers a restart."""
+    print(f"[Supervisor] {camera_id}: no progress for {STALL_TIMEOUT} s while being fed, killing the decoder")
+    ffmpeg.kill()
+
+def get_encoder_supervisor():
+    global encoder_supervisor
+    if encoder_supervisor is None:
+        encoder_supervisor = EncoderSupervisor(
+            max_encoders=MAX_ENCODERS, cpu_reserve=CPU_RESERVE, cpu_admission=CPU_ADMISSION,
+            max_restarts=MAX_RESTARTS, restart_window=RESTART_WINDOW, stall_timeout=STALL_TIMEOUT,
+            log=lambda msg: print(f"[Supervisor] {msg}")
+        )
+    return encoder_supervisor
+
+def refuse_camera(camera_id, error):
+    """(body, status, headers) for a camera the supervisor did not admit."""
+    ADMISSION_REJECTIONS.inc()
+    print(f"[Supervisor] {camera_id}: refused: {error}")
+    return f"Server at capacity: {error}", 503, {"Retry-After": str(error.retry_after)}
+
+def ensure_camera(camera_id, start_writer=True, first_chunk=b"", options=None):
+    """Start the camera's decoder unless it is already running. Returns True if started.
+    Raises CapacityError if a new camera is not admitted."""
+    with camera_streams_lock:
+        if camera_id in camera_streams:
+            return False
+        start_decoder(camera_id, start_writer, first_chunk, options)
+        return True
+
+def close_camera(camera_id):
+    """Stop feeding a camera's decoder and forget it. Returns False if unknown."""
+    with decoders_changed:
+        q = camera_streams.pop(camera_id, None)
+        if q is None:
+            return False
+        q.put(None)
+        finalizing_cameras.add(camera_id)
+        ffmpeg = camera_decoders.pop(camera_id, None)
+        camera_packaging.pop(camera_id, None)
+        live_manifests.pop(camera_id, None)
+        camera_commands.pop(camera_id, None)
+        ladder_cameras.discard(camera_id)
+        low_latency_cameras.discard(camera_id)
+        decoders_changed.notify_all()
+    for callback in list(close_callbacks):
+        callback(camera_id)
+    get_encoder_supervisor().forget(camera_id)
+    snapshot_cache.forget(camera_id)
+    if frame_tap is not None:
+        frame_tap.remove(camera_id)
+    if motion_analyzer is not None:
+        motion_analyzer.forget(camera_id)
+    forget_camera_metrics(camera_id)
+    event_bus.publish("camera", camera_id=camera_id, live=False)
+    finalize_recording(camera_id, ffmpeg)
+    return True
+
+def finalize_recording(camera_id, ffmpeg):
+    """Index a stopped camera's recording once its ffmpeg has written the final manifest."""
+    def finalize():
+        try:
+            if ffmpeg is not None:
+                try:
+                    ffmpeg.wait(timeout=RECORDING_FINALIZE_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    print(f"[Catalog] {camera_id}: decoder still running, indexing anyway")
+            with decoders_changed:
+                # a restart still moving the crashed decoder's files; it leaves the rest to this
+                decoders_changed.wait_for(lambda: camera_id not in restarting_cameras)
+            if segment_mover is not None:
+                segment_mover.finish(camera_id)
+            get_recording_catalog().camera_stopped(camera_id, os.path.join(SERVER_ROOT, "chunks", camera_id))
+        finally:
+            with camera_streams_lock:
+                finalizing_cameras.discard(camera_id)
+    threading.Thread(target=finalize, daemon=True).start()
+
+def accept_chunk(camera_id, chunk, start_writer=True, options=None):
+    """Route one uploaded chunk into the camera's ingest buffer.
+    Returns (body, status, headers) for the HTTP layer.
+    """
+    body, status, headers = _route_chunk(camera_id, chunk, start_writer, options)
+    UPLOAD_REQUESTS.inc((camera_id, status))
+    return body, status, headers
+
+def _route_chunk(camera_id, chunk, start_writer, options):
+    if not chunk:
+        return "No data", 400, {}
+    # Start a decoder per new camera
+    try:
+        started = ensure_camera(camera_id, start_writer, chunk, options)
+    except CapacityError as e:
+        return refuse_camera(camera_id, e)
+    if not started and camera_id in streaming_ingests:
+        return f"Camera {camera_id} is streaming over /ingest", 409, {}
+    q = camera_streams.get(camera_id)
+    if q is None:
+        return f"Camera {camera_id} closed", 410, {}
+    if not q.put(chunk):
+        # Buffer full under the block policy: push back on the uploader
+        return "Ingest buffer full", 503, {"Retry-After": str(INGEST_RETRY_AFTER)}
+    record_ingest(camera_id, chunk)
+    return "OK", 200, activity_headers(camera_id)
+
+def activity_headers(camera_id):
+    """Camera-Activity hint for the uploading client, which encodes idle cameras at its
+    cheapest level (see motion.py). Empty without motion analysis."""
+    if motion_analyzer is None:
+        return {}
+    return {"Camera-Activity": "idle" if motion_analyzer.idle(camera_id) else "active"}
+
+def record_ingest(camera_id, chunk):
+    """Count a chunk received from a camera."""
+    INGEST_BYTES.inc((camera_id,), len(chunk))
+    latency = camera_latency.get(camera_id)
+    if latency is not None:
+        latency.received(chunk)
+
+def record_written(camera_id, chunk):
+    """Note a chunk handed to the camera's ffmpeg."""
+    get_encoder_supervisor().fed(camera_id)
+    latency = camera_latency.get(camera_id)
+    if latency is not None:
+        latency.written(chunk)
+
+def watch_decoder(camera_id, ffmpeg, chunks_dir):
+    """Read a decoder's -progress output into camera_encoder_stats and time its segments.
+    Hands the decoder to decoder_exited once its output ends."""
+    try:
+        _watch_progress(camera_id, ffmpeg, chunks_dir)
+    finally:
+        decoder_exited(camera_id, ffmpeg)
+
+def _watch_progress(camera_id, ffmpeg, chunks_dir):
+    next_segment = 1
+    last_segment_time = time.time()
+    block = {}
+    for raw in ffmpeg.stdout:
+        key, _, value = raw.decode(errors="ignore").strip().partition("=")
+        block[key] = value
+        if key != "progress":
+            continue
+        if camera_decoders.get(camera_id) is not ffmpeg:
+            # closed: don't recreate series forget_camera_metrics removed
+            block = {}
+            continue
+        get_encoder_supervisor().progress(camera_id)
+        stats = {}
+        for name, cast in (("fps", float), ("speed", lambda v: float(v.rstrip("x"))), ("frame", int)):
+            try:
+                stats[name] = cast(block.get(name, ""))
+            except ValueError:
+                stats[name] = None
+        camera_encoder_stats[camera_id] = stats
+        block = {}
+        # One stat per progress report (every ~0.5 s) finds each new segment, wherever the
+        # RAM tier has put it: a flush can move it to disk before this sees it
+        try:
+            written = os.path.getmtime(archive_file(camera_id, segment_name(0, next_segment)))
+        except OSError:
+            continue
+        SEGMENT_INTERVAL_SECONDS.observe((camera_id,), max(0.0, written - last_segment_time))
+        activity = None
+        if motion_analyzer is not None:
+            activity = motion_analyzer.segment_activity(camera_id, last_segment_time, written)
+        get_recording_catalog().segment_finished(camera_id, next_segment, last_segment_time, written, activity)
+        event_bus.publish("segment", camera_id=camera_id, number=next_segment, started=last_segment_time,
+                          ended=written, activity=activity)
+        if segment_mover is not None:
+            segment_mover.segment_finished(camera_id, next_segment)
+        latency = camera_latency.get(camera_id)
+        if latency is not None:
+            latency.segment_published(written)
+        if dash_viewers.get(camera_id):
+            # every viewer of the camera asks for this segment next
+            preload_segment(camera_id, chunks_dir, next_segment)
+        if snapshot_cache.due(camera_id):
+            # the segment starts with a keyframe; the smallest rendition is the cheapest to decode
+            stream = len(LADDER or parse_ladder(DEFAULT_LADDER)) - 1 if camera_id in ladder_cameras else 0
+            snapshot_cache.submit(camera_id, os.path.join(chunks_dir, f"init-stream{stream}.m4s"),
+                                  archive_file(camera_id, segment_name(stream, next_segment)))
+        last_segment_time = written
+        next_segment += 1
+
+def record_dash_request(camera_id, filename, client, seconds):
+    """Count a /dash request towards request latency and the camera's viewers."""
+    kind = "manifest" if filename.endswith(".mpd") else "segment"
+    DASH_REQUEST_SECONDS.observe((kind,), seconds)
+    viewers = dash_viewers.get(camera_id)
+    if viewers is None:
+        viewers = dash_viewers.setdefault(camera_id, {})
+    viewers[client] = time.time()
+
+def forget_camera_metrics(camera_id):
+    INGEST_BYTES.remove((camera_id,))
+    INGEST_DROPPED_BYTES.remove((camera_id,))
+    SEGMENT_INTERVAL_SECONDS.remove((camera_id,))
+    for camera, status in UPLOAD_REQUESTS.values():
+        if camera == camera_id:
+            UPLOAD_REQUESTS.remove((camera, status))
+    camera_encoder_stats.pop(camera_id, None)
+    camera_latency.pop(camera_id, None)
+    for stage in LATENCY_STAGES:
+        LATENCY_SECONDS.remove((camera_id, stage))
+
+def _viewer_counts():
+    cutoff = time.time() - VIEWER_WINDOW
+    counts = {}
+    for camera_id, viewers in list(dash_viewers.items()):
+        for client, seen in list(viewers.items()):
+            if seen < cutoff:
+                viewers.pop(client, None)
+        if viewers:
+            counts[(camera_id,)] = len(viewers)
+        else:
+            dash_viewers.pop(camera_id, None)
+    return counts
+
+def _decoder_process_stats():
+    stats = {}
+    for camera_id, ffmpeg in list(camera_decoders.items()):
+        stats[camera_id] = process_stats(ffmpeg.pid)
+    return stats
+
+def _conversion_counts():
+    counts = {("queued",): 0, ("in_progress",): 0}
+    for job in get_conversion_scheduler().jobs():
+        counts[(job["state"],)] = counts.get((job["state"],), 0) + 1
+    return counts
+
+def _encoder_stat(name):
+    return lambda: {(cam,): st.get(name) for cam, st in list(camera_encoder_stats.items()) if cam in camera_streams}
+
+def _process_stat(index):
+    return lambda: {(cam,): st[index] for cam, st in _decoder_process_stats().items() if st is not None}
+
+METRICS = [
+    Gauge("multiflow_cameras", "Cameras currently ingesting", collect=lambda: {(): len(camera_streams)}),
+    INGEST_BYTES,
+    UPLOAD_REQUESTS,
+    Gauge("multiflow_ingest_queue_bytes", "Encoded bytes waiting in a camera's ingest buffer", ("camera",),
+          collect=lambda: {(cam,): q.stats()["depth_bytes"] for cam, q in list(camera_streams.items())}),
+    INGEST_DROPPED_BYTES,
+    Gauge("multiflow_encoder_fps", "Frames per second the camera's ffmpeg is processing", ("camera",),
+          collect=_encoder_stat("fps")),
+    Gauge("multiflow_encoder_speed", "Camera ffmpeg speed as a multiple of real time", ("camera",),
+          collect=_encoder_stat("speed")),
+    SEGMENT_INTERVAL_SECONDS,
+    Gauge("multiflow_decoder_cpu_seconds", "CPU time used by the camera's ffmpeg", ("camera",),
+          collect=_process_stat(0), kind="counter"),
+    Gauge("multiflow_decoder_resident_bytes", "Resident memory of the camera's ffmpeg", ("camera",),
+          collect=_process_stat(1)),
+    Gauge("multiflow_viewers", f"Clients that fetched a camera's DASH files in the last {VIEWER_WINDOW} s",
+          ("camera",), collect=_viewer_counts),
+    DASH_REQUEST_SECONDS,
+    Gauge("multiflow_dash_cache_bytes", "Manifests and segments held in memory for /dash",
+          collect=lambda: {(): segment_cache.stats()["bytes"]}),
+    Gauge("multiflow_dash_cache_requests_total", "/dash lookups answered from memory (hit) or disk (miss)", ("result",),
+          collect=lambda: {("hit",): segment_cache.stats()["hits"], ("miss",): segment_cache.stats()["misses"]},
+          kind="counter"),
+    LATENCY_SECONDS,
+    Gauge("multiflow_conversions", "Conversions by state", ("state",), collect=_conversion_counts),
+    CONVERSIONS_FINISHED,
+    Gauge("multiflow_idle_cameras", "Live cameras without motion for the idle period (motion analysis only)",
+          collect=lambda: {(): sum(motion_analyzer.idle(cam) for cam in list(camera_streams))}
+          if motion_analyzer is not None else {}),
+    Gauge("multiflow_event_subscribers", "Open /events and /convert-status streams",
+          collect=lambda: {(): event_bus.subscribers()}),
+    Gauge("multiflow_ram_tier_backlog_bytes", "Finished segments in RAM waiting to be moved to disk (--ram-dir only)",
+          collect=lambda: {(): segment_mover.backlog_bytes()} if segment_mover is not None else {}),
+    Gauge("multiflow_ram_tier_moved_bytes_total", "Bytes moved from the RAM tier to disk (--ram-dir only)",
+          collect=lambda: {(): segment_mover.moved_bytes} if segment_mover is not None else {}, kind="counter"),
+    Gauge("multiflow_cpu_idle_cores", "Idle CPU cores measured by the decoder supervisor",
+          collect=lambda: {(): get_encoder_supervisor().idle_cores}),
+    DECODER_RESTARTS,
+    ADMISSION_REJECTIONS,
+]
+
+def metrics_text():
+    """Everything above in Prometheus text format, as served by /metrics."""
+    return render_metrics_text(METRICS)
 
 @app.route("/upload", methods=["POST", "DELETE"])
 def upload():
     cam_id = request.headers.get("Camera-ID", "0")
     if request.method == "DELETE":
-        if cam_id in camera_streams:
-            camera_streams[cam_id].put(None)
-            del camera_streams[cam_id]
-            del telemetry_data_amounts[cam_id]
-            del telemetry_data_locks[cam_id]
+        if close_camera(cam_id):
             return f"Closed camera {cam_id}", 200
         else:
             return f"Camera {cam_id} not found", 404 
     else:
-        chunk = request.data
+        return accept_chunk(cam_id, request.data, options=camera_options(request.headers))
+
+@app.route("/ingest", methods=["POST"])
+def ingest():
+    """
+    Long-lived ingest channel: one chunked-transfer POST per camera whose body is
+    copied into the camera's ffmpeg stdin as it arrives, without a per-chunk request
+    or a queue hop. Closing the camera still goes through DELETE /upload.
+    Returns 200 when the body ends, 409 if the camera already has a channel open.
+    """
+    cam_id = request.headers.get("Camera-ID", "0")
+    with streaming_ingests_lock:
+        if cam_id in streaming_ingests:
+            return f"Camera {cam_id} already streaming", 409
+        streaming_ingests.add(cam_id)
+    try:
+        stream = request.stream
+        chunk = stream.read(INGEST_READ_SIZE)
         if not chunk:
             return "No data", 400
-
-        # Start a decoder thread per new camera
-        if cam_id not in camera_streams:
-            start_decoder(cam_id)
-        camera_streams[cam_id].put(chunk)
-        with telemetry_data_locks[cam_id]:
-            telemetry_data_amounts[cam_id] += len(chunk)
+        try:
+            ensure_camera(cam_id, first_chunk=chunk, options=camera_options(request.headers))
+        except CapacityError as e:
+            return refuse_camera(cam_id, e)
+        ffmpeg = camera_decoders[cam_id]
+        gate = None
+        while chunk:
+            if cam_id not in camera_streams:
+                return f"Camera {cam_id} closed", 410
+            record_ingest(cam_id, chunk)
+            if gate is not None:
+                chunk = gate(chunk)
+                if gate.open:
+                    gate = None
+            try:
+                if chunk:
+                    ffmpeg.stdin.write(chunk)
+                    record_written(cam_id, chunk)
+            except (BrokenPipeError, ValueError):
+                # ValueError: stdin was closed by a DELETE while we were streaming
+                ffmpeg = wait_for_decoder(cam_id, ffmpeg)
+                if ffmpeg is None:
+                    return f"Camera {cam_id} decoder closed", 410
+                # the decoder crashed and was restarted: resume at the next keyframe
+                gate = KeyframeGate()
+            chunk = stream.read(INGEST_READ_SIZE)
+        try:
+            ffmpeg.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass
         return "OK", 200
+    finally:
+        with streaming_ingests_lock:
+            streaming_ingests.discard(cam_id)
 @app.route("/")
 def live_frontend():
     return render_template("index.html")
@@ -121,33 +881,295 @@ def assets_files(filename):
     return send_from_directory(f"../client/web/assets", filename)
 @app.route("/info")
 def num_cameras():
-    chunks_root = os.path.join(SERVER_ROOT, "chunks")
+    """
+    Live cameras, recordings and conversions.
+    ?limit=<n>&offset=<n> page through recordings (default: all),
+    ?q=<text> keeps recordings whose id contains text,
+    ?state=recorded|live|removed|all (default recorded),
+    ?converted=1|0 keeps only (un)converted recordings.
+    """
+    return info_request(request.args)
+
+def info_request(args):
+    """Validate /info query parameters; returns (body, status) for the HTTP layer."""
     try:
-        all_dirs = [name for name in os.listdir(chunks_root) if os.path.isdir(os.path.join(chunks_root, name))]
-    except FileNotFoundError:
-        all_dirs = []
-    past_recordings = [d for d in all_dirs if d not in camera_streams]
-    with active_conversions_lock:
-        conversions_in_progress = list(active_conversions.keys())
-    converted_dir = os.path.join(SERVER_ROOT, "converted")
-    converted_files = []
-    if os.path.isdir(converted_dir):
-        converted_files = [
-            f for f in os.listdir(converted_dir)
-            if os.path.isfile(os.path.join(converted_dir, f)) and f.lower().endswith(".mp4")
-        ]
-        converted_files.sort()
+        limit = args.get("limit")
+        limit = max(0, int(limit)) if limit not in (None, "") else None
+        offset = max(0, int(args.get("offset") or 0))
+    except ValueError:
+        return {"error": "limit and offset must be integers"}, 400
+    state = args.get("state") or STATE_RECORDED
+    if state not in RECORDING_STATES + ("all",):
+        return {"error": f"Unknown state {state!r}, expected one of {', '.join(RECORDING_STATES + ('all',))}"}, 400
+    converted = args.get("converted")
+    if converted not in (None, ""):
+        converted = converted.strip().lower() in ("1", "true", "yes", "on")
+    else:
+        converted = None
+    return build_info(limit, offset, args.get("q") or None, None if state == "all" else state, converted), 200
+
+def build_info(limit=None, offset=0, search=None, state=STATE_RECORDED, converted=None):
+    """Live cameras, a page of catalogued recordings and conversion state, as served by /info."""
+    catalog = get_recording_catalog()
+    recordings, total = catalog.query(state, search, converted, limit, offset)
+    conversion_jobs = get_conversion_scheduler().jobs()
+    converted_files = catalog.converted_files()
+    if search:
+        converted_files = [f for f in converted_files if search in f]
     return {
         "num_cameras": len(camera_streams),
         "cameras": list(camera_streams.keys()),
-        "past_recordings": sorted(past_recordings),
-        "conversions_in_progress": conversions_in_progress,
-        "converted_files": converted_files
+        "ingest_queues": {cam_id: q.stats() for cam_id, q in list(camera_streams.items())},
+        "packaging": dict(camera_packaging),
+        "ladder_cameras": sorted(ladder_cameras),
+        "low_latency_cameras": sorted(low_latency_cameras),
+        "mosaic": f"/dash/{MOSAIC_ID}/manifest.mpd" if mosaic is not None else None,
+        "idle_cameras": sorted(cam for cam in camera_streams if motion_analyzer.idle(cam))
+        if motion_analyzer is not None else None,
+        "past_recordings": [r["camera_id"] for r in recordings if r["state"] == STATE_RECORDED],
+        "recordings": recordings,
+        "total_recordings": total,
+        "offset": offset,
+        "limit": limit,
+        "conversions_in_progress": [job["camera_id"] for job in conversion_jobs],
+        "conversion_queue": conversion_jobs,
+        "converted_files": converted_files,
+        "retention": {
+            "deleted_segments": segment_collector.deleted_segments,
+            "deleted_bytes": segment_collector.deleted_bytes,
+        } if segment_collector else None,
+        "ram_tier": {
+            "backlog_bytes": segment_mover.backlog_bytes(),
+            "moved_segments": segment_mover.moved_segments,
+            "moved_bytes": segment_mover.moved_bytes,
+        } if segment_mover else None
         }
 @app.route("/dash/<camera_id>/<path:filename>")
 def dash_files(camera_id, filename):
-    # Serve chunk files from the server's chunks directory
-    return send_from_directory(os.path.join(SERVER_ROOT, "chunks", camera_id), filename)
+    # Serve chunk files from the server's chunks directory, through the segment cache
+    started = time.perf_counter()
+    body, status, headers = dash_file(camera_id, filename, request.headers.get("If-None-Match"))
+    if status != 404:
+        record_dash_request(camera_id, filename, request.remote_addr, time.perf_counter() - started)
+    if isinstance(body, GrowingSegment):
+        return app.response_class(iter(body), status, headers)
+    if isinstance(body, UncachedFile):
+        response = send_file(body.path, mimetype=headers["Content-Type"], etag=False, conditional=False)
+        response.headers.update(headers)
+        return response
+    return body, status, headers
+
+@app.route("/snapshot/<camera_id>")
+def snapshot_route(camera_id):
+    """Latest thumbnail of a live camera, for the overview grid."""
+    return snapshot_request(camera_id, request.headers.get("If-None-Match"))
+
+def snapshot_request(camera_id, if_none_match=None):
+    """(body, status, headers) with the camera's latest snapshot from snapshot_cache."""
+    snapshot = snapshot_cache.get(camera_id)
+    if snapshot is None:
+        return "No snapshot", 404, {}
+    # a new snapshot gets a new ETag, so revalidating every time is cheap and never stale
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, snapshot.etag):
+        return b"", 304, headers
+    headers["Content-Type"] = snapshot.content_type
+    return snapshot.data, 200, headers
+
+@app.route("/activity/<camera_id>")
+def activity_route(camera_id):
+    """
+    Per-segment activity index of a live or past recording (motion analysis only).
+    ?min_activity=<share of changed pixels> keeps only segments at or above it.
+    """
+    return activity_request(camera_id, request.args)
+
+def activity_request(camera_id, args):
+    """(body, status) listing a recording's indexed segments and the ranges with activity.
+    offset is the segment's start in the recording's media time, for seeking the player."""
+    if os.path.basename(camera_id) != camera_id:
+        return {"error": "Invalid camera id"}, 400
+    try:
+        min_activity = _float_arg(args.get("min_activity"))
+    except ValueError:
+        return {"error": "min_activity must be a number"}, 400
+    catalog = get_recording_catalog()
+    segments = catalog.segments(camera_id, min_activity)
+    if not segments and catalog.get(camera_id) is None:
+        return {"error": "Recording not found"}, 404
+    manifest_path = archive_file(camera_id, "manifest.mpd")
+    offsets = {number: start for number, start, _ in conversion.segment_timeline(manifest_path)}
+    threshold = motion_analyzer.threshold if motion_analyzer is not None else DEFAULT_MOTION_THRESHOLD
+    ranges = []
+    for segment in segments:
+        segment["offset"] = offsets.get(segment["number"])
+        if segment["activity"] is None or segment["activity"] < threshold:
+            continue
+        last = ranges[-1] if ranges else None
+        if last is not None and last["last"] == segment["number"] - 1:
+            last.update(last=segment["number"], ended=segment["ended"],
+                        activity=max(last["activity"], segment["activity"]))
+        else:
+            ranges.append({"first": segment["number"], "last": segment["number"], "started": segment["started"],
+                           "ended": segment["ended"], "offset": segment["offset"], "activity": segment["activity"]})
+    live = camera_id in camera_streams
+    return {
+        "camera_id": camera_id,
+        "live": live,
+        "idle": motion_analyzer.idle(camera_id) if motion_analyzer is not None and live else None,
+        "threshold": threshold,
+        "segments": segments,
+        "ranges": ranges,
+    }, 200
+
+def _float_arg(value):
+    """A float query parameter, None if absent; raises ValueError if malformed."""
+    return float(value) if value not in (None, "") else None
+
+@app.route("/clock")
+def clock_route():
+    """Server time as ISO 8601 UTC: the manifests' UTCTiming source and the clients' clock sync."""
+    return app.response_class(server_clock(), mimetype="text/plain")
+
+def server_clock():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+@app.route("/latency", defaults={"camera_id": None})
+@app.route("/latency/<camera_id>", methods=["GET", "POST"])
+def latency_route(camera_id):
+    """
+    GET: per-stage latency breakdown for one camera (or every live camera).
+    POST {"live_latency": seconds}: a player reports how far behind live it plays.
+    """
+    if request.method == "POST":
+        return report_player_latency(camera_id, request.get_json(silent=True))
+    return latency_summary(camera_id)
+
+def latency_summary(camera_id=None):
+    """(body, status) with the latency breakdown of one camera, or all of them."""
+    if camera_id is None:
+        return {cam: latency.summary() for cam, latency in list(camera_latency.items())}, 200
+    latency = camera_latency.get(camera_id)
+    if latency is None:
+        return {"error": "Camera not found"}, 404
+    return latency.summary(), 200
+
+def report_player_latency(camera_id, body):
+    latency = camera_latency.get(camera_id)
+    if latency is None:
+        return {"error": "Camera not found"}, 404
+    try:
+        live_latency = float((body or {})["live_latency"])
+    except (KeyError, TypeError, ValueError):
+        return {"error": "Expected {\"live_latency\": seconds}"}, 400
+    if not 0 <= live_latency < 3600:
+        return {"error": "live_latency out of range"}, 400
+    latency.player_latency(live_latency)
+    return {"status": "ok"}, 200
+
+@app.route("/metrics")
+def metrics_route():
+    """Prometheus scrape endpoint."""
+    return app.response_class(metrics_text(), mimetype="text/plain; version=0.0.4")
+
+def resolve_dash_file(camera_id, filename):
+    """Absolute path of a DASH file for a camera, or None if outside chunks/.
+    The file itself may not exist."""
+    if mosaic is not None and camera_id == MOSAIC_ID:
+        path = os.path.normpath(os.path.join(MOSAIC_DIR, filename))
+        return path if path.startswith(os.path.join(MOSAIC_DIR, "")) else None
+    chunks_root = os.path.join(SERVER_ROOT, "chunks")
+    if filename.startswith(LIVE_DIR + "/") and not (LIVE_WINDOW_SEGMENTS and camera_id in low_latency_cameras):
+        # Live viewers get the archive's files; live_manifest cuts the manifest to the window
+        filename = filename[len(LIVE_DIR) + 1:]
+    path = os.path.normpath(os.path.join(chunks_root, camera_id, filename))
+    if not path.startswith(os.path.join(chunks_root, "")):
+        return None
+    if segment_mover is not None and camera_id in camera_commands:
+        # a live camera's live window is in RAM, and so is its archive until the mover takes it
+        ram_path = os.path.normpath(os.path.join(segment_mover.ram_dir(camera_id), filename))
+        if filename.startswith(LIVE_DIR + "/") or os.path.exists(ram_path):
+            return ram_path
+    return path
+
+def archive_file(camera_id, filename):
+    """Path of a file of a camera's archive, in whichever tier holds it."""
+    if segment_mover is not None:
+        return segment_mover.locate(camera_id, filename)
+    return os.path.join(SERVER_ROOT, "chunks", camera_id, filename)
+
+def dash_file(camera_id, filename, if_none_match=None, load=True):
+    """(body, status, headers) for a /dash request, from segment_cache when the file is unchanged.
+    For a low-latency camera's segment that ffmpeg is still writing, body is a GrowingSegment
+    the engine streams with chunked transfer. For a file segment_cache would not keep, body is
+    an UncachedFile the engine sends from disk.
+    With load=False an uncached file is not read and None is returned instead
+    (the async engine then reads it off its event loop)."""
+    path = resolve_dash_file(camera_id, filename)
+    st = _stat_file(path)
+    if st is None and path is not None and camera_id in low_latency_cameras and path.endswith(".m4s"):
+        growing = GrowingSegment.open(path, LL_SEGMENT_IDLE_TIMEOUT)
+        if growing is not None:
+            # incomplete until ffmpeg renames it, so never cached by the browser
+            return growing, 200, {"Content-Type": DASH_CONTENT_TYPES[".m4s"], "Cache-Control": "no-store"}
+        # finished between the two checks
+        st = _stat_file(path)
+    if st is None:
+        return "Not found", 404, {}
+    windowed = (filename == f"{LIVE_DIR}/manifest.mpd" and LIVE_WINDOW_SEGMENTS and camera_id in camera_commands
+                and camera_id not in low_latency_cameras)
+    entry = segment_cache.get(path, st)
+    if entry is None and not windowed and not segment_cache.holds(st.st_size):
+        # reading it would not save the next viewer a disk read
+        entry = UncachedFile(path, st)
+    elif entry is None:
+        if not load:
+            return None
+        entry = segment_cache.load(path)
+        if entry is None:
+            return "Not found", 404, {}
+    extension = os.path.splitext(path)[1]
+    headers = {
+        "ETag": entry.etag,
+        "Cache-Control": MANIFEST_CACHE_CONTROL if extension == ".mpd" else SEGMENT_CACHE_CONTROL,
+    }
+    data = entry if isinstance(entry, UncachedFile) else entry.data
+    if windowed:
+        data, headers["ETag"] = live_manifest(camera_id, entry)
+    if etag_matches(if_none_match, headers["ETag"]):
+        return b"", 304, headers
+    headers["Content-Type"] = (DASH_CONTENT_TYPES.get(extension) or mimetypes.guess_type(path)[0]
+                               or "application/octet-stream")
+    return data, 200, headers
+
+def live_manifest(camera_id, entry):
+    """(body, ETag) of a live camera's window: its archive manifest (a segment_cache entry)
+    cut to the last LIVE_WINDOW_SEGMENTS segments. Cut once per archive manifest version."""
+    cached = live_manifests.get(camera_id)
+    if cached is None or cached[0] != entry.etag:
+        mpd = window_manifest(entry.data.decode("utf-8", errors="replace"), LIVE_WINDOW_SEGMENTS)
+        cached = live_manifests[camera_id] = (entry.etag, mpd.encode("utf-8"))
+    # a different body from the archive manifest's, so a different tag
+    return cached[1], entry.etag[:-1] + '-live"'
+
+def _stat_file(path):
+    """os.stat of a regular file, or None."""
+    try:
+        st = os.stat(path) if path is not None else None
+    except OSError:
+        return None
+    return st if st is not None and stat.S_ISREG(st.st_mode) else None
+
+def preload_segment(camera_id, chunks_dir, number):
+    """Read a just-written segment of every rendition into segment_cache, where viewers will ask for it."""
+    if not segment_cache.max_bytes:
+        return
+    directory = chunks_dir
+    if LIVE_WINDOW_SEGMENTS and camera_id in low_latency_cameras:
+        directory = os.path.join(chunks_dir, LIVE_DIR)
+    stream = 0
+    while segment_cache.load(os.path.join(directory, segment_name(stream, number))) is not None:
+        stream += 1
 def setup_chunks_dir(base_dir="./chunks"):
     # Normalize base_dir to be inside the server package unless an absolute path was provided
     if not os.path.isabs(base_dir):
@@ -157,51 +1179,100 @@ def setup_chunks_dir(base_dir="./chunks"):
         os.makedirs(base_dir)
         return
 
-def _conversion_worker(camera_id, manifest_path, output_path):
-    """Run ffmpeg to convert a DASH manifest to a single MP4 file.
-    This runs in a background thread so the HTTP request can return immediately.
-    """
-    try:
-        # Use copy to avoid re-encoding when possible; allow necessary protocols
-        ffmpeg_cmd = [
-            "ffmpeg",
-            "-i", manifest_path,
-            "-c:v", "libx264",
-            "-pix_fmt", "yuv420p",
-            output_path
-        ]
-        print(f"[Conversion] Starting conversion for {camera_id}: {' '.join(ffmpeg_cmd)}")
-        proc = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=os.path.dirname(output_path))
-        stdout, stderr = proc.communicate()
-        if proc.returncode == 0:
-            print(f"[Conversion] Finished converting {camera_id} -> {output_path}")
-        else:
-            print(f"[Conversion] FFmpeg failed for {camera_id} (code {proc.returncode}): {stderr.decode(errors='ignore')}")
-    except Exception as e:
-        print(f"[Conversion] Exception while converting {camera_id}: {e}")
-    finally:
-        with active_conversions_lock:
-            active_conversions.pop(camera_id, None)
-
-def start_conversion(camera_id, manifest_path, output_path):
-    with active_conversions_lock:
-        if camera_id in active_conversions:
-            raise RuntimeError(f"Conversion already in progress for {camera_id}")
-        thread = threading.Thread(target=_conversion_worker, args=(camera_id, manifest_path, output_path), daemon=True)
-        active_conversions[camera_id] = thread
-        thread.start()
-        return thread.ident
-
-@app.route("/convert/<camera_id>", methods=["POST"])
+def get_conversion_scheduler():
+    global conversion_scheduler
+    if conversion_scheduler is None:
+        conversion_scheduler = ConversionScheduler(log=lambda msg: print(f"[Conversion] {msg}"),
+                                                   on_finished=on_conversion_finished,
+                                                   piece_workers=os.cpu_count() or 1,
+                                                   on_update=publish_conversion)
+    return conversion_scheduler
+
+def publish_conversion(status):
+    event_bus.publish("conversion", **status)
+
+def publish_recording(row):
+    event_bus.publish("recording", **row)
+
+def on_conversion_finished(job):
+    CONVERSIONS_FINISHED.inc()
+    if job.excerpt is not None:
+        # exports don't count as the recording's conversion
+        return
+    get_recording_catalog().conversion_finished(job.camera_id, job.output_path)
+
+def get_recording_catalog():
+    global recording_catalog
+    if recording_catalog is None:
+        recording_catalog = RecordingCatalog(CATALOG_PATH, on_change=publish_recording)
+    return recording_catalog
+
+def start_conversion(camera_id, manifest_path, output_path, mode=conversion.MODE_AUTO, priority=0, excerpt=None):
+    """Queue a conversion; raises RuntimeError if the camera is already queued or converting."""
+    return get_conversion_scheduler().submit(camera_id, manifest_path, output_path, mode, priority, excerpt)
+
+@app.route("/convert/<camera_id>", methods=["POST", "DELETE"])
 def convert_route(camera_id):
     """
-    Start a background conversion of a past recording (chunks/<camera_id>/manifest.mpd)
-    into converted/<camera_id>.mp4. Returns 202 if started, 404 if not found, 409 if already converting.
+    Queue a background conversion of a past recording (chunks/<camera_id>/manifest.mpd)
+    into converted/<camera_id>.mp4. Returns 202 if queued, 404 if not found, 409 if already converting.
+    ?mode=copy|transcode|auto (default auto: stream copy, re-encode only if copying fails).
+    ?priority=<int> (higher starts first, default 0).
+    ?start=<t>&end=<t> exports only that range to exports/<camera_id>.<start>-<end>.mp4; times are
+    seconds into the recording or ISO 8601 wall-clock times.
+    ?active=1 exports only the segments with activity (see /activity), &min_activity=<share>
+    overrides the motion threshold.
+    DELETE cancels a queued or running conversion.
     """
+    if request.method == "DELETE":
+        return cancel_conversion(camera_id)
+    return request_conversion(camera_id, request.args.get("mode", conversion.MODE_AUTO), request.args.get("priority", 0),
+                              query_flag(request.args.get("active")), request.args.get("min_activity"),
+                              request.args.get("start"), request.args.get("end"))
+
+def query_flag(value):
+    return value is not None and value.strip().lower() in ("1", "true", "yes", "on")
+
+@app.route("/convert-all", methods=["POST"])
+def convert_all_route():
+    """Queue every past recording that is not converted or converting yet. Same query parameters as /convert."""
+    return request_convert_all(request.args.get("mode", conversion.MODE_AUTO), request.args.get("priority", 0))
+
+def cancel_conversion(camera_id):
+    if get_conversion_scheduler().cancel(camera_id):
+        return {"status": "cancelled", "camera_id": camera_id}, 200
+    return {"error": "No conversion queued or running"}, 404
+
+def request_convert_all(mode=conversion.MODE_AUTO, priority=0):
+    """Queue conversions for all past recordings; returns (body, status) for the HTTP layer."""
+    queued, skipped = [], []
+    recordings, _ = get_recording_catalog().query(STATE_RECORDED, converted=False)
+    for camera_id in [r["camera_id"] for r in recordings]:
+        body, status = request_conversion(camera_id, mode, priority)
+        if status == 400:
+            return body, status
+        (queued if status == 202 else skipped).append(camera_id)
+    return {"queued": queued, "skipped": skipped}, 202
+
+def request_conversion(camera_id, mode=conversion.MODE_AUTO, priority=0, active=False, min_activity=None,
+                       start=None, end=None):
+    """Validate and queue a conversion; returns (body, status) for the HTTP layer.
+    With a start or end, or active, only part of the recording is exported (see request_export)."""
+    if mode not in conversion.MODES:
+        return {"error": f"Unknown mode {mode!r}, expected one of {', '.join(conversion.MODES)}"}, 400
+    try:
+        priority = int(priority)
+    except (TypeError, ValueError):
+        return {"error": "priority must be an integer"}, 400
+    if segment_mover is not None:
+        # conversions and exports of a live camera read everything from disk
+        segment_mover.flush(camera_id)
     chunks_dir = os.path.join(SERVER_ROOT, "chunks", camera_id)
     manifest_path = os.path.join(chunks_dir, "manifest.mpd")
     if not os.path.isdir(chunks_dir) or not os.path.exists(manifest_path):
         return {"error": "Recording not found"}, 404
+    if active or start not in (None, "") or end not in (None, ""):
+        return request_export(camera_id, chunks_dir, manifest_path, mode, priority, active, min_activity, start, end)
 
     converted_dir = os.path.join(SERVER_ROOT, "converted")
     os.makedirs(converted_dir, exist_ok=True)
@@ -211,65 +1282,235 @@ def convert_route(camera_id):
         return {"error": "Converted file already exists"}, 409
 
     try:
-        pid = start_conversion(camera_id, manifest_path, output_path)
+        start_conversion(camera_id, manifest_path, output_path, mode, priority)
     except RuntimeError as e:
         return {"error": str(e)}, 409
     except Exception as e:
         return {"error": f"Failed to start conversion: {e}"}, 500
 
     return {
-        "status": "started",
         "camera_id": camera_id,
         "output": f"converted/{camera_id}.mp4",
-        "thread_id": pid
+        "mode": mode,
+        "priority": priority,
+        **conversion_status(camera_id)
     }, 202
 
+def request_export(camera_id, chunks_dir, manifest_path, mode, priority, active, min_activity, start, end):
+    """Queue an export of the segments between start and end and, with active, only those whose
+    activity reached min_activity (default: the motion threshold). Segments are found through the
+    manifest's timeline, so the cost follows the excerpt's length. Works on live cameras too
+    (their finished segments); a new export of the same part replaces the last one."""
+    timeline = conversion.segment_timeline(manifest_path)
+    if not timeline:
+        return {"error": "Recording has no segment timeline"}, 404
+    try:
+        start = recording_time(camera_id, timeline, start)
+        end = recording_time(camera_id, timeline, end)
+    except ValueError:
+        return {"error": "start and end must be seconds into the recording or ISO 8601 times"}, 400
+    if start is not None and end is not None and end <= start:
+        return {"error": "end must be after start"}, 400
+    segments = [(number, seg_start, duration) for number, seg_start, duration in timeline
+                if (start is None or seg_start + duration > start) and (end is None or seg_start < end)]
+    export_id = camera_id
+    if start is not None or end is not None:
+        export_id += f".{_time_label(start or 0)}-{_time_label(end) if end is not None else 'end'}"
+    if active:
+        try:
+            min_activity = _float_arg(min_activity)
+        except ValueError:
+            return {"error": "min_activity must be a number"}, 400
+        if min_activity is None:
+            min_activity = motion_analyzer.threshold if motion_analyzer is not None else DEFAULT_MOTION_THRESHOLD
+        active_numbers = {row["number"] for row in get_recording_catalog().segments(camera_id, min_activity)}
+        segments = [segment for segment in segments if segment[0] in active_numbers]
+        export_id += ".activity"
+    # retention may have deleted some since the manifest was written
+    segments = [segment for segment in segments
+                if os.path.exists(os.path.join(chunks_dir, segment_name(0, segment[0])))]
+    if not segments:
+        return {"error": "No segments with activity in range" if active else "No segments in range"}, 404
+    if get_conversion_scheduler().is_active(export_id):
+        return {"error": f"Conversion already in progress for {export_id}"}, 409
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    excerpt = conversion.Excerpt(chunks_dir, segments, start, end)
+    try:
+        start_conversion(export_id, manifest_path, os.path.join(EXPORTS_DIR, f"{export_id}.mp4"), mode, priority,
+                         excerpt)
+    except RuntimeError as e:
+        return {"error": str(e)}, 409
+    return {
+        **conversion_status(export_id),
+        "camera_id": camera_id,
+        "export_id": export_id,
+        "output": f"exports/{export_id}.mp4",
+        "start": start,
+        "end": end,
+        "segments": len(segments),
+        # stream copy keeps whole segments; only re-encoding trims to start and end
+        "duration": round(excerpt.duration(trim=mode == conversion.MODE_TRANSCODE), 3),
+        "min_activity": min_activity if active else None,
+        "mode": mode,
+        "priority": priority
+    }, 202
+
+def recording_time(camera_id, timeline, value):
+    """Seconds into a recording for a start/end parameter: seconds as given, or an ISO 8601 time
+    (local unless it has an offset) placed through the segment index. None if absent; raises
+    ValueError if malformed."""
+    if value in (None, ""):
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    when = datetime.datetime.fromisoformat(value).timestamp()
+    catalog = get_recording_catalog()
+    row = catalog.segment_at(camera_id, when)
+    if row is None:
+        # before the first indexed segment, or a recording from before the index: count from its start
+        recording = catalog.get(camera_id)
+        return max(0.0, when - recording["started"]) if recording and recording["started"] else 0.0
+    segments = {number: (start, duration) for number, start, duration in timeline}
+    if row["number"] in segments:
+        start, duration = segments[row["number"]]
+        return start + min(max(0.0, when - row["started"]), duration)
+    # the segment is gone: clamp to what is left
+    first, last = timeline[0], timeline[-1]
+    return first[1] if row["number"] < first[0] else last[1] + last[2]
+
+def _time_label(seconds):
+    return f"{seconds:.3f}".rstrip("0").rstrip(".")
+
 def stop_all_streams():
     for cam_id in list(camera_streams.keys()):
+        # its decoder exiting from here on is not a crash
+        get_encoder_supervisor().untrack(cam_id)
         try:
             camera_streams[cam_id].put(None)
         except Exception:
             pass
+        finalize_recording(cam_id, camera_decoders.get(cam_id))
+    for callback in list(stop_callbacks):
+        callback()
 @app.route("/convert-status/<camera_id>")
 def convert_status(camera_id):
+    """Server-sent events with the conversion's status until it completes (see conversion_status)."""
     if os.path.basename(camera_id) != camera_id:
         return {"error": "Invalid filename"}, 400
     def stream():
-        last_status = None
-        while True:
-            with active_conversions_lock:
-                in_progress = camera_id in active_conversions
-            converted_dir = os.path.join(SERVER_ROOT, "converted")
-            output_path = os.path.join(converted_dir, f"{camera_id}.mp4")
-            if in_progress:
-                status = "in_progress"
-            elif os.path.exists(output_path):
-                status = "completed"
-            else:
-                status = "not_found"
-            if status != last_status:
-                yield f"data: {status}\n\n"
-                last_status = status
-            if status in ("completed", "not_found"):
-                break
-            time.sleep(1)
+        subscription = Subscription(event_bus, ("conversion",))
+        try:
+            # after subscribing, so no change is missed
+            status = conversion_status(camera_id)
+            while True:
+                if status is not None:
+                    yield f"data: {json.dumps(status)}\n\n"
+                    if status["status"] in ("completed", "not_found"):
+                        return
+                events, resync = subscription.wait(EVENTS_KEEPALIVE)
+                status = conversion_status(camera_id) if resync else follow_conversion(camera_id, events)
+                if status is None and not events:
+                    yield ": keepalive\n\n"
+        finally:
+            subscription.close()
     return app.response_class(stream(), mimetype='text/event-stream')
+
+def follow_conversion(camera_id, events):
+    """The /convert-status message for the newest of these conversion events about camera_id, or None."""
+    for event in reversed(events):
+        if event.data["camera_id"] == camera_id:
+            if event.data["status"] in ("completed", "queued", "in_progress"):
+                return {"status": "completed"} if event.data["status"] == "completed" else event.data
+            # failed or cancelled: an earlier conversion's file may still be there
+            return conversion_status(camera_id)
+    return None
+
+@app.route("/events")
+def events_route():
+    """
+    One server-sent event stream of everything dashboards show, as it changes.
+    It starts with a `snapshot` event (the /info body), then sends `camera`, `recording`,
+    `segment` and `conversion` events. ?topics=camera,conversion limits the stream to
+    those topics. Reconnects with Last-Event-ID get the missed events instead of a snapshot.
+    """
+    value, error = open_event_stream(request.args, request.headers.get("Last-Event-ID"))
+    if error:
+        return error
+    subscription, first = value
+    def stream():
+        try:
+            yield first
+            while True:
+                events, resync = subscription.wait(EVENTS_KEEPALIVE)
+                if resync:
+                    yield event_snapshot()
+                if events:
+                    yield "".join(event.sse() for event in events)
+                elif not resync:
+                    yield ": keepalive\n\n"
+        finally:
+            subscription.close()
+    return app.response_class(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def open_event_stream(args, last_event_id=None, on_pending=None):
+    """Subscribe an /events client. Returns ((subscription, first message), None), or
+    (None, (body, status)) for bad parameters. The caller closes the subscription."""
+    topics = None
+    if args.get("topics"):
+        topics = set(args["topics"].split(","))
+        if not topics <= set(EVENT_TOPICS):
+            return None, ({"error": f"Unknown topics, expected some of {', '.join(EVENT_TOPICS)}"}, 400)
+    after = last_event_id or args.get("last_event_id")
+    try:
+        after = int(after) if after not in (None, "") else None
+    except ValueError:
+        after = None
+    subscription = Subscription(event_bus, topics, after, on_pending)
+    # the reconnect delay the browser uses, then the state later events apply to
+    first = "retry: 2000\n\n"
+    if not subscription.complete:
+        first += event_snapshot(subscription.last_id)
+    return (subscription, first), None
+
+def event_snapshot(event_id=None):
+    """A `snapshot` message with the /info body, as of event_id (default: the newest event)."""
+    return sse_message("snapshot", build_info(), event_bus.last_id if event_id is None else event_id)
+
+def conversion_status(camera_id):
+    """{"status": queued|in_progress|completed|not_found}, plus position while queued
+    and mode, percent, speed and eta while in progress."""
+    job = get_conversion_scheduler().status(camera_id)
+    if job is not None:
+        return {"status": job.pop("state"), **job}
+    for directory in (os.path.join(SERVER_ROOT, "converted"), EXPORTS_DIR):
+        if os.path.exists(os.path.join(directory, f"{camera_id}.mp4")):
+            return {"status": "completed"}
+    return {"status": "not_found"}
 @app.route("/download/<filename>")
 def download_converted(filename):
+    file_path, error = resolve_download(filename)
+    if error:
+        return error
+    # Serve the file as an attachment to prompt download
+    return send_from_directory(os.path.dirname(file_path), filename, as_attachment=True)
+
+def resolve_download(filename):
+    """Returns (path, None) for a finished conversion or export, else (None, (body, status))."""
     # Disallow directory traversal: filename must not contain path separators
     if os.path.basename(filename) != filename:
-        return {"error": "Invalid filename"}, 400
+        return None, ({"error": "Invalid filename"}, 400)
     converted_dir = os.path.join(SERVER_ROOT, "converted")
-    if not os.path.isdir(converted_dir):
-        return {"error": "No converted recordings available"}, 404
-    file_path = os.path.join(converted_dir, filename)
-    if not os.path.isfile(file_path):
-        return {"error": "File not found"}, 404
-    with active_conversions_lock:
-        if os.path.splitext(filename)[0] in active_conversions:
-            return {"error": "Conversion still in progress"}, 409
-    # Serve the file as an attachment to prompt download
-    return send_from_directory(converted_dir, filename, as_attachment=True)
+    if not os.path.isdir(converted_dir) and not os.path.isdir(EXPORTS_DIR):
+        return None, ({"error": "No converted recordings available"}, 404)
+    file_path = next((path for path in (os.path.join(converted_dir, filename), os.path.join(EXPORTS_DIR, filename))
+                      if os.path.isfile(path)), None)
+    if file_path is None:
+        return None, ({"error": "File not found"}, 404)
+    if get_conversion_scheduler().is_active(os.path.splitext(filename)[0]):
+        return None, ({"error": "Conversion still in progress"}, 409)
+    return file_path, None
 
 def menu_loop():
     """Interactive single-char menu:
@@ -291,6 +1532,9 @@ def menu_loop():
             continue
         if c == 'l':
             print(f"Open camera streams: {list(camera_streams.keys())}")
+            for cam_id, q in list(camera_streams.items()):
+                st = q.stats()
+                print(f"  {cam_id}: {st['depth_bytes']} B queued, {st['dropped_bytes']} B dropped, {st['rejected_chunks']} rejected")
         elif c == 't':
             print("Stopping all streams...")
             stop_all_streams()
@@ -306,16 +1550,173 @@ def menu_loop():
         else:
             print('Unknown command, use l/t/q')
 def main(argv=None):
+    global INGEST_BUFFER_BYTES, INGEST_POLICY, PACKAGING_MODE, LADDER, ABR_DEFAULT, MAX_LADDER_ENCODES
+    global conversion_scheduler, recording_catalog, segment_collector
+    global LIVE_WINDOW_SEGMENTS, RETENTION, encoder_supervisor
+    global MAX_ENCODERS, CPU_RESERVE, CPU_ADMISSION, MAX_RESTARTS, STALL_TIMEOUT, DASH_CACHE_BYTES, segment_cache
+    global LOW_LATENCY_DEFAULT, snapshot_cache, mosaic, motion_analyzer, frame_tap, segment_mover
     parser = argparse.ArgumentParser(description='MultiFlow server')
     parser.add_argument('--host', default='0.0.0.0', help='Host to bind the server to')
     parser.add_argument('--port', type=int, default=5000, help='Port to listen on')
     parser.add_argument('--debug', action='store_true', help='Enable Flask debug mode')
+    parser.add_argument('--engine', choices=('flask', 'aiohttp'), default='flask',
+                        help='HTTP engine: threaded Flask dev server, or a single asyncio event loop (needs aiohttp)')
+    parser.add_argument('--ingest-buffer-mb', type=float, default=INGEST_BUFFER_BYTES / (1024 * 1024),
+                        help='Max encoded data buffered per camera before the ingest policy kicks in')
+    parser.add_argument('--ingest-policy', choices=POLICIES, default=INGEST_POLICY,
+                        help='What to do when a camera buffer is full: refuse uploads with 503, drop oldest data, or drop until the next keyframe')
+    parser.add_argument('--packaging', choices=PACKAGING_MODES, default=PACKAGING_MODE,
+                        help='transcode every camera, stream-copy the uploaded H.264, or copy when browser-playable (auto); cameras can override with a Packaging header')
+    parser.add_argument('--ladder', type=parse_ladder, default=DEFAULT_LADDER,
+                        help='Bitrate ladder as height:bitrate pairs, e.g. 1080:5000k,720:2500k,360:800k')
+    parser.add_argument('--abr', action='store_true',
+                        help='Encode the ladder for every camera by default (cameras can opt in/out with an ABR-Ladder header)')
+    parser.add_argument('--low-latency', action='store_true',
+                        help='Package every camera for low-latency live viewing by default (cameras can opt in/out with a Low-Latency header)')
+    parser.add_argument('--max-ladder-encodes', type=int, default=MAX_LADDER_ENCODES,
+                        help='Max cameras encoding the ladder at once; others fall back to a single rendition')
+    parser.add_argument('--max-conversions', type=int, default=1,
+                        help='Conversions that may run at once; further requests wait in a queue')
+    parser.add_argument('--conversion-nice', type=int, default=10,
+                        help='Niceness added to conversion ffmpeg processes so live cameras keep priority')
+    parser.add_argument('--export-workers', type=int, default=os.cpu_count() or 1,
+                        help='ffmpeg processes a re-encoded time-range or activity export is split over (default: one per core)')
+    parser.add_argument('--conversion-cpus', type=lambda v: {int(c) for c in v.split(',')},
+                        help='Comma-separated CPU ids conversions are pinned to (Linux only)')
+    parser.add_argument('--catalog', default=CATALOG_PATH,
+                        help='SQLite file indexing recordings for /info')
+    parser.add_argument('--live-window', type=int, default=LIVE_WINDOW_SEGMENTS,
+                        help='Segments in the live manifest served under /dash/<id>/live/ (0 serves the full archive)')
+    parser.add_argument('--ram-dir',
+                        help='RAM-backed directory (e.g. /dev/shm/multiflow) live cameras write to; '
+                             'finished segments are moved to chunks/ in batches')
+    parser.add_argument('--ram-flush-delay', type=float, default=DEFAULT_RAM_FLUSH_DELAY,
+                        help='Most seconds finished segments wait in RAM before being moved to disk')
+    parser.add_argument('--ram-flush-batch-mb', type=float, default=DEFAULT_RAM_FLUSH_BATCH / (1024 * 1024),
+                        help='Move to disk as soon as this much is waiting in RAM')
+    parser.add_argument('--retain-hours', type=float,
+                        help='Delete archived segments older than this')
+    parser.add_argument('--max-camera-gb', type=float,
+                        help='Delete the oldest segments of a recording above this size')
+    parser.add_argument('--max-total-gb', type=float,
+                        help='Delete the oldest segments across all recordings above this total size')
+    parser.add_argument('--gc-interval', type=float, default=GC_INTERVAL,
+                        help='Seconds between retention passes')
+    parser.add_argument('--max-encoders', type=int, default=0,
+                        help='Max camera decoders running at once (0: limited by CPU headroom only)')
+    parser.add_argument('--cpu-reserve', type=float, default=CPU_RESERVE,
+                        help='Share of all CPUs kept idle when admitting a new camera')
+    parser.add_argument('--no-cpu-admission', action='store_true',
+                        help='Admit cameras regardless of measured CPU headroom')
+    parser.add_argument('--max-restarts', type=int, default=MAX_RESTARTS,
+                        help=f'Restarts of a crashed decoder allowed per {RESTART_WINDOW} s before the camera is closed')
+    parser.add_argument('--stall-timeout', type=float, default=STALL_TIMEOUT,
+                        help='Seconds a fed decoder may make no progress before it is restarted')
+    parser.add_argument('--snapshot-interval', type=float, default=snapshot_cache.interval,
+                        help='Seconds between thumbnails of a camera served at /snapshot/<id> (0 disables)')
+    parser.add_argument('--snapshot-width', type=int, default=snapshot_cache.width,
+                        help='Thumbnail width in pixels')
+    parser.add_argument('--snapshot-format', choices=sorted(SNAPSHOT_FORMATS), default=snapshot_cache.format,
+                        help='Thumbnail image format')
+    parser.add_argument('--mosaic', action='store_true',
+                        help=f'Publish a tiled mosaic of all live cameras at /dash/{MOSAIC_ID}/manifest.mpd')
+    parser.add_argument('--mosaic-size', type=lambda v: tuple(int(n) for n in v.lower().split('x')),
+                        default=DEFAULT_MOSAIC_SIZE, help='Mosaic size as WIDTHxHEIGHT (default: %(default)s)')
+    parser.add_argument('--mosaic-fps', type=int, default=DEFAULT_MOSAIC_FPS,
+                        help='Mosaic frame rate')
+    parser.add_argument('--motion', action='store_true',
+                        help='Analyse live cameras for motion: per-segment activity index at /activity/<id>, '
+                             'idle hints to uploading clients')
+    parser.add_argument('--motion-threshold', type=float, default=DEFAULT_MOTION_THRESHOLD,
+                        help='Share of changed pixels from which a frame counts as activity')
+    parser.add_argument('--motion-idle-after', type=float, default=DEFAULT_MOTION_IDLE_AFTER,
+                        help='Seconds without activity after which a camera counts as idle')
+    parser.add_argument('--dash-cache-mb', type=float, default=DASH_CACHE_BYTES / (1024 * 1024),
+                        help='Memory for recently written manifests and segments served to viewers (0 disables)')
     args = parser.parse_args(argv)
 
+    INGEST_BUFFER_BYTES = int(args.ingest_buffer_mb * 1024 * 1024)
+    INGEST_POLICY = args.ingest_policy
+    PACKAGING_MODE = args.packaging
+    # argparse only applies type= to string defaults, so this is always parsed
+    LADDER = args.ladder
+    ABR_DEFAULT = args.abr
+    LOW_LATENCY_DEFAULT = args.low_latency
+    MAX_LADDER_ENCODES = args.max_ladder_encodes
+    LIVE_WINDOW_SEGMENTS = max(0, args.live_window)
+    MAX_ENCODERS = args.max_encoders or None
+    CPU_RESERVE = args.cpu_reserve
+    CPU_ADMISSION = not args.no_cpu_admission
+    MAX_RESTARTS = args.max_restarts
+    STALL_TIMEOUT = args.stall_timeout
+    DASH_CACHE_BYTES = int(args.dash_cache_mb * 1024 * 1024)
+    segment_cache = SegmentCache(DASH_CACHE_BYTES)
+    snapshot_cache = SnapshotCache(interval=args.snapshot_interval, width=args.snapshot_width,
+                                   fmt=args.snapshot_format, log=snapshot_cache.log)
+    gb = 1024 ** 3
+    RETENTION = RetentionPolicy(
+        max_age=args.retain_hours * 3600 if args.retain_hours is not None else None,
+        max_camera_bytes=int(args.max_camera_gb * gb) if args.max_camera_gb is not None else None,
+        max_total_bytes=int(args.max_total_gb * gb) if args.max_total_gb is not None else None
+    )
+    conversion_scheduler = ConversionScheduler(
+        max_workers=args.max_conversions,
+        nice=args.conversion_nice,
+        cpus=args.conversion_cpus,
+        log=lambda msg: print(f"[Conversion] {msg}"),
+        on_finished=on_conversion_finished,
+        piece_workers=args.export_workers,
+        on_update=publish_conversion
+    )
+
     setup_chunks_dir()
+    if args.ram_dir:
+        segment_mover = SegmentMover(os.path.abspath(args.ram_dir), os.path.join(SERVER_ROOT, "chunks"),
+                                     delay=args.ram_flush_delay, batch_bytes=int(args.ram_flush_batch_mb * 1024 * 1024),
+                                     log=lambda msg: print(f"[RAM tier] {msg}"))
+        # before the catalog scans chunks/, so it sees what a previous run left in RAM
+        segment_mover.recover()
+        segment_mover.start()
+    recording_catalog = RecordingCatalog(args.catalog, on_change=publish_recording)
+    # One directory walk at startup; afterwards the catalog is updated as cameras and conversions finish
+    recording_catalog.sync_from_disk(os.path.join(SERVER_ROOT, "chunks"), os.path.join(SERVER_ROOT, "converted"))
+    if RETENTION.enabled():
+        segment_collector = SegmentCollector(
+            os.path.join(SERVER_ROOT, "chunks"), RETENTION, recording_catalog,
+            is_busy=conversion_scheduler.is_active,
+            interval=args.gc_interval,
+            log=lambda msg: print(f"[Retention] {msg}")
+        )
+        segment_collector.start()
+    encoder_supervisor = None
+    get_encoder_supervisor().start(on_stalled=kill_stalled_decoder)
+    if (args.mosaic or args.motion) and sys.platform == "win32":
+        print("[Server] The mosaic and motion analysis need extra ffmpeg output pipes, not supported on Windows; disabled")
+    elif args.mosaic or args.motion:
+        frame_tap = FrameTap(fps=args.mosaic_fps if args.mosaic else DEFAULT_MOTION_FPS,
+                             log=lambda msg: print(f"[FrameTap] {msg}"))
+        if args.mosaic:
+            mosaic = Mosaic(MOSAIC_DIR, args.mosaic_size, args.mosaic_fps,
+                            window=LIVE_WINDOW_SEGMENTS or 6, log=lambda msg: print(f"[Mosaic] {msg}"))
+            frame_tap.subscribe(mosaic)
+            mosaic.start()
+        if args.motion:
+            motion_analyzer = MotionAnalyzer(args.motion_threshold, args.motion_idle_after)
+            frame_tap.subscribe(motion_analyzer)
     threading.Thread(target=menu_loop, daemon=True).start()
-    threading.Thread(target=aggregate_telemetry, daemon=True).start()
-    app.run(host=args.host, port=args.port, threaded=True)
+    if args.engine == 'aiohttp':
+        try:
+            import aio_server
+        except ImportError as e:
+            sys.exit(f"--engine aiohttp needs the aiohttp package: {e}")
+    try:
+        if args.engine == 'aiohttp':
+            aio_server.run(sys.modules[__name__], args.host, args.port)
+        else:
+            app.run(host=args.host, port=args.port, threaded=True)
+    finally:
+        if mosaic is not None:
+            mosaic.stop()
 
 
 if __name__ == "__main__":
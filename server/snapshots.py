@@ -0,0 +1,134 @@
+"""
+Low-resolution snapshots of live cameras for the overview grid.
+
+Every DASH segment starts with a keyframe, so the newest one is always a
+decodable picture. When a camera finishes a segment and its snapshot is due,
+the server queues the segment here. One worker thread decodes the keyframe
+with OpenCV, reading init segment and media segment through ffmpeg's concat
+protocol without a temporary file. The worker scales the frame down, encodes
+it as JPEG or WebP, and keeps the result in memory. A grid of thumbnails then
+costs the browser one small image per camera instead of one video decoder.
+
+Cameras nobody has asked a snapshot of for a while are only refreshed when
+they have none yet, so unwatched cameras cost nothing after their first
+picture.
+"""
+import queue
+import threading
+import time
+
+import cv2
+
+FORMATS = {"jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY, "image/jpeg"),
+           "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY, "image/webp")}
+DEFAULT_INTERVAL = 5
+DEFAULT_WIDTH = 320
+DEFAULT_FORMAT = "jpeg"
+DEFAULT_QUALITY = 70
+# Snapshots of cameras not requested for this long are no longer refreshed
+IDLE_SECONDS = 60
+# Segments waiting for the worker; further ones are skipped while it is behind
+MAX_PENDING = 64
+
+
+class Snapshot:
+    __slots__ = ("data", "taken", "etag", "content_type")
+
+    def __init__(self, data, taken, content_type):
+        self.data = data
+        self.taken = taken
+        self.etag = f'"{int(taken * 1000):x}-{len(data):x}"'
+        self.content_type = content_type
+
+
+def grab_keyframe(init_path, segment_path):
+    """First frame of a fragmented-MP4 segment as a BGR array, or None."""
+    cap = cv2.VideoCapture(f"concat:{init_path}|{segment_path}", cv2.CAP_FFMPEG)
+    try:
+        ok, frame = cap.read()
+    finally:
+        cap.release()
+    return frame if ok else None
+
+
+def encode_thumbnail(frame, width=DEFAULT_WIDTH, fmt=DEFAULT_FORMAT, quality=DEFAULT_QUALITY):
+    """Scale frame down to width (never up) and encode it; returns bytes or None."""
+    height, source_width = frame.shape[:2]
+    if source_width > width:
+        # even height keeps encoders happy and the aspect ratio close
+        scaled = max(2, round(height * width / source_width / 2) * 2)
+        frame = cv2.resize(frame, (width, scaled), interpolation=cv2.INTER_AREA)
+    extension, quality_flag, _ = FORMATS[fmt]
+    ok, buffer = cv2.imencode(extension, frame, [quality_flag, quality])
+    return buffer.tobytes() if ok else None
+
+
+class SnapshotCache:
+    """Latest snapshot per camera, refreshed from segments at most every `interval` seconds."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL, width=DEFAULT_WIDTH, fmt=DEFAULT_FORMAT,
+                 quality=DEFAULT_QUALITY, log=print):
+        self.interval = interval
+        self.width = width
+        self.format = fmt
+        self.quality = quality
+        self.log = log
+        self.failures = 0
+        self._snapshots = {}
+        self._requested = {}
+        self._queued = {}
+        self._pending = queue.Queue(MAX_PENDING)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def due(self, camera_id):
+        """True if a new segment of this camera should be turned into a snapshot."""
+        if not self.interval or camera_id in self._queued:
+            return False
+        snapshot = self._snapshots.get(camera_id)
+        if snapshot is None:
+            return True
+        if time.time() - self._requested.get(camera_id, 0) > IDLE_SECONDS:
+            return False
+        return time.time() - snapshot.taken >= self.interval
+
+    def submit(self, camera_id, init_path, segment_path):
+        """Queue a finished segment for decoding (call when due())."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, daemon=True)
+                self._thread.start()
+        try:
+            self._queued[camera_id] = True
+            self._pending.put_nowait((camera_id, init_path, segment_path))
+        except queue.Full:
+            self._queued.pop(camera_id, None)
+
+    def get(self, camera_id):
+        """The camera's latest Snapshot (or None); counts as a request for refresh purposes."""
+        snapshot = self._snapshots.get(camera_id)
+        if snapshot is not None:
+            self._requested[camera_id] = time.time()
+        return snapshot
+
+    def forget(self, camera_id):
+        # a segment still queued for the camera is decoded but not kept
+        self._queued.pop(camera_id, None)
+        self._snapshots.pop(camera_id, None)
+        self._requested.pop(camera_id, None)
+
+    def _worker(self):
+        while True:
+            camera_id, init_path, segment_path = self._pending.get()
+            data = None
+            try:
+                frame = grab_keyframe(init_path, segment_path)
+                if frame is not None:
+                    data = encode_thumbnail(frame, self.width, self.format, self.quality)
+            except Exception as e:
+                self.log(f"{camera_id}: {e}")
+            if data is None:
+                self.failures += 1
+                self._queued.pop(camera_id, None)
+            elif self._queued.pop(camera_id, None):
+                self._snapshots[camera_id] = Snapshot(data, time.time(), FORMATS[self.format][2])
@@ -0,0 +1,234 @@
+"""
+Supervision and admission control for the per-camera ffmpeg encoders.
+
+`EncoderSupervisor` keeps three jobs out of the ingest path:
+- Admission: a new camera is refused with `CapacityError` when the host is
+  out of CPU. It is admitted only if its expected encoder cost, in cores, fits
+  in the measured idle CPU minus a reserve. The cost is measured from running
+  encoders of the same kind ("copy", "transcode", "ladder"). A fixed encoder
+  limit can apply on top.
+- Crash recovery: the server reports encoders that exited on their own.
+  `restart_allowed` decides whether to bring them back; a camera that keeps
+  crashing is given up and refused for a while.
+- Health: stderr is drained into a short per-camera tail that is printed
+  when an encoder dies. Encoders that stop making progress while still being
+  fed are reported as stalled, so the server can kill and restart them.
+
+CPU is read from /proc. Where it is unavailable, only the fixed limit applies.
+"""
+import collections
+import os
+import statistics
+import threading
+import time
+
+from metrics import process_stats
+
+# Cores assumed for an encoder kind before any of them has been measured
+DEFAULT_COSTS = {"copy": 0.05, "transcode": 0.5, "ladder": 1.5}
+# Newly admitted encoders count at their expected cost until measured for this long
+WARMUP_SECONDS = 10
+STDERR_TAIL_LINES = 20
+
+
+class CapacityError(Exception):
+    """A camera was not admitted; str() is the reason sent to the client."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+def host_cpu_times():
+    """(idle, total) jiffies of all CPUs from /proc/stat, or None."""
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # idle + iowait count as available
+    return fields[3] + (fields[4] if len(fields) > 4 else 0), sum(fields[:8])
+
+
+class _Encoder:
+    def __init__(self, ffmpeg, kind):
+        self.ffmpeg = ffmpeg
+        self.kind = kind
+        self.started = time.monotonic()
+        self.cores = None
+        self.cpu_seconds = None
+        self.progress = time.monotonic()
+        self.fed = None
+        self.stderr = collections.deque(maxlen=STDERR_TAIL_LINES)
+        self.drain = None
+
+
+class EncoderSupervisor:
+    def __init__(self, max_encoders=None, cpu_reserve=0.1, cpu_admission=True, max_restarts=3,
+                 restart_window=60, stall_timeout=20, interval=2, refuse_seconds=60, log=print):
+        self.max_encoders = max_encoders
+        self.cpu_reserve = cpu_reserve
+        self.cpu_admission = cpu_admission
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.stall_timeout = stall_timeout
+        self.interval = interval
+        self.refuse_seconds = refuse_seconds
+        self.log = log
+        self.cpus = os.cpu_count() or 1
+        self.idle_cores = None
+        self.encoders = {}
+        self.restarts = collections.defaultdict(collections.deque)
+        # camera -> monotonic time until which it is refused after crashing too often
+        self.refused = {}
+        self._lock = threading.Lock()
+        self._cpu_sample = None
+
+    def start(self, on_stalled):
+        """Start sampling CPU; on_stalled(camera_id, ffmpeg) is called for hung encoders."""
+        threading.Thread(target=self._loop, args=(on_stalled,), daemon=True).start()
+
+    def _loop(self, on_stalled):
+        while True:
+            try:
+                self.sample()
+                for camera_id, ffmpeg in self.stalled():
+                    on_stalled(camera_id, ffmpeg)
+            except Exception as e:
+                self.log(f"Sampling failed: {e}")
+            time.sleep(self.interval)
+
+    def sample(self):
+        """Measure host idle CPU and each encoder's CPU use since the last sample."""
+        times = host_cpu_times()
+        if times is not None and self._cpu_sample is not None:
+            idle = times[0] - self._cpu_sample[0]
+            total = times[1] - self._cpu_sample[1]
+            if total > 0:
+                self.idle_cores = self.cpus * idle / total
+        if times is not None:
+            self._cpu_sample = times
+        now = time.monotonic()
+        with self._lock:
+            encoders = list(self.encoders.values())
+        for encoder in encoders:
+            stats = process_stats(encoder.ffmpeg.pid)
+            if stats is None:
+                continue
+            if encoder.cpu_seconds is not None:
+                cores = (stats[0] - encoder.cpu_seconds[0]) / max(1e-3, now - encoder.cpu_seconds[1])
+                # smooth over ~5 samples so one keyframe burst does not swing admission
+                encoder.cores = cores if encoder.cores is None else encoder.cores * 0.8 + cores * 0.2
+            encoder.cpu_seconds = (stats[0], now)
+
+    def cost(self, kind):
+        """Expected cores for a new encoder of this kind."""
+        with self._lock:
+            measured = [e.cores for e in self.encoders.values()
+                        if e.kind == kind and e.cores is not None and time.monotonic() - e.started > WARMUP_SECONDS]
+        if measured:
+            return statistics.median(measured)
+        return DEFAULT_COSTS.get(kind, DEFAULT_COSTS["transcode"])
+
+    def admit(self, camera_id, kind):
+        """Raise CapacityError unless another encoder of this kind fits on the host."""
+        refused_until = self.refused.get(camera_id)
+        if refused_until is not None:
+            if time.monotonic() < refused_until:
+                raise CapacityError(f"Encoder for {camera_id} keeps failing", int(refused_until - time.monotonic()) + 1)
+            self.refused.pop(camera_id, None)
+        with self._lock:
+            running = len(self.encoders)
+            warming = [e for e in self.encoders.values() if time.monotonic() - e.started <= WARMUP_SECONDS]
+        if self.max_encoders and running >= self.max_encoders:
+            raise CapacityError(f"Encoder limit reached ({self.max_encoders})", self.interval * 5)
+        if not self.cpu_admission or self.idle_cores is None or running == 0:
+            return
+        need = self.cost(kind)
+        # warming encoders have not shown up in the idle measurement yet
+        available = self.idle_cores - sum(self.cost(e.kind) for e in warming)
+        reserve = self.cpu_reserve * self.cpus
+        if available - need < reserve:
+            raise CapacityError(
+                f"Not enough CPU: {kind} encoder needs ~{need:.2f} cores, "
+                f"{max(0.0, available):.2f} idle of {self.cpus} ({reserve:.2f} reserved)",
+                self.interval * 5)
+
+    def track(self, camera_id, ffmpeg, kind):
+        """Watch a started encoder; drains its stderr, which must be a pipe."""
+        encoder = _Encoder(ffmpeg, kind)
+        with self._lock:
+            previous = self.encoders.get(camera_id)
+            if previous is not None:
+                # a restart keeps the camera's measured cost
+                encoder.cores = previous.cores
+                encoder.started = previous.started
+            self.encoders[camera_id] = encoder
+        encoder.drain = threading.Thread(target=self._drain_stderr, args=(encoder,), daemon=True)
+        encoder.drain.start()
+
+    def untrack(self, camera_id, ffmpeg=None):
+        with self._lock:
+            encoder = self.encoders.get(camera_id)
+            if encoder is not None and (ffmpeg is None or encoder.ffmpeg is ffmpeg):
+                del self.encoders[camera_id]
+
+    def tracking(self, camera_id, ffmpeg):
+        """True while ffmpeg is the camera's supervised encoder (untracked ones exit on purpose)."""
+        encoder = self.encoders.get(camera_id)
+        return encoder is not None and encoder.ffmpeg is ffmpeg
+
+    def _drain_stderr(self, encoder):
+        for line in encoder.ffmpeg.stderr:
+            encoder.stderr.append(line.decode(errors="ignore").rstrip())
+
+    def stderr_tail(self, camera_id, wait=1.0):
+        """Last stderr lines of the camera's encoder; waits up to `wait` s for an exited one to flush."""
+        with self._lock:
+            encoder = self.encoders.get(camera_id)
+        if encoder is None:
+            return []
+        if encoder.ffmpeg.poll() is not None:
+            encoder.drain.join(wait)
+        return list(encoder.stderr)
+
+    def progress(self, camera_id):
+        encoder = self.encoders.get(camera_id)
+        if encoder is not None:
+            encoder.progress = time.monotonic()
+
+    def fed(self, camera_id):
+        encoder = self.encoders.get(camera_id)
+        if encoder is not None:
+            encoder.fed = time.monotonic()
+
+    def stalled(self):
+        """(camera, ffmpeg) of encoders fed recently but without progress for stall_timeout."""
+        now = time.monotonic()
+        with self._lock:
+            encoders = list(self.encoders.items())
+        return [(camera_id, e.ffmpeg) for camera_id, e in encoders
+                if e.fed is not None and now - e.fed < self.stall_timeout
+                and now - max(e.progress, e.started) > self.stall_timeout and e.ffmpeg.poll() is None]
+
+    def restart_allowed(self, camera_id):
+        """Record a crash; False once the camera crashed max_restarts times within restart_window."""
+        now = time.monotonic()
+        history = self.restarts[camera_id]
+        while history and history[0] < now - self.restart_window:
+            history.popleft()
+        if len(history) >= self.max_restarts:
+            self.refused[camera_id] = now + self.refuse_seconds
+            del self.restarts[camera_id]
+            return False
+        history.append(now)
+        return True
+
+    def forget(self, camera_id):
+        self.untrack(camera_id)
+        self.restarts.pop(camera_id, None)
+
+    def snapshot(self):
+        """Cores per running encoder, for metrics."""
+        with self._lock:
+            return {camera_id: e.cores for camera_id, e in self.encoders.items()}
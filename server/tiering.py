@@ -0,0 +1,208 @@
+"""
+RAM tier for live cameras' DASH output, moved to disk in batches.
+
+With a RAM directory configured (a tmpfs such as /dev/shm), a live camera's
+ffmpeg writes its archive and its live window there instead of under
+chunks/<camera_id>/. Segment writes and the manifest rewrite after every
+segment then never touch the disk, and live viewers are served from memory.
+
+A mover thread copies finished archive segments to chunks/<camera_id>/ and
+deletes them from RAM. Work is collected until `batch_bytes` are waiting or
+`delay` seconds have passed. It is then written camera by camera in segment
+order, as a few large sequential writes instead of ffmpeg's many small ones.
+Each batch copies the camera's manifest as it was before the batch started,
+so the copy on disk never lists a segment that is not on disk yet.
+
+Conversions and exports of a live camera call flush() first, so they read
+everything from disk. When a camera stops, or its ffmpeg crashes, finish()
+moves the rest and clears its RAM directory. A RAM directory left behind by
+a server that did not shut down cleanly is moved to disk at startup
+(recover()).
+
+Copies are written to a .part file and renamed, so readers of chunks/ never
+see half a segment. There is no fsync: a segment that only lived in RAM is
+no safer before the copy.
+"""
+import os
+import re
+import shutil
+import threading
+import time
+
+from conversion import segment_timeline
+from retention import segment_name
+
+DEFAULT_DELAY = 10
+DEFAULT_BATCH_BYTES = 64 * 1024 * 1024
+_INIT_RE = re.compile(r"init-stream(\d+)\.m4s$")
+_CHUNK_RE = re.compile(r"chunk-stream(\d+)-(\d+)\.m4s$")
+
+
+class _CameraTier:
+    __slots__ = ("next_number", "newest", "streams", "pending_bytes")
+
+    def __init__(self):
+        # first segment number still in RAM, and the newest one ffmpeg has written
+        self.next_number = 1
+        self.newest = 0
+        self.streams = None
+        self.pending_bytes = 0
+
+
+class SegmentMover:
+    def __init__(self, ram_root, disk_root, delay=DEFAULT_DELAY, batch_bytes=DEFAULT_BATCH_BYTES, log=print):
+        self.ram_root = ram_root
+        self.disk_root = disk_root
+        self.delay = delay
+        self.batch_bytes = batch_bytes
+        self.log = log
+        self.moved_segments = 0
+        self.moved_bytes = 0
+        self._cameras = {}
+        # held while files move, so a flush and a batch never copy the same segment
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def ram_dir(self, camera_id):
+        return os.path.join(self.ram_root, camera_id)
+
+    def disk_dir(self, camera_id):
+        return os.path.join(self.disk_root, camera_id)
+
+    def camera_started(self, camera_id):
+        """Prepare a camera's RAM directory (where its ffmpeg writes) and return it."""
+        with self._lock:
+            self._cameras[camera_id] = _CameraTier()
+        os.makedirs(self.ram_dir(camera_id), exist_ok=True)
+        os.makedirs(self.disk_dir(camera_id), exist_ok=True)
+        return self.ram_dir(camera_id)
+
+    def segment_finished(self, camera_id, number):
+        """ffmpeg has written segment `number` of the camera's archive."""
+        camera = self._cameras.get(camera_id)
+        if camera is None:
+            return
+        try:
+            size = os.path.getsize(self.locate(camera_id, segment_name(0, number)))
+        except OSError:
+            size = 0
+        camera.newest = max(camera.newest, number)
+        camera.pending_bytes += size * len(camera.streams or (0,))
+        if self.backlog_bytes() >= self.batch_bytes:
+            self._wake.set()
+
+    def backlog_bytes(self):
+        return sum(camera.pending_bytes for camera in list(self._cameras.values()))
+
+    def locate(self, camera_id, filename):
+        """Path of one of a camera's archive files in whichever tier holds it (RAM first)."""
+        if camera_id in self._cameras:
+            path = os.path.join(self.ram_dir(camera_id), filename)
+            if os.path.exists(path):
+                return path
+        return os.path.join(self.disk_dir(camera_id), filename)
+
+    def flush(self, camera_id):
+        """Move everything the camera's RAM manifest lists to disk, then copy the manifest.
+        Does nothing for cameras that are not live."""
+        with self._lock:
+            camera = self._cameras.get(camera_id)
+            if camera is not None:
+                self._flush(camera_id, camera)
+
+    def finish(self, camera_id):
+        """The camera's ffmpeg has exited: move what is left to disk and clear its RAM directory."""
+        with self._lock:
+            camera = self._cameras.pop(camera_id, None) or _CameraTier()
+            self._flush(camera_id, camera)
+            self._drain(camera_id)
+
+    def recover(self):
+        """Move RAM directories a previous run left behind to disk. Call before any camera starts."""
+        try:
+            names = os.listdir(self.ram_root)
+        except FileNotFoundError:
+            return
+        for camera_id in names:
+            if os.path.isdir(self.ram_dir(camera_id)):
+                self.log(f"{camera_id}: moving segments left in RAM to disk")
+                self.finish(camera_id)
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.delay)
+            self._wake.clear()
+            started = time.monotonic()
+            with self._lock:
+                for camera_id, camera in list(self._cameras.items()):
+                    if camera.newest >= camera.next_number:
+                        self._flush(camera_id, camera)
+            took = time.monotonic() - started
+            if took > self.delay:
+                self.log(f"Moving to disk took {took:.1f} s, longer than the {self.delay} s batching delay; "
+                         f"the disk is falling behind")
+
+    def _flush(self, camera_id, camera):
+        ram_dir, disk_dir = self.ram_dir(camera_id), self.disk_dir(camera_id)
+        os.makedirs(disk_dir, exist_ok=True)
+        manifest = os.path.join(disk_dir, "manifest.mpd")
+        try:
+            # the manifest as it is now only lists segments that exist now
+            shutil.copyfile(os.path.join(ram_dir, "manifest.mpd"), manifest + ".part")
+        except OSError:
+            return
+        if camera.streams is None:
+            camera.streams = self._copy_init(camera_id)
+        timeline = segment_timeline(manifest + ".part")
+        # without a timeline (archive written in place) the newest segment may be unfinished
+        last = timeline[-1][0] if timeline else camera.newest - 1
+        for number in range(camera.next_number, last + 1):
+            for stream in camera.streams:
+                self._move(os.path.join(ram_dir, segment_name(stream, number)),
+                           os.path.join(disk_dir, segment_name(stream, number)))
+        camera.next_number = max(camera.next_number, last + 1)
+        camera.pending_bytes = 0
+        os.replace(manifest + ".part", manifest)
+
+    def _copy_init(self, camera_id):
+        """Copy the camera's init segments to disk (they stay in RAM for live use); returns their streams."""
+        streams = []
+        for name in os.listdir(self.ram_dir(camera_id)):
+            match = _INIT_RE.match(name)
+            if match:
+                streams.append(int(match.group(1)))
+                self._move(os.path.join(self.ram_dir(camera_id), name),
+                           os.path.join(self.disk_dir(camera_id), name), keep=True)
+        return sorted(streams)
+
+    def _drain(self, camera_id):
+        """Move every finished file left in the camera's RAM directory and remove it."""
+        ram_dir, disk_dir = self.ram_dir(camera_id), self.disk_dir(camera_id)
+        try:
+            names = os.listdir(ram_dir)
+        except FileNotFoundError:
+            return
+        os.makedirs(disk_dir, exist_ok=True)
+        for name in sorted(names):
+            if _CHUNK_RE.match(name) or _INIT_RE.match(name) or name == "manifest.mpd":
+                self._move(os.path.join(ram_dir, name), os.path.join(disk_dir, name))
+        shutil.rmtree(ram_dir, ignore_errors=True)
+
+    def _move(self, source, target, keep=False):
+        """Copy source to target through a .part file and delete it unless keep. Returns
+        False if there was no source."""
+        try:
+            # copy2 keeps the mtime, which is when ffmpeg finished the segment
+            shutil.copy2(source, target + ".part")
+        except FileNotFoundError:
+            return False
+        os.replace(target + ".part", target)
+        self.moved_bytes += os.path.getsize(target)
+        if _CHUNK_RE.search(target):
+            self.moved_segments += 1
+        if not keep:
+            os.remove(source)
+        return True